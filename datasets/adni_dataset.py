@@ -1,10 +1,15 @@
 import glob
+import hashlib
 import os
 import random
+import threading
 
+import numpy as np
 import tensorflow as tf
 
 from datasets.longitudinal_dataset import LongitudinalDataset
+from datasets.slice_store import SliceStore, decode_images, get_store_dir
+from datasets.tfrecords import get_sequence_dataset, get_tfrecord_dir
 
 
 def get_adni_dataset(
@@ -81,8 +86,26 @@ def get_triplets_adni_15t_dataset(
     channels=1,
     augment=False,
     reduced_dataset=10,
+    decode_once=False,
+    cache_max_bytes=2 * 1024**3,
+    cache_dir=None,
 ):
-    # if reduced_dataset is less then 1.0, that portion of training patients will be used in train data set
+    """
+    Triplet datasets with elements {"imgs": (img1, img2, img3), "days": (day1, day2, day3)}
+
+    If decode_once is True, every slice image is decoded and resized once into an image table
+    (see get_decoded_image_table) and triplets are gathered from it by index, so images shared
+    by many triplets are not decoded again. Values differ from the per-path pipeline only by uint8
+    rounding of resized images. The table of a split is decoded when the split is first iterated.
+    A split whose table is larger than cache_max_bytes uses the per-path pipeline unless cache_dir
+    is given. If decode_once is False, every triplet reads and decodes its images.
+
+    :param reduced_dataset: if less then 1.0, that portion of training patients will be used in train data set
+    :param decode_once: gather triplets from a decoded image table instead of decoding paths
+    :param cache_max_bytes: maximum size of in RAM image table of each split
+    :param cache_dir: if given, tables are kept on disk here
+    :return: train_ds, val_ds, test_ds
+    """
     if machine == "colab":
         data_dir = os.path.join("/content", folder_name)
     elif machine == "cloud":
@@ -101,44 +124,9 @@ def get_triplets_adni_15t_dataset(
     val_long = LongitudinalDataset(data_dir=val_data_dir)
     test_long = LongitudinalDataset(data_dir=test_data_dir)
 
-    train_triplets = (
-        train_long.get_ad_image_triplets()
-        + train_long.get_mci_image_triplets()
-        + train_long.get_cn_image_triplets()
-    )
-    val_triplets = (
-        val_long.get_ad_image_triplets()
-        + val_long.get_mci_image_triplets()
-        + val_long.get_cn_image_triplets()
-    )
-    test_triplets = (
-        test_long.get_ad_image_triplets()
-        + test_long.get_mci_image_triplets()
-        + test_long.get_cn_image_triplets()
-    )
-
-    def triplet_list_to_tfdata_style(triplets):
-        imgs = ([], [], [])
-        days = ([], [], [])
-        for triplet in triplets:
-            triplet_imgs, triplet_days = triplet
-            imgs[0].append(triplet_imgs[0])
-            imgs[1].append(triplet_imgs[1])
-            imgs[2].append(triplet_imgs[2])
-            days[0].append(triplet_days[0])
-            days[1].append(triplet_days[1])
-            days[2].append(triplet_days[2])
-        return {"imgs": imgs, "days": days}
-
-    train_list_ds = tf.data.Dataset.from_tensor_slices(
-        triplet_list_to_tfdata_style(train_triplets)
-    )
-    val_list_ds = tf.data.Dataset.from_tensor_slices(
-        triplet_list_to_tfdata_style(val_triplets)
-    )
-    test_list_ds = tf.data.Dataset.from_tensor_slices(
-        triplet_list_to_tfdata_style(test_triplets)
-    )
+    train_triplets = train_long.get_image_triplets_view()
+    val_triplets = val_long.get_image_triplets_view()
+    test_triplets = test_long.get_image_triplets_view()
 
     def decode_img(img, num_channel=1):
         img = tf.io.decode_png(img, channels=num_channel)
@@ -175,16 +163,65 @@ def get_triplets_adni_15t_dataset(
             "days": tuple(days),
         }
 
-    train_ds = train_list_ds.map(
-        process_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE
-    )
+    def get_dataset(triplets):
+        image_paths = triplets.image_paths()
+        image_indices = triplets.image_indices()
+        days = triplets.days()
+        table_bytes = len(image_paths) * int(
+            np.prod(get_image_shape(image_paths, target_shape, channels))
+        )
+        use_table = decode_once and (
+            cache_dir is not None or table_bytes <= cache_max_bytes
+        )
+        if decode_once and not use_table:
+            print(
+                f"Decoded images need {table_bytes} bytes which is more than "
+                f"cache_max_bytes={cache_max_bytes}, decoding images per triplet"
+            )
+        if not use_table:
+            image_paths = np.array(image_paths)
+            list_ds = tf.data.Dataset.from_tensor_slices(
+                {
+                    "imgs": tuple(
+                        image_paths[image_indices[:, i]].tolist() for i in range(3)
+                    ),
+                    "days": tuple(days[:, i] for i in range(3)),
+                }
+            )
+            return list_ds.map(
+                process_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
+
+        images = LazyImageTable(
+            image_paths,
+            target_shape=target_shape,
+            channels=channels,
+            max_bytes=cache_max_bytes,
+            cache_dir=cache_dir,
+        )
+        gather = get_image_gather_fn(images)
+
+        def gather_triplet(triplet):
+            # one gather for the three images of a triplet
+            imgs = gather(tf.stack(triplet["imgs"]))
+            return {
+                "imgs": tuple(tf.unstack(imgs)),
+                "days": tuple(tf.cast(x, tf.float32) for x in triplet["days"]),
+            }
+
+        list_ds = tf.data.Dataset.from_tensor_slices(
+            {
+                "imgs": tuple(image_indices[:, i] for i in range(3)),
+                "days": tuple(days[:, i] for i in range(3)),
+            }
+        )
+        return list_ds.map(
+            gather_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE
+        )
 
-    val_ds = val_list_ds.map(
-        process_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE
-    )
-    test_ds = test_list_ds.map(
-        process_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE
-    )
+    train_ds = get_dataset(train_triplets)
+    val_ds = get_dataset(val_triplets)
+    test_ds = get_dataset(test_triplets)
 
     return train_ds, val_ds, test_ds
 
@@ -260,3 +297,328 @@ def get_images_adni_15t_dataset(
     )
 
     return train_ds, val_ds, test_ds
+
+
+def get_image_gather_fn(images, in_memory=False):
+    """
+    Returns a tf function that gathers one image from a uint8 image table as float32 in [0, 1) range.
+
+    :param images: uint8 array (memory-mapped array or LazyImageTable) with shape (n_images, height, width, channels)
+    :param in_memory: if True, images are copied into a CPU tensor and gathered in graph,
+    otherwise they are read from the array with numpy
+    :return: gather function, image index (or vector of indices) -> image (or images)
+    """
+    if in_memory:
+        with tf.device("/cpu:0"):
+            images_var = tf.Variable(images, trainable=False)
+
+        def gather(index):
+            img = tf.gather(images_var, index)
+            return tf.cast(img, tf.float32) / 256.0
+
+    else:
+
+        def gather(index):
+            img = tf.numpy_function(lambda i: images[i], [index], tf.uint8)
+            img.set_shape(index.shape.concatenate(images.shape[1:]))
+            return tf.cast(img, tf.float32) / 256.0
+
+    return gather
+
+
+def get_image_shape(image_paths, target_shape=None, channels=1):
+    """
+    Shape of decoded and resized images, the first image is decoded if target_shape is None
+
+    :return: (height, width, channels)
+    """
+    if target_shape:
+        return target_shape[0], target_shape[1], channels
+    if image_paths:
+        return tuple(
+            tf.io.decode_png(tf.io.read_file(image_paths[0]), channels=channels).shape
+        )
+    return 0, 0, channels
+
+
+class LazyImageTable:
+    def __init__(
+        self,
+        image_paths,
+        target_shape=None,
+        channels=1,
+        max_bytes=2 * 1024 ** 3,
+        cache_dir=None,
+    ):
+        """
+        Image table that is decoded with get_decoded_image_table on first access, so tables of
+        splits that are never iterated are not decoded. Indexing returns uint8 images like numpy arrays.
+
+        :param image_paths: list of image paths
+        :param target_shape: [height, width], None for original size
+        :param channels: number of image channels
+        :param max_bytes: maximum size of in RAM table
+        :param cache_dir: folder of on-disk tables
+        """
+        self.image_paths = image_paths
+        self.target_shape = target_shape
+        self.channels = channels
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.shape = (len(image_paths),) + tuple(
+            get_image_shape(image_paths, target_shape, channels)
+        )
+        self.images = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.images is None:
+            with self.lock:
+                if self.images is None:
+                    self.images, _ = get_decoded_image_table(
+                        self.image_paths,
+                        target_shape=self.target_shape,
+                        channels=self.channels,
+                        max_bytes=self.max_bytes,
+                        cache_dir=self.cache_dir,
+                    )
+        return self.images[index]
+
+
+def get_decoded_image_table(
+    image_paths, target_shape=None, channels=1, max_bytes=2 * 1024**3, cache_dir=None
+):
+    """
+    Decodes and resizes each image once into a uint8 table. The table is kept in RAM if it is smaller
+    than max_bytes, otherwise (or if cache_dir is given) it is written to a .npy file in cache_dir
+    and memory-mapped. The cache file is keyed by image paths, target shape and channels
+    and reused by later runs.
+
+    :param image_paths: list of image paths
+    :param target_shape: [height, width], None for original size
+    :param channels: number of image channels
+    :param max_bytes: maximum size of in RAM table
+    :param cache_dir: folder of on-disk tables
+    :return: images, in_memory
+    """
+    image_bytes = int(np.prod(get_image_shape(image_paths, target_shape, channels)))
+    if cache_dir is None and len(image_paths) * image_bytes <= max_bytes:
+        images = decode_images(
+            image_paths, target_shape=target_shape, channels=channels
+        )
+        return images, True
+
+    if cache_dir is None:
+        raise ValueError(
+            f"Decoded images need {len(image_paths) * image_bytes} bytes which is more than "
+            f"max_bytes={max_bytes}, set cache_dir to keep them on disk"
+        )
+    key = hashlib.sha1(
+        "\n".join([str(target_shape), str(channels)] + list(image_paths)).encode()
+    ).hexdigest()
+    cache_path = os.path.join(cache_dir, f"decoded_images_{key}.npy")
+    if not os.path.isfile(cache_path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_cache_path = cache_path[: -len(".npy")] + ".tmp.npy"
+        images = decode_images(
+            image_paths,
+            target_shape=target_shape,
+            channels=channels,
+            out_path=tmp_cache_path,
+        )
+        del images
+        os.replace(tmp_cache_path, cache_path)
+    return np.load(cache_path, mmap_mode="r"), False
+
+
+def get_triplets_adni_15t_dataset_from_store(
+    folder_name="training_data_15T_192x160_4slices",
+    machine="none",
+    target_shape=None,
+    reduced_dataset=10,
+    in_memory=False,
+    store_dir=None,
+):
+    """
+    Same as get_triplets_adni_15t_dataset, but images are gathered from a packed slice store
+    (see datasets/slice_store.py) instead of decoding PNG files.
+    Pack the store once with python -m datasets.slice_store DATA_DIR --height H --width W
+
+    :return: train_ds, val_ds, test_ds
+    """
+    if machine == "colab":
+        data_dir = os.path.join("/content", folder_name)
+    elif machine == "cloud":
+        data_dir = os.path.join("/home/umutkucukaslan/data", folder_name)
+    else:
+        data_dir = os.path.join(
+            "/Users/umutkucukaslan/Desktop/thesis/dataset", folder_name
+        )
+    if store_dir is None:
+        store_dir = get_store_dir(data_dir, target_shape)
+
+    def get_dataset(store, patient_indices=None):
+        image_indices, days = store.combinations(r=3, patient_indices=patient_indices)
+        list_ds = tf.data.Dataset.from_tensor_slices(
+            {
+                "imgs": tuple(image_indices[:, i] for i in range(3)),
+                "days": tuple(days[:, i] for i in range(3)),
+            }
+        )
+        gather = get_image_gather_fn(store.images, in_memory=in_memory)
+
+        def process_triplet(triplet):
+            imgs, days = triplet["imgs"], triplet["days"]
+            return {
+                "imgs": tuple(gather(x) for x in imgs),
+                "days": tuple(tf.cast(x, tf.float32) for x in days),
+            }
+
+        return list_ds.map(
+            process_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE
+        )
+
+    train_store = SliceStore(os.path.join(store_dir, "train"))
+    val_store = SliceStore(os.path.join(store_dir, "val"))
+    test_store = SliceStore(os.path.join(store_dir, "test"))
+
+    train_ds = get_dataset(
+        train_store, train_store.select_patients(reduced_dataset=reduced_dataset)
+    )
+    val_ds = get_dataset(val_store)
+    test_ds = get_dataset(test_store)
+
+    return train_ds, val_ds, test_ds
+
+
+def get_images_adni_15t_dataset_from_store(
+    folder_name="training_data_15T_192x160_4slices",
+    machine="none",
+    target_shape=None,
+    in_memory=False,
+    store_dir=None,
+):
+    """
+    Same as get_images_adni_15t_dataset, but images are gathered from a packed slice store
+    (see datasets/slice_store.py) instead of decoding PNG files.
+
+    :return: train_ds, val_ds, test_ds
+    """
+    if machine == "colab":
+        data_dir = os.path.join("/content", folder_name)
+    elif machine == "cloud":
+        data_dir = os.path.join("/home/umutkucukaslan/data", folder_name)
+    else:
+        data_dir = os.path.join(
+            "/Users/umutkucukaslan/Desktop/thesis/dataset", folder_name
+        )
+    if store_dir is None:
+        store_dir = get_store_dir(data_dir, target_shape)
+
+    def get_dataset(store):
+        list_ds = tf.data.Dataset.from_tensor_slices(store.image_indices())
+        return list_ds.map(
+            get_image_gather_fn(store.images, in_memory=in_memory),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        )
+
+    train_ds = get_dataset(SliceStore(os.path.join(store_dir, "train")))
+    val_ds = get_dataset(SliceStore(os.path.join(store_dir, "val")))
+    test_ds = get_dataset(SliceStore(os.path.join(store_dir, "test")))
+
+    return train_ds, val_ds, test_ds
+
+
+def get_triplets_adni_15t_dataset_from_tfrecords(
+    folder_name="training_data_15T_192x160_4slices",
+    machine="none",
+    target_shape=None,
+    shuffle_shards=True,
+    tfrecord_dir=None,
+):
+    """
+    Same elements as get_triplets_adni_15t_dataset, but read from TFRecord shards exported with
+    python -m datasets.tfrecords DATA_DIR --height H --width W
+    Shards are read in parallel and triplets are expanded from longitudinal slice sequences.
+    If shuffle_shards is True, training shards are read in random, non-deterministic order.
+
+    :return: train_ds, val_ds, test_ds
+    """
+    if machine == "colab":
+        data_dir = os.path.join("/content", folder_name)
+    elif machine == "cloud":
+        data_dir = os.path.join("/home/umutkucukaslan/data", folder_name)
+    else:
+        data_dir = os.path.join(
+            "/Users/umutkucukaslan/Desktop/thesis/dataset", folder_name
+        )
+    if tfrecord_dir is None:
+        tfrecord_dir = get_tfrecord_dir(data_dir, target_shape)
+
+    def sequence_to_triplets(sequence):
+        images = tf.cast(sequence["images"], tf.float32) / 256.0
+        days = tf.cast(sequence["days"], tf.float32)
+        triplets = sequence["triplets"]
+        return tf.data.Dataset.from_tensor_slices(
+            {
+                "imgs": tuple(tf.gather(images, triplets[:, i]) for i in range(3)),
+                "days": tuple(tf.gather(days, triplets[:, i]) for i in range(3)),
+            }
+        )
+
+    def get_dataset(split, shuffle):
+        ds = get_sequence_dataset(
+            os.path.join(tfrecord_dir, split), shuffle_shards=shuffle
+        )
+        return ds.flat_map(sequence_to_triplets)
+
+    train_ds = get_dataset("train", shuffle_shards)
+    val_ds = get_dataset("val", False)
+    test_ds = get_dataset("test", False)
+
+    return train_ds, val_ds, test_ds
+
+
+def get_images_adni_15t_dataset_from_tfrecords(
+    folder_name="training_data_15T_192x160_4slices",
+    machine="none",
+    target_shape=None,
+    shuffle_shards=True,
+    tfrecord_dir=None,
+):
+    """
+    Same elements as get_images_adni_15t_dataset, but read from TFRecord shards,
+    see get_triplets_adni_15t_dataset_from_tfrecords
+
+    :return: train_ds, val_ds, test_ds
+    """
+    if machine == "colab":
+        data_dir = os.path.join("/content", folder_name)
+    elif machine == "cloud":
+        data_dir = os.path.join("/home/umutkucukaslan/data", folder_name)
+    else:
+        data_dir = os.path.join(
+            "/Users/umutkucukaslan/Desktop/thesis/dataset", folder_name
+        )
+    if tfrecord_dir is None:
+        tfrecord_dir = get_tfrecord_dir(data_dir, target_shape)
+
+    def sequence_to_images(sequence):
+        images = tf.cast(sequence["images"], tf.float32) / 256.0
+        return tf.data.Dataset.from_tensor_slices(images)
+
+    def get_dataset(split, shuffle):
+        ds = get_sequence_dataset(
+            os.path.join(tfrecord_dir, split), shuffle_shards=shuffle
+        )
+        return ds.flat_map(sequence_to_images)
+
+    train_ds = get_dataset("train", shuffle_shards)
+    val_ds = get_dataset("val", False)
+    test_ds = get_dataset("test", False)
+
+    return train_ds, val_ds, test_ds
@@ -1,43 +1,385 @@
+import bisect
+import functools
+import itertools
+import json
 import random
 from datetime import datetime
 import glob
 import os
 from random import randint
 
+import numpy as np
+
+from datasets.split_manifest import SPLIT_MANIFEST_NAME, read_split_manifest
+
+INDEX_FILE_NAME = ".longitudinal_index.json"
+INDEX_VERSION = 1
+
+
+def scan_patient_folder(patient_folder_path, patient_name=None):
+    """
+    Scans a patient folder and returns its index entry. Slice paths are stored relative to scan folders
+    so that the index stays valid if the dataset tree is moved.
+
+    :param patient_folder_path: path to patient folder containing one folder per scan date
+    :param patient_name: name with class prefix, e.g. ad_002_S_0001, defaults to folder name
+    :return: dict with mtimes, scan dates, relative days, slice names and patient class
+    """
+    if patient_name is None:
+        patient_name = os.path.basename(patient_folder_path)
+    scan_folders = sorted(glob.glob(os.path.join(patient_folder_path, "*")))
+    dates_str = [os.path.basename(x) for x in scan_folders]
+    dates = [datetime.strptime(x, "%Y-%m-%d_%H_%M_%S") for x in dates_str]
+    slice_names = [
+        [
+            os.path.basename(x)
+            for x in sorted(glob.glob(os.path.join(scan_folder, "*slice_*.png")))
+        ]
+        for scan_folder in scan_folders
+    ]
+    return {
+        "mtime": os.stat(patient_folder_path).st_mtime_ns,
+        "scan_mtimes": [os.stat(x).st_mtime_ns for x in scan_folders],
+        "patient_class": patient_name.split("_")[0],
+        "dates_str": dates_str,
+        "relative_dates": [(x - dates[0]).days for x in dates],
+        "slice_names": slice_names,
+    }
+
+
+class LongitudinalIndex:
+    """
+    On-disk index of a longitudinal data folder (patients, scan dates, relative days, slice paths, class).
+    Entries are validated against patient and scan folder mtimes, and only changed patient folders are rescanned.
+    """
+
+    def __init__(self, data_dir, index_path=None):
+        self.data_dir = data_dir
+        self.index_path = (
+            index_path if index_path else os.path.join(data_dir, INDEX_FILE_NAME)
+        )
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+        except (OSError, ValueError):
+            return
+        if index.get("version") == INDEX_VERSION:
+            self.entries = index["patients"]
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as index_file:
+                json.dump(
+                    {"version": INDEX_VERSION, "patients": self.entries},
+                    index_file,
+                    separators=(",", ":"),
+                )
+            os.replace(tmp_path, self.index_path)
+            self.dirty = False
+        except OSError as e:
+            print(f"Could not write longitudinal index {self.index_path}: {e}")
+
+    def is_valid(self, patient_folder_path, entry):
+        try:
+            if os.stat(patient_folder_path).st_mtime_ns != entry["mtime"]:
+                return False
+            scan_mtimes = [
+                os.stat(os.path.join(patient_folder_path, x)).st_mtime_ns
+                for x in entry["dates_str"]
+            ]
+        except OSError:
+            return False
+        return scan_mtimes == entry["scan_mtimes"]
+
+    def get(self, patient_folder_path, patient_name=None):
+        """
+        Returns index entry for the patient folder, rescanning the folder if the entry is missing or stale.
+
+        :param patient_folder_path:
+        :param patient_name: key of the entry, defaults to folder name
+        :return: index entry
+        """
+        if patient_name is None:
+            patient_name = os.path.basename(patient_folder_path)
+        entry = self.entries.get(patient_name)
+        if entry is None or not self.is_valid(patient_folder_path, entry):
+            entry = scan_patient_folder(patient_folder_path, patient_name=patient_name)
+            self.entries[patient_name] = entry
+            self.dirty = True
+        return entry
+
+    def prune(self, patient_names):
+        """
+        Removes entries of patients that are not in patient_names anymore.
+
+        :param patient_names: names of patient folders currently in data_dir
+        """
+        for patient_name in set(self.entries) - set(patient_names):
+            del self.entries[patient_name]
+            self.dirty = True
+
+
+@functools.lru_cache(maxsize=None)
+def combination_table(n, r):
+    """
+    Read-only array of all increasing r-combinations of range(n) in lexicographic order.
+    Tables are shared between all patients with the same number of scans.
+
+    :param n: number of scans
+    :param r: combination size, 2 for pairs and 3 for triplets
+    :return: int32 array with shape (n choose r, r)
+    """
+    table = np.array(list(itertools.combinations(range(n), r)), dtype=np.int32).reshape(
+        -1, r
+    )
+    table.setflags(write=False)
+    return table
+
+
+class ScanCombinations:
+    """
+    Indexable view over scan index combinations (pairs or triplets) of a patient.
+    Supports len, integer indexing, iteration and constant time membership check.
+    """
+
+    def __init__(self, n_scans, r):
+        self.n_scans = n_scans
+        self.r = r
+        self.table = combination_table(n_scans, r)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        return tuple(int(x) for x in self.table[index])
+
+    def __iter__(self):
+        for combination in self.table:
+            yield tuple(int(x) for x in combination)
+
+    def __contains__(self, combination):
+        if len(combination) != self.r:
+            return False
+        return all(0 <= x < self.n_scans for x in combination) and all(
+            x < y for x, y in zip(combination[:-1], combination[1:])
+        )
+
+
+class ImageCombinations:
+    """
+    Lazy indexable view over (slice, scan combination) samples of one or more patients.
+    Items are ordered patient by patient, slice by slice, then combination by combination, which is the order
+    of Patient.get_all_image_pairs / get_all_image_triplets. Nothing is materialized per sample; random access,
+    sampling and index arrays are computed from per-patient offsets and shared combination tables.
+    """
+
+    def __init__(self, patients, r, slice_index=None):
+        """
+
+        :param patients: list of Patient objects
+        :param r: 2 for image pairs, 3 for image triplets
+        :param slice_index: if not None, only this slice of each patient is used
+        """
+        self.patients = patients
+        self.r = r
+        self.slice_index = slice_index
+        self.n_scans = np.array([p.n_scans for p in patients], dtype=np.int64)
+        self.n_slices = np.array(
+            [1 if slice_index is not None else p.n_slices for p in patients],
+            dtype=np.int64,
+        )
+        self.n_combinations = np.array(
+            [len(combination_table(p.n_scans, r)) for p in patients], dtype=np.int64
+        )
+        lengths = self.n_slices * self.n_combinations
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # offsets of patients in flat image list (see image_paths) and flat days list (see days)
+        self.image_offsets = np.concatenate(
+            [[0], np.cumsum([p.n_slices * p.n_scans for p in patients])]
+        ).astype(np.int64)
+        self.day_offsets = np.concatenate([[0], np.cumsum(self.n_scans)]).astype(
+            np.int64
+        )
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ImageCombinations index out of range")
+        patient_index = bisect.bisect_right(self.offsets, index) - 1
+        patient = self.patients[patient_index]
+        slice_index, combination_index = divmod(
+            index - int(self.offsets[patient_index]),
+            int(self.n_combinations[patient_index]),
+        )
+        if self.slice_index is not None:
+            slice_index = self.slice_index
+        combination = tuple(
+            int(x)
+            for x in combination_table(patient.n_scans, self.r)[combination_index]
+        )
+        return self._get_item(patient, slice_index, combination)
+
+    def __iter__(self):
+        for patient in self.patients:
+            slice_indices = (
+                range(patient.n_slices)
+                if self.slice_index is None
+                else [self.slice_index]
+            )
+            combinations = ScanCombinations(patient.n_scans, self.r)
+            for slice_index in slice_indices:
+                for combination in combinations:
+                    yield self._get_item(patient, slice_index, combination)
+
+    def _get_item(self, patient, slice_index, combination):
+        if self.r == 2:
+            return patient.get_image_pair(slice_index, combination)
+        return patient.get_image_triplet(slice_index, combination)
+
+    def locate(self, indices):
+        """
+        Vectorized mapping of view indices to patient, slice and scan indices.
+
+        :param indices: int array of view indices
+        :return: patient_indices (N,), slice_indices (N,), scan_indices (N, r)
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        patient_indices = np.searchsorted(self.offsets, indices, side="right") - 1
+        local = indices - self.offsets[patient_indices]
+        n_combinations = self.n_combinations[patient_indices]
+        slice_indices = local // n_combinations
+        combination_indices = local % n_combinations
+        if self.slice_index is not None:
+            slice_indices = np.full_like(slice_indices, self.slice_index)
+
+        scan_indices = np.empty((len(indices), self.r), dtype=np.int64)
+        n_scans = self.n_scans[patient_indices]
+        for n in np.unique(n_scans):
+            mask = n_scans == n
+            scan_indices[mask] = combination_table(int(n), self.r)[
+                combination_indices[mask]
+            ]
+        return patient_indices, slice_indices, scan_indices
+
+    def index_arrays(self):
+        """
+        Returns patient, slice and scan indices of all items
+
+        :return: patient_indices (N,), slice_indices (N,), scan_indices (N, r)
+        """
+        return self.locate(np.arange(len(self)))
+
+    def sample(self, size, rng=None):
+        """
+        Uniformly samples items with replacement and returns their indices
+
+        :param size: number of samples
+        :param rng: numpy Generator, default generator is used if None
+        :return: patient_indices (size,), slice_indices (size,), scan_indices (size, r)
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        return self.locate(rng.integers(0, len(self), size=size))
+
+    def image_paths(self):
+        """
+        Flat list of image paths of all patients, patient by patient in Patient.get_all_images order.
+        Use image_indices to index this list.
+
+        :return: list of image paths
+        """
+        paths = []
+        for patient in self.patients:
+            paths += patient.get_all_images()
+        return paths
+
+    def image_indices(self, indices=None):
+        """
+        Indices of images of items in the flat image list returned by image_paths
+
+        :param indices: view indices, all items if None
+        :return: int array with shape (N, r)
+        """
+        if indices is None:
+            patient_indices, slice_indices, scan_indices = self.index_arrays()
+        else:
+            patient_indices, slice_indices, scan_indices = self.locate(indices)
+        return (
+            self.image_offsets[patient_indices, None]
+            + slice_indices[:, None] * self.n_scans[patient_indices, None]
+            + scan_indices
+        )
+
+    def days(self, indices=None):
+        """
+        Days of scans of items relative to first scan of the patient
+
+        :param indices: view indices, all items if None
+        :return: int array with shape (N, r)
+        """
+        if indices is None:
+            patient_indices, _, scan_indices = self.index_arrays()
+        else:
+            patient_indices, _, scan_indices = self.locate(indices)
+        flat_days = np.array(
+            [d for patient in self.patients for d in patient.relative_dates],
+            dtype=np.int64,
+        )
+        return flat_days[self.day_offsets[patient_indices, None] + scan_indices]
+
 
 class Patient:
-    def __init__(self, patient_folder_path, patient_type=None):
+    def __init__(
+        self, patient_folder_path, patient_type=None, index=None, patient_name=None
+    ):
+        """
+
+        :param patient_folder_path:
+        :param patient_type:
+        :param index: LongitudinalIndex to read folder structure from. If None, patient folder is scanned.
+        :param patient_name: name with class prefix, e.g. ad_002_S_0001, defaults to folder name
+        """
         self.patient_type = patient_type
         self.folder_path = patient_folder_path
-        self.patient_name = os.path.basename(patient_folder_path)
-        self.scan_folders = sorted(glob.glob(os.path.join(patient_folder_path, "*")))
-
-        self.dates_str = [
-            os.path.basename(x) for x in self.scan_folders
-        ]  # dates of scans in str format
-        dates = [datetime.strptime(x, "%Y-%m-%d_%H_%M_%S") for x in self.dates_str]
-        relative_dates = [x - dates[0] for x in dates]
-        self.relative_dates = [
-            x.days for x in relative_dates
+        self.patient_name = (
+            patient_name if patient_name else os.path.basename(patient_folder_path)
+        )
+        if index is None:
+            entry = scan_patient_folder(patient_folder_path, self.patient_name)
+        else:
+            entry = index.get(patient_folder_path, self.patient_name)
+
+        self.dates_str = entry["dates_str"]  # dates of scans in str format
+        self.scan_folders = [
+            os.path.join(patient_folder_path, x) for x in self.dates_str
+        ]
+        self.relative_dates = entry[
+            "relative_dates"
         ]  # scan ages in days relative to first scan
 
         images = []
-        for scan_folder in self.scan_folders:
-            slice_paths = sorted(glob.glob(os.path.join(scan_folder, "*slice_*.png")))
-            images.append(slice_paths)
+        for scan_folder, slice_names in zip(self.scan_folders, entry["slice_names"]):
+            images.append([os.path.join(scan_folder, x) for x in slice_names])
 
         self.images = list(zip(*images))
         self.n_slices = len(self.images)
-        self.n_scans = len(dates)
-        self.scan_pairs = [
-            (i, j) for i in range(self.n_scans) for j in range(i + 1, self.n_scans)
-        ]
-        self.scan_triplets = [
-            (i, j, k)
-            for i in range(self.n_scans)
-            for j in range(i + 1, self.n_scans)
-            for k in range(j + 1, self.n_scans)
-        ]
+        self.n_scans = len(self.dates_str)
+        self.scan_pairs = ScanCombinations(self.n_scans, 2)
+        self.scan_triplets = ScanCombinations(self.n_scans, 3)
 
     def get_image(self, slice_index=None, scan_index=None):
         """
@@ -97,7 +439,7 @@ class Patient:
         if slice_index is None:
             slice_index = randint(0, self.n_slices - 1)
         if scan_pair is None:
-            scan_pair = self.scan_pairs[randint(0, len(self.scan_pairs))]
+            scan_pair = self.scan_pairs[randint(0, len(self.scan_pairs) - 1)]
 
         assert slice_index < self.n_slices
         assert scan_pair in self.scan_pairs
@@ -116,12 +458,16 @@ class Patient:
 
         :return:
         """
-        all_image_pairs = []
-        for slice_index in range(self.n_slices):
-            for scan_pair in self.scan_pairs:
-                all_image_pairs.append(self.get_image_pair(slice_index, scan_pair))
+        return list(self.get_image_pairs_view())
 
-        return all_image_pairs
+    def get_image_pairs_view(self, slice_index=None):
+        """
+        Returns lazy view over all image pairs, see ImageCombinations
+
+        :param slice_index: if not None, only pairs of this slice are used
+        :return: ImageCombinations
+        """
+        return ImageCombinations([self], r=2, slice_index=slice_index)
 
     def get_image_pair_generator(self, repeat=False):
         """
@@ -149,7 +495,7 @@ class Patient:
         if slice_index is None:
             slice_index = randint(0, self.n_slices - 1)
         if scan_triplet is None:
-            scan_triplet = self.scan_triplets[randint(0, len(self.scan_triplets))]
+            scan_triplet = self.scan_triplets[randint(0, len(self.scan_triplets) - 1)]
 
         assert slice_index < self.n_slices
         assert scan_triplet in self.scan_triplets
@@ -173,19 +519,16 @@ class Patient:
 
         :return:
         """
-        all_image_triplets = []
-        if slice_index is None:
-            for slice_index in range(self.n_slices):
-                for scan_triplet in self.scan_triplets:
-                    all_image_triplets.append(
-                        self.get_image_triplet(slice_index, scan_triplet)
-                    )
-        else:
-            for scan_triplet in self.scan_triplets:
-                all_image_triplets.append(
-                    self.get_image_triplet(slice_index, scan_triplet)
-                )
-        return all_image_triplets
+        return list(self.get_image_triplets_view(slice_index=slice_index))
+
+    def get_image_triplets_view(self, slice_index=None):
+        """
+        Returns lazy view over all image triplets, see ImageCombinations
+
+        :param slice_index: if not None, only triplets of this slice are used
+        :return: ImageCombinations
+        """
+        return ImageCombinations([self], r=3, slice_index=slice_index)
 
     def get_image_triplet_generator(self, repeat=False):
         """
@@ -226,18 +569,56 @@ class Patient:
 
 
 class LongitudinalDataset:
-    def __init__(self, data_dir, reduced_dataset=5.0):
+    def __init__(
+        self,
+        data_dir,
+        reduced_dataset=5.0,
+        use_index=True,
+        index_path=None,
+        split=None,
+        split_manifest=None,
+    ):
         """
 
         :param data_dir:
         :param reduced_dataset: If less than 1.0, that ratio of patients will be used seperately
         for AD, MCI, CN
+        :param use_index: If True, folder structure is read from an on-disk LongitudinalIndex which is
+        created on first use and updated only for changed patient folders
+        :param index_path: path of the index file, defaults to data_dir/.longitudinal_index.json
+        :param split: If given, e.g. "train", patients of this split are read from the split manifest instead of
+        ad_*, mci_* and cn_* folders in data_dir, so split folders do not have to exist
+        :param split_manifest: path of the split manifest, defaults to data_dir/split_manifest.csv. See
+        datasets.split_manifest
         """
         self.data_dir = data_dir
+        if split is not None and index_path is None:
+            index_path = os.path.join(
+                data_dir, os.path.splitext(INDEX_FILE_NAME)[0] + f"_{split}.json"
+            )
+        self.index = (
+            LongitudinalIndex(data_dir, index_path=index_path) if use_index else None
+        )
 
-        ad_patient_folder_paths = glob.glob(os.path.join(self.data_dir, "ad_*"))
-        mci_patient_folder_paths = glob.glob(os.path.join(self.data_dir, "mci_*"))
-        cn_patient_folder_paths = glob.glob(os.path.join(self.data_dir, "cn_*"))
+        # patient names of folders that are not named with class prefix, i.e. manifest sources
+        patient_names = {}
+        if split is None:
+            ad_patient_folder_paths = glob.glob(os.path.join(self.data_dir, "ad_*"))
+            mci_patient_folder_paths = glob.glob(os.path.join(self.data_dir, "mci_*"))
+            cn_patient_folder_paths = glob.glob(os.path.join(self.data_dir, "cn_*"))
+        else:
+            if split_manifest is None:
+                split_manifest = os.path.join(data_dir, SPLIT_MANIFEST_NAME)
+            manifest_rows = read_split_manifest(split_manifest, split=split)
+            patient_names = {row["source"]: row["patient"] for row in manifest_rows}
+            (
+                ad_patient_folder_paths,
+                mci_patient_folder_paths,
+                cn_patient_folder_paths,
+            ) = [
+                [row["source"] for row in manifest_rows if row["patient_type"] == x]
+                for x in ["ad", "mci", "cn"]
+            ]
 
         if reduced_dataset < 1.0:
             print("REDUCED TRAIN SET")
@@ -263,17 +644,43 @@ class LongitudinalDataset:
             cn_patient_folder_paths = ad_patient_folder_paths[:cn_index]
 
         self.ad_patients = [
-            Patient(patient_folder_path=x, patient_type="ad")
+            Patient(
+                patient_folder_path=x,
+                patient_type="ad",
+                index=self.index,
+                patient_name=patient_names.get(x),
+            )
             for x in ad_patient_folder_paths
         ]
         self.mci_patients = [
-            Patient(patient_folder_path=x, patient_type="ad")
+            Patient(
+                patient_folder_path=x,
+                patient_type="ad",
+                index=self.index,
+                patient_name=patient_names.get(x),
+            )
             for x in mci_patient_folder_paths
         ]
         self.cn_patients = [
-            Patient(patient_folder_path=x, patient_type="ad")
+            Patient(
+                patient_folder_path=x,
+                patient_type="ad",
+                index=self.index,
+                patient_name=patient_names.get(x),
+            )
             for x in cn_patient_folder_paths
         ]
+        if self.index is not None:
+            if reduced_dataset >= 1.0:
+                self.index.prune(
+                    [
+                        patient_names.get(x, os.path.basename(x))
+                        for x in ad_patient_folder_paths
+                        + mci_patient_folder_paths
+                        + cn_patient_folder_paths
+                    ]
+                )
+            self.index.save()
 
     def get_image(self, patient_type=None, slice_index=None, scan_index=None):
         if patient_type is None:
@@ -329,28 +736,47 @@ class LongitudinalDataset:
         return all_image_pairs
 
     def get_ad_image_triplets(self, slice_index=None):
-        all_image_triplets = []
-        for patient in self.ad_patients:
-            all_image_triplets += patient.get_all_image_triplets(
-                slice_index=slice_index
-            )
-        return all_image_triplets
+        return list(self.get_image_triplets_view(["ad"], slice_index=slice_index))
 
     def get_mci_image_triplets(self, slice_index=None):
-        all_image_triplets = []
-        for patient in self.mci_patients:
-            all_image_triplets += patient.get_all_image_triplets(
-                slice_index=slice_index
-            )
-        return all_image_triplets
+        return list(self.get_image_triplets_view(["mci"], slice_index=slice_index))
 
     def get_cn_image_triplets(self, slice_index=None):
-        all_image_triplets = []
-        for patient in self.cn_patients:
-            all_image_triplets += patient.get_all_image_triplets(
-                slice_index=slice_index
-            )
-        return all_image_triplets
+        return list(self.get_image_triplets_view(["cn"], slice_index=slice_index))
+
+    def get_patients(self, patient_types=("ad", "mci", "cn")):
+        patients = {
+            "ad": self.ad_patients,
+            "mci": self.mci_patients,
+            "cn": self.cn_patients,
+        }
+        return [patient for x in patient_types for patient in patients[x]]
+
+    def get_image_pairs_view(self, patient_types=("ad", "mci", "cn"), slice_index=None):
+        """
+        Returns lazy view over image pairs of the given patient types, in the given type order
+
+        :param patient_types: subset of ("ad", "mci", "cn")
+        :param slice_index: if not None, only pairs of this slice are used
+        :return: ImageCombinations
+        """
+        return ImageCombinations(
+            self.get_patients(patient_types), r=2, slice_index=slice_index
+        )
+
+    def get_image_triplets_view(
+        self, patient_types=("ad", "mci", "cn"), slice_index=None
+    ):
+        """
+        Returns lazy view over image triplets of the given patient types, in the given type order
+
+        :param patient_types: subset of ("ad", "mci", "cn")
+        :param slice_index: if not None, only triplets of this slice are used
+        :return: ImageCombinations
+        """
+        return ImageCombinations(
+            self.get_patients(patient_types), r=3, slice_index=slice_index
+        )
 
     def get_ad_longitudinal_sequences(self):
         all_sequences = []
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from datasets.longitudinal_dataset import LongitudinalDataset, combination_table
+
+STORE_FOLDER_NAME = "slice_store"
+STORE_VERSION = 1
+
+
+def get_store_dir(data_dir, target_shape=None):
+    """
+    Default location of packed slice store of a dataset folder with train, val and test splits.
+
+    :param data_dir: dataset folder, e.g. .../training_data_15T_192x160_4slices
+    :param target_shape: [height, width] of stored slices, None for original size
+    :return: store folder path
+    """
+    shape_name = f"{target_shape[0]}x{target_shape[1]}" if target_shape else "original"
+    return os.path.join(data_dir, STORE_FOLDER_NAME, shape_name)
+
+
+def decode_images(
+    image_paths, target_shape=None, channels=1, out_path=None, batch_size=256
+):
+    """
+    Decodes and resizes PNG images into a single uint8 array.
+    Resizing is done with tf.image.resize like the path based loaders, then rounded to uint8.
+
+    :param image_paths: list of PNG paths, all images must have the same shape after resizing
+    :param target_shape: [height, width], None to keep original size
+    :param channels: number of image channels
+    :param out_path: if given, images are written to this .npy file and a memory-mapped array is returned
+    :param batch_size: number of images decoded at once
+    :return: uint8 array with shape (len(image_paths), height, width, channels)
+    """
+
+    def process_path(file_path):
+        img = tf.io.decode_png(tf.io.read_file(file_path), channels=channels)
+        if target_shape:
+            img = tf.image.resize(tf.cast(img, tf.float32), target_shape)
+            img = tf.cast(tf.clip_by_value(tf.round(img), 0, 255), tf.uint8)
+        return img
+
+    ds = (
+        tf.data.Dataset.from_tensor_slices(image_paths)
+        .map(process_path, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        .batch(batch_size)
+        .prefetch(tf.data.experimental.AUTOTUNE)
+    )
+    images = None
+    position = 0
+    for batch in ds:
+        batch = batch.numpy()
+        if images is None:
+            shape = (len(image_paths),) + batch.shape[1:]
+            if out_path:
+                images = np.lib.format.open_memmap(
+                    out_path, mode="w+", dtype=np.uint8, shape=shape
+                )
+            else:
+                images = np.empty(shape, dtype=np.uint8)
+        images[position : position + len(batch)] = batch
+        position += len(batch)
+    if images is None:
+        shape = tuple(target_shape) if target_shape else (0, 0)
+        images = np.zeros((0,) + shape + (channels,), dtype=np.uint8)
+    elif out_path:
+        images.flush()
+    return images
+
+
+def pack_slices(
+    split_dir, store_split_dir, target_shape=None, channels=1, batch_size=256
+):
+    """
+    Decodes, resizes and packs all slice images of a split folder into a single uint8 array file
+    (images.npy) with an index (index.json) of patient, scan, slice and day metadata.
+    Images are ordered patient by patient (AD, MCI, CN), slice by slice, scan by scan,
+    which is the order of LongitudinalDataset image lists.
+
+    :param split_dir: folder with ad_*, mci_*, cn_* patient folders
+    :param store_split_dir: output folder
+    :param target_shape: [height, width], None to keep original size
+    :param channels: number of image channels
+    :param batch_size: number of images decoded at once
+    :return: path of images.npy
+    """
+    longitudinal_dataset = LongitudinalDataset(data_dir=split_dir)
+    patients = longitudinal_dataset.get_patients()
+    image_paths = []
+    patient_records = []
+    for patient in patients:
+        patient_records.append(
+            {
+                "name": patient.patient_name,
+                "patient_class": patient.patient_name.split("_")[0],
+                "dates_str": patient.dates_str,
+                "relative_dates": patient.relative_dates,
+                "n_slices": patient.n_slices,
+                "n_scans": patient.n_scans,
+                "image_offset": len(image_paths),
+            }
+        )
+        image_paths += patient.get_all_images()
+
+    if not os.path.isdir(store_split_dir):
+        os.makedirs(store_split_dir)
+    images_path = os.path.join(store_split_dir, "images.npy")
+    tmp_images_path = os.path.join(store_split_dir, "images.tmp.npy")
+
+    if not image_paths:
+        raise ValueError(f"No slice images found in {split_dir}")
+    images = decode_images(
+        image_paths,
+        target_shape=target_shape,
+        channels=channels,
+        out_path=tmp_images_path,
+        batch_size=batch_size,
+    )
+    shape = list(images.shape[1:])
+    del images
+    os.replace(tmp_images_path, images_path)
+
+    with open(os.path.join(store_split_dir, "index.json"), "w") as index_file:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "shape": shape,
+                "n_images": len(image_paths),
+                "patients": patient_records,
+            },
+            index_file,
+        )
+    return images_path
+
+
+def pack_dataset(data_dir, target_shape=None, channels=1, store_dir=None):
+    """
+    Packs train, val and test splits of a dataset folder, see pack_slices
+
+    :param data_dir: dataset folder with train, val, test split folders
+    :param target_shape: [height, width], None to keep original size
+    :param channels: number of image channels
+    :param store_dir: output folder, defaults to get_store_dir(data_dir, target_shape)
+    :return: store_dir
+    """
+    if store_dir is None:
+        store_dir = get_store_dir(data_dir, target_shape)
+    for split in ["train", "val", "test"]:
+        print(f"packing {split} split...")
+        pack_slices(
+            os.path.join(data_dir, split),
+            os.path.join(store_dir, split),
+            target_shape=target_shape,
+            channels=channels,
+        )
+    return store_dir
+
+
+class SliceStore:
+    """
+    Read access to a packed split folder created by pack_slices. Images are memory-mapped,
+    so selecting and gathering images does not decode or copy the whole array.
+    """
+
+    def __init__(self, store_split_dir, in_memory=False):
+        """
+
+        :param store_split_dir: folder with images.npy and index.json
+        :param in_memory: if True, images are read into RAM instead of being memory-mapped
+        """
+        with open(os.path.join(store_split_dir, "index.json")) as index_file:
+            index = json.load(index_file)
+        if index.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported slice store version in {store_split_dir}")
+        self.store_split_dir = store_split_dir
+        self.shape = tuple(index["shape"])
+        self.patients = index["patients"]
+        self.images = np.load(
+            os.path.join(store_split_dir, "images.npy"),
+            mmap_mode=None if in_memory else "r",
+        )
+
+    def __len__(self):
+        return len(self.images)
+
+    def select_patients(self, reduced_dataset=None):
+        """
+        Returns indices of patients to use. If reduced_dataset is less than 1.0, that ratio of
+        patients is randomly selected separately for AD, MCI and CN.
+
+        :param reduced_dataset: ratio of patients to keep
+        :return: list of patient indices
+        """
+        if reduced_dataset is None or reduced_dataset >= 1.0:
+            return list(range(len(self.patients)))
+        selected = []
+        for patient_class in ["ad", "mci", "cn"]:
+            indices = [
+                i
+                for i, x in enumerate(self.patients)
+                if x["patient_class"] == patient_class
+            ]
+            if not indices:
+                continue
+            n_keep = max(1, int(len(indices) * reduced_dataset))
+            selected += sorted(np.random.permutation(indices)[:n_keep].tolist())
+        return selected
+
+    def image_indices(self, patient_indices=None):
+        """
+        Indices of all images of the given patients
+
+        :param patient_indices: None for all patients
+        :return: int64 array
+        """
+        if patient_indices is None:
+            return np.arange(len(self), dtype=np.int64)
+        ranges = []
+        for i in patient_indices:
+            patient = self.patients[i]
+            n_images = patient["n_slices"] * patient["n_scans"]
+            ranges.append(
+                np.arange(
+                    patient["image_offset"],
+                    patient["image_offset"] + n_images,
+                    dtype=np.int64,
+                )
+            )
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+    def combinations(self, r=3, patient_indices=None, slice_index=None):
+        """
+        Image indices and days of all scan combinations (pairs or triplets) of the given patients,
+        in the order of LongitudinalDataset triplet lists.
+
+        :param r: 2 for pairs, 3 for triplets
+        :param patient_indices: None for all patients
+        :param slice_index: if not None, only combinations of this slice are returned
+        :return: image indices (N, r), days (N, r)
+        """
+        if patient_indices is None:
+            patient_indices = range(len(self.patients))
+        image_indices = []
+        days = []
+        for i in patient_indices:
+            patient = self.patients[i]
+            n_scans = patient["n_scans"]
+            table = combination_table(n_scans, r)
+            slices = (
+                np.arange(patient["n_slices"])
+                if slice_index is None
+                else np.array([slice_index])
+            )
+            image_indices.append(
+                (
+                    patient["image_offset"]
+                    + slices[:, None, None] * n_scans
+                    + table[None, :, :]
+                ).reshape(-1, r)
+            )
+            patient_days = np.array(patient["relative_dates"], dtype=np.int64)
+            days.append(np.tile(patient_days[table], (len(slices), 1)))
+        if not image_indices:
+            return np.zeros((0, r), dtype=np.int64), np.zeros((0, r), dtype=np.int64)
+        return (
+            np.concatenate(image_indices).astype(np.int64),
+            np.concatenate(days),
+        )
+
+    def gather(self, indices):
+        """
+        Gathers images from the store
+
+        :param indices: int array
+        :return: uint8 array with shape (len(indices),) + self.shape
+        """
+        return self.images[np.asarray(indices)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack slice images into a store")
+    parser.add_argument(
+        "data_dir", type=str, help="Dataset folder with train, val, test splits"
+    )
+    parser.add_argument("--height", default=None, type=int, help="target height")
+    parser.add_argument("--width", default=None, type=int, help="target width")
+    parser.add_argument("--channels", default=1, type=int, help="image channels")
+    parser.add_argument("--store_dir", default=None, type=str, help="output folder")
+    args = parser.parse_args()
+
+    target_shape = [args.height, args.width] if args.height and args.width else None
+    store_dir = pack_dataset(
+        args.data_dir,
+        target_shape=target_shape,
+        channels=args.channels,
+        store_dir=args.store_dir,
+    )
+    print(f"slice store written to {store_dir}")
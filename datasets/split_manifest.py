@@ -0,0 +1,145 @@
+import csv
+import os
+import shutil
+
+"""
+A split manifest lists the split of every patient folder of a processed dataset, so that a new split is a small
+csv file instead of a copy of all slice images. Patient names carry the ad/mci/cn prefix of the split folders,
+source paths are stored relative to the manifest. LongitudinalDataset reads a split directly from the manifest,
+and materialize_split creates the usual train/val/test folders with hard links or symlinks when they are needed.
+"""
+
+SPLIT_MANIFEST_NAME = "split_manifest.csv"
+SPLIT_MANIFEST_COLUMNS = ["patient", "split", "patient_type", "change", "source"]
+SPLITS = ["train", "val", "test"]
+MATERIALIZE_MODES = ["copy", "hardlink", "symlink"]
+PATIENT_TYPES = ["ad", "mci", "cn"]
+
+
+def get_patient_name(source_patient_folder):
+    """
+    Split folder name of a patient folder of a processed dataset, e.g. .../AD/002_S_0001 -> ad_002_S_0001
+
+    :param source_patient_folder: patient folder inside AD, MCI or CN folder
+    :return: patient name with class prefix
+    """
+    patient_type = os.path.basename(os.path.dirname(source_patient_folder)).lower()
+    return patient_type + "_" + os.path.basename(source_patient_folder)
+
+
+def write_split_manifest(manifest_path, splits, changes=None):
+    """
+    Writes split manifest of patient folders
+
+    :param manifest_path: csv file path
+    :param splits: dict of split name to list of source patient folders, e.g. {"train": [...], "val": [...]}
+    :param changes: optional dict of source patient folder to change category used for stratification
+    :return: list of manifest rows
+    """
+    changes = changes or {}
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    rows = []
+    for split, source_folders in splits.items():
+        for source_folder in source_folders:
+            patient_name = get_patient_name(source_folder)
+            rows.append(
+                {
+                    "patient": patient_name,
+                    "split": split,
+                    "patient_type": patient_name.split("_")[0],
+                    "change": changes.get(source_folder, ""),
+                    "source": os.path.relpath(
+                        os.path.abspath(source_folder), manifest_dir
+                    ),
+                }
+            )
+    os.makedirs(manifest_dir, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", newline="") as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=SPLIT_MANIFEST_COLUMNS)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    os.replace(tmp_path, manifest_path)
+    return rows
+
+
+def read_split_manifest(manifest_path, split=None):
+    """
+    Reads split manifest rows, with source paths resolved relative to the manifest
+
+    :param manifest_path: csv file path
+    :param split: if given, only rows of this split are returned
+    :return: list of row dicts, see SPLIT_MANIFEST_COLUMNS
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline="") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    for row in rows:
+        row["source"] = os.path.normpath(os.path.join(manifest_dir, row["source"]))
+    if split is not None:
+        rows = [row for row in rows if row["split"] == split]
+    return rows
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. target on another file system
+        shutil.copy2(src, dst)
+
+
+def _remove_patient_folder(path):
+    if os.path.islink(path):
+        os.unlink(path)
+    else:
+        shutil.rmtree(path)
+
+
+def materialize_split(manifest_path, target_dir=None, mode="hardlink"):
+    """
+    Creates split folders of a manifest, target_dir/<split>/<patient>. Existing patient folders of the same split
+    are kept. Patient folders that the manifest does not assign to their split folder (e.g. left by an earlier split)
+    are removed first, so that a patient is never in two splits.
+    Hard linked slice images share storage with the source, so they should not be modified in place.
+
+    :param manifest_path: csv file path
+    :param target_dir: folder of split folders, defaults to manifest folder
+    :param mode: "hardlink" links every file (copying across file systems), "symlink" links patient folders,
+    "copy" copies patient folders
+    :return: number of created patient folders
+    """
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(
+            f"Unknown materialize mode {mode}, use one of {MATERIALIZE_MODES}"
+        )
+    if target_dir is None:
+        target_dir = os.path.dirname(os.path.abspath(manifest_path))
+    rows = read_split_manifest(manifest_path)
+    assigned = {(row["split"], row["patient"]) for row in rows}
+    for split in sorted(set(SPLITS) | {row["split"] for row in rows}):
+        split_dir = os.path.join(target_dir, split)
+        if not os.path.isdir(split_dir):
+            continue
+        for patient in sorted(os.listdir(split_dir)):
+            if patient.split("_")[0] not in PATIENT_TYPES:
+                continue
+            if (split, patient) not in assigned:
+                print(f"removing {split}/{patient}, it is not in {split} split")
+                _remove_patient_folder(os.path.join(split_dir, patient))
+
+    n_created = 0
+    for row in rows:
+        split_dir = os.path.join(target_dir, row["split"])
+        os.makedirs(split_dir, exist_ok=True)
+        target_path = os.path.join(split_dir, row["patient"])
+        if os.path.lexists(target_path):
+            continue
+        if mode == "symlink":
+            os.symlink(row["source"], target_path, target_is_directory=True)
+        elif mode == "hardlink":
+            shutil.copytree(row["source"], target_path, copy_function=_link_or_copy)
+        else:
+            shutil.copytree(row["source"], target_path)
+        n_created += 1
+    return n_created
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from datasets.longitudinal_dataset import LongitudinalDataset, combination_table
+from datasets.slice_store import decode_images
+
+"""
+Each record is one longitudinal slice sequence, i.e. the same slice of all scans of a patient,
+with pre-resized uint8 images, days relative to the first scan and indices of all scan triplets.
+Image and triplet datasets are expanded from sequences while reading.
+"""
+
+TFRECORD_FOLDER_NAME = "tfrecords"
+
+
+def get_tfrecord_dir(data_dir, target_shape=None):
+    """
+    Default location of TFRecord export of a dataset folder with train, val and test splits.
+
+    :param data_dir: dataset folder, e.g. .../training_data_15T_192x160_4slices
+    :param target_shape: [height, width] of stored slices, None for original size
+    :return: folder path
+    """
+    shape_name = f"{target_shape[0]}x{target_shape[1]}" if target_shape else "original"
+    return os.path.join(data_dir, TFRECORD_FOLDER_NAME, shape_name)
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def sequence_to_example(images, days, patient_name, slice_index):
+    """
+    :param images: uint8 array with shape (n_scans, height, width, channels)
+    :param days: days of scans relative to first scan
+    :param patient_name:
+    :param slice_index:
+    :return: tf.train.Example
+    """
+    n_scans, height, width, channels = images.shape
+    feature = {
+        "images": _bytes_feature(np.ascontiguousarray(images).tobytes()),
+        "shape": _int64_feature([n_scans, height, width, channels]),
+        "days": _int64_feature(list(days)),
+        "triplets": _int64_feature(combination_table(n_scans, 3).flatten().tolist()),
+        "patient_name": _bytes_feature(patient_name.encode()),
+        "slice_index": _int64_feature([slice_index]),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def export_split(
+    split_dir, out_dir, target_shape=None, channels=1, n_shards=16, compression=None
+):
+    """
+    Writes all longitudinal slice sequences of a split folder into n_shards TFRecord files.
+    Patients are distributed over shards round robin. Shards of an earlier export in out_dir are removed,
+    and the shard file names are listed in metadata.json.
+
+    :param split_dir: folder with ad_*, mci_*, cn_* patient folders
+    :param out_dir: output folder
+    :param target_shape: [height, width], None to keep original size
+    :param channels: number of image channels
+    :param n_shards: number of TFRecord files
+    :param compression: None or "GZIP"
+    :return: list of shard paths
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    for file_name in os.listdir(out_dir):
+        if file_name.startswith("data-") and (
+            file_name.endswith(".tfrecord") or file_name.endswith(".tfrecord.tmp")
+        ):
+            os.remove(os.path.join(out_dir, file_name))
+    patients = LongitudinalDataset(data_dir=split_dir).get_patients()
+    n_shards = max(1, min(n_shards, len(patients)))
+    shard_paths = [
+        os.path.join(out_dir, f"data-{i:05d}-of-{n_shards:05d}.tfrecord")
+        for i in range(n_shards)
+    ]
+    options = tf.io.TFRecordOptions(compression_type=compression)
+    writers = [tf.io.TFRecordWriter(x + ".tmp", options=options) for x in shard_paths]
+    n_sequences = 0
+    n_images = 0
+    for patient_index, patient in enumerate(patients):
+        # images of patient in slice by slice, scan by scan order
+        images = decode_images(
+            patient.get_all_images(), target_shape=target_shape, channels=channels
+        )
+        images = images.reshape((patient.n_slices, patient.n_scans) + images.shape[1:])
+        writer = writers[patient_index % n_shards]
+        for slice_index in range(patient.n_slices):
+            example = sequence_to_example(
+                images[slice_index],
+                patient.relative_dates,
+                patient.patient_name,
+                slice_index,
+            )
+            writer.write(example.SerializeToString())
+        n_sequences += patient.n_slices
+        n_images += patient.n_slices * patient.n_scans
+    for writer in writers:
+        writer.close()
+    for shard_path in shard_paths:
+        os.replace(shard_path + ".tmp", shard_path)
+
+    with open(os.path.join(out_dir, "metadata.json"), "w") as metadata_file:
+        json.dump(
+            {
+                "target_shape": target_shape,
+                "channels": channels,
+                "compression": compression,
+                "n_shards": n_shards,
+                "shards": [os.path.basename(x) for x in shard_paths],
+                "n_patients": len(patients),
+                "n_sequences": n_sequences,
+                "n_images": n_images,
+            },
+            metadata_file,
+        )
+    return shard_paths
+
+
+def export_dataset(
+    data_dir,
+    target_shape=None,
+    channels=1,
+    n_shards=16,
+    compression=None,
+    tfrecord_dir=None,
+):
+    """
+    Exports train, val and test splits of a dataset folder, see export_split
+
+    :return: tfrecord_dir
+    """
+    if tfrecord_dir is None:
+        tfrecord_dir = get_tfrecord_dir(data_dir, target_shape)
+    for split in ["train", "val", "test"]:
+        print(f"exporting {split} split...")
+        export_split(
+            os.path.join(data_dir, split),
+            os.path.join(tfrecord_dir, split),
+            target_shape=target_shape,
+            channels=channels,
+            n_shards=n_shards,
+            compression=compression,
+        )
+    return tfrecord_dir
+
+
+def parse_sequence(serialized, image_shape=None):
+    """
+    Parses a sequence record
+
+    :param serialized: serialized tf.train.Example
+    :param image_shape: static [height, width, channels] of images, if known
+    :return: {"images": uint8 (n_scans, h, w, c), "days": int64 (n_scans,), "triplets": int64 (n_triplets, 3)}
+    """
+    features = tf.io.parse_single_example(
+        serialized,
+        {
+            "images": tf.io.FixedLenFeature([], tf.string),
+            "shape": tf.io.FixedLenFeature([4], tf.int64),
+            "days": tf.io.VarLenFeature(tf.int64),
+            "triplets": tf.io.VarLenFeature(tf.int64),
+        },
+    )
+    images = tf.reshape(
+        tf.io.decode_raw(features["images"], tf.uint8), features["shape"]
+    )
+    if image_shape:
+        images.set_shape([None] + list(image_shape))
+    return {
+        "images": images,
+        "days": tf.sparse.to_dense(features["days"]),
+        "triplets": tf.reshape(tf.sparse.to_dense(features["triplets"]), [-1, 3]),
+    }
+
+
+def get_sequence_dataset(split_dir, shuffle_shards=False, cycle_length=None):
+    """
+    Reads sequence records of a split with parallel interleaved shard reads
+
+    :param split_dir: folder with TFRecord shards and metadata.json
+    :param shuffle_shards: shuffle shard order and read them non-deterministically
+    :param cycle_length: number of shards read concurrently, defaults to number of shards
+    :return: tf.data.Dataset of parsed sequences, see parse_sequence
+    """
+    with open(os.path.join(split_dir, "metadata.json")) as metadata_file:
+        metadata = json.load(metadata_file)
+    if "shards" in metadata:
+        files = tf.data.Dataset.from_tensor_slices(
+            [os.path.join(split_dir, x) for x in metadata["shards"]]
+        )
+        if shuffle_shards:
+            files = files.shuffle(len(metadata["shards"]))
+    else:
+        # exports without shard list
+        files = tf.data.Dataset.list_files(
+            os.path.join(split_dir, "data-*.tfrecord"), shuffle=shuffle_shards
+        )
+    ds = files.interleave(
+        lambda x: tf.data.TFRecordDataset(
+            x, compression_type=metadata["compression"] or ""
+        ),
+        cycle_length=cycle_length if cycle_length else metadata["n_shards"],
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+        deterministic=not shuffle_shards,
+    )
+    image_shape = None
+    if metadata["target_shape"]:
+        image_shape = list(metadata["target_shape"]) + [metadata["channels"]]
+    return ds.map(
+        lambda x: parse_sequence(x, image_shape=image_shape),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export slice dataset to TFRecords")
+    parser.add_argument(
+        "data_dir", type=str, help="Dataset folder with train, val, test splits"
+    )
+    parser.add_argument("--height", default=None, type=int, help="target height")
+    parser.add_argument("--width", default=None, type=int, help="target width")
+    parser.add_argument("--channels", default=1, type=int, help="image channels")
+    parser.add_argument("--n_shards", default=16, type=int, help="shards per split")
+    parser.add_argument(
+        "--gzip", action="store_true", help="use GZIP compressed records"
+    )
+    parser.add_argument("--tfrecord_dir", default=None, type=str, help="output folder")
+    args = parser.parse_args()
+
+    target_shape = [args.height, args.width] if args.height and args.width else None
+    tfrecord_dir = export_dataset(
+        args.data_dir,
+        target_shape=target_shape,
+        channels=args.channels,
+        n_shards=args.n_shards,
+        compression="GZIP" if args.gzip else None,
+        tfrecord_dir=args.tfrecord_dir,
+    )
+    print(f"TFRecords written to {tfrecord_dir}")
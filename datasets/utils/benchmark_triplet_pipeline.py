@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import tensorflow as tf
+
+from datasets.adni_dataset import get_triplets_adni_15t_dataset
+
+"""
+Throughput of triplet training pipeline, per-path decoding vs decode-once image table
+
+python -m datasets.utils.benchmark_triplet_pipeline --folder_name training_data_15T_192x160_4slices --machine none
+"""
+
+parser = argparse.ArgumentParser(description="Triplet pipeline benchmark")
+parser.add_argument("--folder_name", default="training_data_15T_192x160_4slices")
+parser.add_argument("--machine", default="none")
+parser.add_argument("--height", default=64, type=int, help="target height")
+parser.add_argument("--width", default=64, type=int, help="target width")
+parser.add_argument("--batch", default=32, type=int, help="batch size")
+parser.add_argument("--epochs", default=3, type=int, help="number of epochs")
+parser.add_argument("--cache_dir", default=None, type=str, help="on-disk table dir")
+
+
+def timeit(ds, epochs):
+    epoch_times = []
+    n_triplets = 0
+    for _ in range(epochs):
+        start = time.time()
+        n_triplets = 0
+        for batch in ds:
+            n_triplets += int(tf.shape(batch["imgs"][0])[0])
+        epoch_times.append(time.time() - start)
+    return n_triplets, epoch_times
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    for decode_once in [False, True]:
+        start = time.time()
+        train_ds, _, _ = get_triplets_adni_15t_dataset(
+            folder_name=args.folder_name,
+            machine=args.machine,
+            target_shape=[args.height, args.width],
+            decode_once=decode_once,
+            cache_dir=args.cache_dir,
+        )
+        setup_time = time.time() - start
+        train_ds = train_ds.batch(args.batch).prefetch(3)
+        n_triplets, epoch_times = timeit(train_ds, args.epochs)
+        mean_time = sum(epoch_times) / len(epoch_times)
+        print(
+            f"decode_once={decode_once}: setup {setup_time:.2f} s, "
+            f"{n_triplets} triplets/epoch, epoch times "
+            + ", ".join(f"{x:.2f}" for x in epoch_times)
+            + f" s, {n_triplets / mean_time:.1f} triplets/s"
+        )
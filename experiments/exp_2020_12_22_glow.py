@@ -15,7 +15,7 @@ from datasets.adni_dataset import (
     get_triplets_adni_15t_dataset,
     get_images_adni_15t_dataset,
 )
-from model.glow.model import Glow
+from model.glow.model import Glow, bits_per_dim_loss
 
 """
 GLOW model implemented in TF2.
@@ -198,6 +198,7 @@ if __name__ == "__main__":
         ]
         return tf.reduce_mean([ssims[0], ssims[2]]), tf.reduce_mean(ssims[1])
 
+    @tf.function
     def train_step(image_batch):
         image_batch = image_batch + tf.random.normal(
             tf.shape(image_batch), mean=0.5, stddev=1
@@ -210,22 +211,25 @@ if __name__ == "__main__":
         image_batch = image_batch / (2 ** N_BITS) - 0.5  # todo: think about 0.5
 
         with tf.GradientTape() as gen_tape:
-            z_list = model(image_batch, training=True)
-            likelihood = sum(model.losses) / (
-                BATCH_SIZE * INPUT_HEIGHT * INPUT_WIDTH * INPUT_CHANNEL
+            z_list, log_p, logdet = model(image_batch, training=True)
+            # bits per dim
+            loss, _, _ = bits_per_dim_loss(
+                log_p, logdet, INPUT_HEIGHT * INPUT_WIDTH * INPUT_CHANNEL, N_BITS
+            )
+            likelihood = tf.reduce_mean(log_p + logdet) / (
+                INPUT_HEIGHT * INPUT_WIDTH * INPUT_CHANNEL
             )
-            loss = -1.0 * likelihood
-            print("loss: ", loss.numpy())
 
         grads = gen_tape.gradient(loss, model.trainable_variables)
         optimizer.apply_gradients(zip(grads, model.trainable_variables))
 
         return loss, likelihood
 
+    @tf.function
     def eval_step(image_batch):
-        z_list = model(image_batch, training=True)
-        likelihood = sum(model.losses) / (
-            BATCH_SIZE * INPUT_HEIGHT * INPUT_WIDTH * INPUT_CHANNEL
+        z_list, log_p, logdet = model(image_batch, training=False)
+        likelihood = tf.reduce_mean(log_p + logdet) / (
+            INPUT_HEIGHT * INPUT_WIDTH * INPUT_CHANNEL
         )
         return likelihood
 
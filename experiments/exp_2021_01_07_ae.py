@@ -212,121 +212,23 @@ if __name__ == "__main__":
         .prefetch(PREFETCH_BUFFER_SIZE)
     )
 
-    def calculate_ssim(imgs, generated_imgs):
-        ssims = [
-            tf.image.ssim(img1, img2, max_val=1.0)
-            for img1, img2 in zip(imgs, generated_imgs)
-        ]
-        return tf.reduce_mean(ssims)
-
-    def get_predicted_states(states, days):
-        while tf.rank(days[0]) < tf.rank(states[0]):
-            days = [tf.expand_dims(x, axis=-1) for x in days]
-        past = states[1] + (days[0] - days[2]) / (days[1] - days[2]) * (
-            states[1] - states[2]
-        )
-        missing = states[0] + (days[1] - days[0]) / (days[2] - days[0]) * (
-            states[2] - states[0]
-        )
-        future = states[0] + (days[2] - days[0]) / (days[1] - days[0]) * (
-            states[1] - states[0]
-        )
-        return [past, missing, future]
-
     mse_loss_fn = tf.keras.losses.MeanSquaredError()
 
     def train_step(imgs, days):
-        predicted_imgs_for_vis = None
-        with tf.GradientTape() as tape:
-            structures = []
-            states = []
-            for image_batch in imgs:
-                structure, state = model.encode(image_batch, training=True)
-                structures.append(structure)
-                states.append(state)
-            structure_sim_mse = [
-                mse_loss_fn(structures[0], structures[1]),
-                mse_loss_fn(structures[0], structures[2]),
-                mse_loss_fn(structures[1], structures[2]),
-            ]
-            structure_vec_sim_loss = tf.reduce_mean(
-                structure_sim_mse
-            )  # sum(structure_sim_mse) / 3.0
-
-            predicted_states = get_predicted_states(states, days)
-            predicted_imgs = [
-                model.decode(structure, state)
-                for structure, state in zip(structures, predicted_states)
-            ]
-            if predicted_imgs_for_vis is None:
-                predicted_imgs_for_vis = predicted_imgs
-            image_similarity_mse = [
-                mse_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
-            ]
-            image_similarity_loss = tf.reduce_mean(
-                image_similarity_mse
-            )  # sum(image_similarity_mse) / 3.0
-            total_loss = (
-                STRUCTURE_VEC_SIMILARITY_LOSS_MULT * structure_vec_sim_loss
-                + image_similarity_loss
-            )
-
-        grads = tape.gradient(total_loss, model.trainable_variables)
-        optimizer.apply_gradients(zip(grads, model.trainable_variables))
-
-        ssims = calculate_ssim(imgs, predicted_imgs)
-
-        return (
-            total_loss,
-            image_similarity_loss,
-            structure_vec_sim_loss,
-            ssims,
-            predicted_imgs_for_vis,
+        return model.train_using_triplet(
+            imgs,
+            days,
+            optimizer,
+            sim_loss_fn=mse_loss_fn,
+            structure_vec_similarity_loss_mult=STRUCTURE_VEC_SIMILARITY_LOSS_MULT,
         )
 
     def eval_step(imgs, days):
-        predicted_imgs_for_vis = None
-        structures = []
-        states = []
-        for image_batch in imgs:
-            structure, state = model.encode(image_batch, training=False)
-            structures.append(structure)
-            states.append(state)
-        structure_sim_mse = [
-            mse_loss_fn(structures[0], structures[1]),
-            mse_loss_fn(structures[0], structures[2]),
-            mse_loss_fn(structures[1], structures[2]),
-        ]
-        structure_vec_sim_loss = tf.reduce_mean(
-            structure_sim_mse
-        )  # sum(structure_sim_mse) / 3.0
-
-        predicted_states = get_predicted_states(states, days)
-        predicted_imgs = [
-            model.decode(structure, state)
-            for structure, state in zip(structures, predicted_states)
-        ]
-        if predicted_imgs_for_vis is None:
-            predicted_imgs_for_vis = predicted_imgs
-        image_similarity_mse = [
-            mse_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
-        ]
-        image_similarity_loss = tf.reduce_mean(
-            image_similarity_mse
-        )  # sum(image_similarity_mse) / 3.0
-        total_loss = (
-            STRUCTURE_VEC_SIMILARITY_LOSS_MULT * structure_vec_sim_loss
-            + image_similarity_loss
-        )
-
-        ssims = calculate_ssim(imgs, predicted_imgs)
-
-        return (
-            total_loss,
-            image_similarity_loss,
-            structure_vec_sim_loss,
-            ssims,
-            predicted_imgs_for_vis,
+        return model.eval_using_triplet(
+            imgs,
+            days,
+            sim_loss_fn=mse_loss_fn,
+            structure_vec_similarity_loss_mult=STRUCTURE_VEC_SIMILARITY_LOSS_MULT,
         )
 
     def generate_images(predicted_imgs, image_name):
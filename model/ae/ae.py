@@ -6,6 +6,23 @@ import numpy as np
 from tqdm import tqdm
 
 
+class WeightSnapshot:
+    """
+    Host memory copy of model (and optionally optimizer) variables, see AE.snapshot_weights
+    """
+
+    def __init__(self, model_weights, optimizer_weights=None):
+        self.model_weights = model_weights
+        self.optimizer_weights = optimizer_weights
+
+
+def get_optimizer_variables(optimizer):
+    variables = optimizer.variables
+    if callable(variables):
+        variables = variables()
+    return list(variables)
+
+
 class AE(tf.keras.Model):
     def __init__(
         self,
@@ -15,9 +32,20 @@ class AE(tf.keras.Model):
         last_activation=tf.nn.sigmoid,
         structure_vec_size=100,
         longitudinal_vec_size=1,
+        compiled_steps=True,
+        jit_compile=False,
         **kwargs,
     ):
+        """
+
+        :param compiled_steps: if True, training and evaluation steps run as tf.functions
+        :param jit_compile: if True, compiled steps are compiled with XLA
+        """
         super(AE, self).__init__(**kwargs)
+        self.compiled_steps = compiled_steps
+        self.jit_compile = jit_compile
+        self._step_functions = {}
+        self._weight_snapshot = None
         self.filters = filters
         self.kernel_size = kernel_size
         self.structure_vec_size = structure_vec_size
@@ -32,6 +60,7 @@ class AE(tf.keras.Model):
             )
             for f in filters
         ]
+        self.flatten = tf.keras.layers.Flatten()
         self.structure_dense = tf.keras.layers.Dense(
             structure_vec_size, activation=tf.nn.tanh, use_bias=False
         )
@@ -57,6 +86,9 @@ class AE(tf.keras.Model):
                 activation=last_activation,
             )
         )
+        self.upsampling_layers = [
+            tf.keras.layers.UpSampling2D() for _ in self.upsample_layers
+        ]
 
     def build(self, input_shape):
         _, height, width, channels = input_shape
@@ -84,7 +116,7 @@ class AE(tf.keras.Model):
         x = image_batch
         for layer in self.downsample_conv:
             x = layer(x)
-        x = tf.keras.layers.Flatten()(x)
+        x = self.flatten(x)
         structure = self.structure_dense(x)
         longitudinal_state = self.longitudinal_dense(x)
         return structure, longitudinal_state
@@ -94,11 +126,75 @@ class AE(tf.keras.Model):
         y = self.decode_longitudinal_dense(longitudinal_state)
         x = tf.math.add(x, y)
         x = tf.reshape(x, shape=[-1] + self.decode_input_shape)
-        for up_conv in self.upsample_layers:
-            x = tf.keras.layers.UpSampling2D()(x)
+        for upsampling, up_conv in zip(self.upsampling_layers, self.upsample_layers):
+            x = upsampling(x)
             x = up_conv(x)
         return x
 
+    def encode_sequence(self, imgs, training=None):
+        """
+        Encodes a list of image batches (e.g. time points of triplets) with a single encoder pass
+
+        :param imgs: list of image batches
+        :param training:
+        :return: list of structure vectors, list of longitudinal states
+        """
+        sizes = [tf.shape(x)[0] for x in imgs]
+        structure, state = self.encode(tf.concat(imgs, axis=0), training=training)
+        return tf.split(structure, sizes, axis=0), tf.split(state, sizes, axis=0)
+
+    def decode_sequence(self, structures, longitudinal_states, training=None):
+        """
+        Decodes lists of structure vectors and longitudinal states with a single decoder pass
+
+        :param structures: list of structure vector batches
+        :param longitudinal_states: list of longitudinal state batches
+        :param training:
+        :return: list of image batches
+        """
+        sizes = [tf.shape(x)[0] for x in structures]
+        imgs = self.decode(
+            tf.concat(structures, axis=0),
+            tf.concat(longitudinal_states, axis=0),
+            training=training,
+        )
+        return tf.split(imgs, sizes, axis=0)
+
+    def run_step(self, step_fn, inputs, *args):
+        """
+        Runs step_fn(*inputs, *args). If compiled_steps is True, step_fn is wrapped in a tf.function
+        with an input signature that has unknown batch sizes, so it is traced once for each step
+        and args (e.g. optimizer) instead of once per input shape.
+
+        :param step_fn: step method
+        :param inputs: tuple of tensors or tuples of tensors
+        :param args: python arguments of the step, bound at trace time
+        :return: outputs of step_fn
+        """
+        inputs = tf.nest.map_structure(
+            tf.convert_to_tensor,
+            tuple(tuple(x) if isinstance(x, list) else x for x in inputs),
+        )
+        if not self.compiled_steps:
+            return step_fn(*inputs, *args)
+        args_key = tuple(
+            x if isinstance(x, (bool, int, float, str)) else id(x) for x in args
+        )
+        # only the latest function of each step is kept, so old optimizers are released
+        cached = self._step_functions.get(step_fn.__name__)
+        if cached is None or cached[0] != args_key:
+            input_signature = tf.nest.map_structure(
+                lambda x: tf.TensorSpec([None] + x.shape[1:], x.dtype), inputs
+            )
+            function = tf.function(
+                lambda *x: step_fn(*x, *args),
+                input_signature=input_signature,
+                jit_compile=self.jit_compile,
+            )
+            cached = (args_key, function)
+            self._step_functions[step_fn.__name__] = cached
+        return cached[1](*inputs)
+
     def call(self, inputs, training=None, mask=None):
         structure, state = self.encode(inputs, training=training)
         out = self.decode(structure, state, training=training)
@@ -127,20 +223,37 @@ class AE(tf.keras.Model):
             return_as_image=False,
         )
         ssim = self.calculate_ssim([ground_truth], [interpolations[ground_truth_index]])
-        interpolations = [
-            np.clip(x.numpy()[0, ...] * 255, 0, 255).astype(np.uint8)
-            for x in interpolations
-        ]
-        interpolations = [
-            cv2.putText(x, str(p), (0, 10), cv2.FONT_HERSHEY_PLAIN, 1, 255)
-            for x, p in zip(interpolations, dates)
-        ]
+        images = self.interpolations_to_images(interpolations)
         for idx in {0, 1, 2} - {ground_truth_index}:
-            cv2.putText(
-                interpolations[idx], "*", (0, 63), cv2.FONT_HERSHEY_PLAIN, 1, 255
-            )
-        interpolations = np.hstack(interpolations)
-        return interpolations, ssim.numpy()
+            cv2.putText(images[idx], "*", (0, 63), cv2.FONT_HERSHEY_PLAIN, 1, 255)
+        return self.stack_images(images, dates), ssim.numpy()
+
+    @staticmethod
+    def interpolations_to_images(interpolations):
+        """
+        Converts first sample of every interpolation to uint8 image in one pass
+
+        :param interpolations: tensor with shape (n_points, batch, height, width, channels)
+        :return: uint8 array with shape (n_points, height, width, channels)
+        """
+        images = np.clip(interpolations[:, 0].numpy() * 255, 0, 255)
+        return np.ascontiguousarray(images.astype(np.uint8))
+
+    @staticmethod
+    def stack_images(images, dates):
+        """
+        Writes dates on images and stacks them horizontally
+
+        :param images: uint8 array with shape (n_points, height, width, channels)
+        :param dates: label of every image
+        :return: uint8 array with shape (height, n_points * width, channels)
+        """
+        for image, date in zip(images, dates):
+            cv2.putText(image, str(date), (0, 10), cv2.FONT_HERSHEY_PLAIN, 1, 255)
+        n_points, height, width, channels = images.shape
+        return images.transpose((1, 0, 2, 3)).reshape(
+            (height, n_points * width, channels)
+        )
 
     def interpolate(
         self,
@@ -151,10 +264,23 @@ class AE(tf.keras.Model):
         structure_mix_type="mean",
         return_as_image=False,
     ):
+        """
+        Decodes images with longitudinal states interpolated (or extrapolated) between the states of
+        inputs1 (sample point 0) and inputs2 (sample point 1). All sample points are decoded in one batch.
+
+        :param inputs1: image batch
+        :param inputs2: image batch
+        :param sample_points: list of sample points
+        :param dates: labels written on images if return_as_image is True
+        :param structure_mix_type: "first", "second" or "mean"
+        :param return_as_image: if True, first sample of each point is returned as a labeled uint8 image row
+        :return: tensor with shape (n_points, batch, height, width, channels), or image
+        """
         if dates is None:
             dates = [round(p, 2) for p in sample_points]
-        structure1, state1 = self.encode(inputs1, training=False)
-        structure2, state2 = self.encode(inputs2, training=False)
+        structures, states = self.encode_sequence([inputs1, inputs2], training=False)
+        structure1, structure2 = structures
+        state1, state2 = states
         if structure_mix_type == "first":
             structure = structure1
         elif structure_mix_type == "second":
@@ -163,21 +289,25 @@ class AE(tf.keras.Model):
             structure = (structure1 + structure2) / 2.0
         else:
             raise ValueError(f"structure mix type {structure_mix_type} is unknown")
-        diff = state2 - state1
-        state_vecs = [state1 + diff * sample_point for sample_point in sample_points]
-        interpolations = [
-            self.decode(structure, state, training=False) for state in state_vecs
-        ]
+        n_points = len(sample_points)
+        points = tf.reshape(tf.cast(sample_points, state1.dtype), [n_points, 1, 1])
+        # (n_points, batch, state size)
+        state_vecs = state1[tf.newaxis] + (state2 - state1)[tf.newaxis] * points
+        structure_vecs = tf.broadcast_to(
+            structure[tf.newaxis], [n_points] + tf.unstack(tf.shape(structure))
+        )
+        decoded = self.decode(
+            tf.reshape(structure_vecs, [-1, tf.shape(structure)[-1]]),
+            tf.reshape(state_vecs, [-1, tf.shape(state1)[-1]]),
+            training=False,
+        )
+        interpolations = tf.reshape(
+            decoded, tf.concat([[n_points, -1], tf.shape(decoded)[1:]], axis=0)
+        )
         if return_as_image:
-            interpolations = [
-                np.clip(x.numpy()[0, ...] * 255, 0, 255).astype(np.uint8)
-                for x in interpolations
-            ]
-            interpolations = [
-                cv2.putText(x, str(p), (0, 10), cv2.FONT_HERSHEY_PLAIN, 1, 255)
-                for x, p in zip(interpolations, dates)
-            ]
-            interpolations = np.hstack(interpolations)
+            interpolations = self.stack_images(
+                self.interpolations_to_images(interpolations), dates
+            )
         return interpolations
 
     def interpolate_and_ssim(
@@ -314,6 +444,7 @@ class AE(tf.keras.Model):
         callback_fn_save_val_losses=None,
         callback_fn_save_train_and_pair_losses=None,
         use_training_set=True,
+        optimizer=None,
     ):
         """
         finetuning function
@@ -330,9 +461,13 @@ class AE(tf.keras.Model):
         :param callback_fn_generate_seq:
         :param callback_fn_save_val_losses:
         :param callback_fn_save_train_and_pair_losses:
+        :param use_training_set:
+        :param optimizer: optimizer to use (e.g. reset with restore_weights_snapshot), if None a new Adam
+        optimizer with learning rate lr is created
         :return:
         """
-        optimizer = tf.optimizers.Adam(lr, beta_1=0.5)
+        if optimizer is None:
+            optimizer = tf.optimizers.Adam(lr, beta_1=0.5)
         sim_loss_fn = tf.keras.losses.MeanSquaredError()
         structure_vec_similarity_loss_mult = 100
 
@@ -607,46 +742,103 @@ class AE(tf.keras.Model):
         sim_loss_fn=tf.keras.losses.MeanSquaredError(),
         structure_vec_similarity_loss_mult=100,
     ):
-        predicted_imgs_for_vis = None
-        structures = []
-        states = []
-        for image_batch in imgs:
-            structure, state = self.encode(image_batch, training=False)
-            structures.append(structure)
-            states.append(state)
+        return self.run_step(
+            self._eval_using_triplet,
+            (imgs, days),
+            sim_loss_fn,
+            structure_vec_similarity_loss_mult,
+        )
+
+    def _eval_using_triplet(
+        self, imgs, days, sim_loss_fn, structure_vec_similarity_loss_mult
+    ):
+        (
+            total_loss,
+            image_similarity_loss,
+            structure_vec_sim_loss,
+            predicted_imgs,
+        ) = self.triplet_losses(
+            imgs,
+            days,
+            sim_loss_fn,
+            structure_vec_similarity_loss_mult,
+            training=False,
+        )
+        ssims = self.calculate_ssim(imgs, predicted_imgs)
+        return (
+            total_loss,
+            image_similarity_loss,
+            structure_vec_sim_loss,
+            ssims,
+            predicted_imgs,
+        )
+
+    def triplet_losses(
+        self,
+        imgs,
+        days,
+        sim_loss_fn,
+        structure_vec_similarity_loss_mult,
+        training=None,
+        structures=None,
+        states=None,
+    ):
+        """
+        Losses of predicting each image of triplets from the other two.
+        All time points are encoded in one pass and decoded in one pass.
+
+        :param structures: structure vectors of imgs, if already encoded
+        :param states: longitudinal states of imgs, if already encoded
+        :return: total_loss, image_similarity_loss, structure_vec_sim_loss, predicted_imgs
+        """
+        if structures is None:
+            structures, states = self.encode_sequence(imgs, training=training)
         structure_sim_mse = [
             sim_loss_fn(structures[0], structures[1]),
             sim_loss_fn(structures[0], structures[2]),
             sim_loss_fn(structures[1], structures[2]),
         ]
-        structure_vec_sim_loss = tf.reduce_mean(
-            structure_sim_mse
-        )  # sum(structure_sim_mse) / 3.0
+        structure_vec_sim_loss = tf.reduce_mean(structure_sim_mse)
         predicted_states = self.get_predicted_states(states, days)
-        predicted_imgs = [
-            self.decode(structure, state)
-            for structure, state in zip(structures, predicted_states)
-        ]
-        if predicted_imgs_for_vis is None:
-            predicted_imgs_for_vis = predicted_imgs
+        predicted_imgs = self.decode_sequence(
+            structures, predicted_states, training=training
+        )
         image_similarity_mse = [
             sim_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
         ]
-        image_similarity_loss = tf.reduce_mean(
-            image_similarity_mse
-        )  # sum(image_similarity_mse) / 3.0
+        image_similarity_loss = tf.reduce_mean(image_similarity_mse)
         total_loss = (
             structure_vec_similarity_loss_mult * structure_vec_sim_loss
             + image_similarity_loss
         )
-        ssims = self.calculate_ssim(imgs, predicted_imgs)
-        return (
-            total_loss,
-            image_similarity_loss,
-            structure_vec_sim_loss,
-            ssims,
-            predicted_imgs_for_vis,
+        return total_loss, image_similarity_loss, structure_vec_sim_loss, predicted_imgs
+
+    def pair_losses(
+        self,
+        imgs,
+        sim_loss_fn,
+        training=None,
+        structures=None,
+        states=None,
+    ):
+        """
+        Reconstruction losses of image pairs
+
+        :param structures: structure vectors of imgs, if already encoded
+        :param states: longitudinal states of imgs, if already encoded
+        :return: image_similarity_loss, structure_vec_sim_loss, predicted_imgs
+        """
+        if structures is None:
+            structures, states = self.encode_sequence(imgs, training=training)
+        structure_vec_sim_loss = tf.reduce_mean(
+            [sim_loss_fn(structures[0], structures[1])]
         )
+        predicted_imgs = self.decode_sequence(structures, states, training=training)
+        image_similarity_mse = [
+            sim_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
+        ]
+        image_similarity_loss = tf.reduce_mean(image_similarity_mse)
+        return image_similarity_loss, structure_vec_sim_loss, predicted_imgs
 
     def train_using_pair(
         self,
@@ -655,26 +847,23 @@ class AE(tf.keras.Model):
         sim_loss_fn=tf.keras.losses.MeanSquaredError(),
         structure_vec_similarity_loss_mult=100,
     ):
-        predicted_imgs_for_vis = None
+        return self.run_step(
+            self._train_using_pair,
+            (imgs,),
+            optimizer,
+            sim_loss_fn,
+            structure_vec_similarity_loss_mult,
+        )
+
+    def _train_using_pair(
+        self, imgs, optimizer, sim_loss_fn, structure_vec_similarity_loss_mult
+    ):
         with tf.GradientTape() as tape:
-            structures = []
-            states = []
-            for image_batch in imgs:
-                structure, state = self.encode(image_batch, training=True)
-                structures.append(structure)
-                states.append(state)
-            structure_sim_mse = [sim_loss_fn(structures[0], structures[1])]
-            structure_vec_sim_loss = tf.reduce_mean(structure_sim_mse)
-            predicted_imgs = [
-                self.decode(structure, state)
-                for structure, state in zip(structures, states)
-            ]
-            if predicted_imgs_for_vis is None:
-                predicted_imgs_for_vis = predicted_imgs
-            image_similarity_mse = [
-                sim_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
-            ]
-            image_similarity_loss = tf.reduce_mean(image_similarity_mse)
+            (
+                image_similarity_loss,
+                structure_vec_sim_loss,
+                predicted_imgs,
+            ) = self.pair_losses(imgs, sim_loss_fn, training=True)
             total_loss = (
                 structure_vec_similarity_loss_mult * structure_vec_sim_loss
                 + image_similarity_loss
@@ -687,12 +876,12 @@ class AE(tf.keras.Model):
             image_similarity_loss,
             structure_vec_sim_loss,
             ssims,
-            predicted_imgs_for_vis,
+            predicted_imgs,
         )
 
     @staticmethod
     def get_predicted_states(states, days):
-        while tf.rank(days[0]) < tf.rank(states[0]):
+        while days[0].shape.rank < states[0].shape.rank:
             days = [tf.expand_dims(x, axis=-1) for x in days]
         past = states[1] + (days[0] - days[2]) / (days[1] - days[2]) * (
             states[1] - states[2]
@@ -707,10 +896,11 @@ class AE(tf.keras.Model):
 
     @staticmethod
     def calculate_ssim(imgs, generated_imgs):
-        ssims = [
-            tf.image.ssim(img1, img2, max_val=1.0)
-            for img1, img2 in zip(imgs, generated_imgs)
-        ]
+        ssims = tf.image.ssim(
+            tf.concat(list(imgs), axis=0),
+            tf.concat(list(generated_imgs), axis=0),
+            max_val=1.0,
+        )
         return tf.reduce_mean(ssims)
 
     def train_using_triplet_and_pair(
@@ -722,55 +912,62 @@ class AE(tf.keras.Model):
         sim_loss_fn=tf.keras.losses.MeanSquaredError(),
         structure_vec_similarity_loss_mult=100,
         use_training_set=True,
+    ):
+        return self.run_step(
+            self._train_using_triplet_and_pair,
+            (imgs, days, pair),
+            optimizer,
+            sim_loss_fn,
+            structure_vec_similarity_loss_mult,
+            use_training_set,
+        )
+
+    def _train_using_triplet_and_pair(
+        self,
+        imgs,
+        days,
+        pair,
+        optimizer,
+        sim_loss_fn,
+        structure_vec_similarity_loss_mult,
+        use_training_set,
     ):
         predicted_imgs_for_vis = None
         with tf.GradientTape() as tape:
-            # using pair
-            structures = []
-            states = []
-            for image_batch in pair:
-                structure, state = self.encode(image_batch, training=True)
-                structures.append(structure)
-                states.append(state)
-            structure_sim_mse = [sim_loss_fn(structures[0], structures[1])]
-            structure_vec_sim_loss_pair = tf.reduce_mean(structure_sim_mse)
-            predicted_imgs_pair = [
-                self.decode(structure, state)
-                for structure, state in zip(structures, states)
-            ]
-            image_similarity_mse = [
-                sim_loss_fn(real, pred) for real, pred in zip(pair, predicted_imgs_pair)
-            ]
-            image_similarity_loss_pair = tf.reduce_mean(image_similarity_mse)
-
             if use_training_set:
-                # using triplet
-                structures = []
-                states = []
-                for image_batch in imgs:
-                    structure, state = self.encode(image_batch, training=True)
-                    structures.append(structure)
-                    states.append(state)
-                structure_sim_mse = [
-                    sim_loss_fn(structures[0], structures[1]),
-                    sim_loss_fn(structures[0], structures[2]),
-                    sim_loss_fn(structures[1], structures[2]),
-                ]
-                structure_vec_sim_loss = tf.reduce_mean(structure_sim_mse)
-
-                predicted_states = self.get_predicted_states(states, days)
-                predicted_imgs = [
-                    self.decode(structure, state)
-                    for structure, state in zip(structures, predicted_states)
-                ]
-                if predicted_imgs_for_vis is None:
-                    predicted_imgs_for_vis = predicted_imgs
-                image_similarity_mse = [
-                    sim_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
-                ]
-                image_similarity_loss = tf.reduce_mean(
-                    image_similarity_mse
-                )  # sum(image_similarity_mse) / 3.0
+                # pair and triplet images are encoded together
+                structures, states = self.encode_sequence(
+                    list(pair) + list(imgs), training=True
+                )
+            else:
+                structures, states = self.encode_sequence(pair, training=True)
+            (
+                image_similarity_loss_pair,
+                structure_vec_sim_loss_pair,
+                predicted_imgs_pair,
+            ) = self.pair_losses(
+                pair,
+                sim_loss_fn,
+                training=True,
+                structures=structures[:2],
+                states=states[:2],
+            )
+            if use_training_set:
+                (
+                    _,
+                    image_similarity_loss,
+                    structure_vec_sim_loss,
+                    predicted_imgs,
+                ) = self.triplet_losses(
+                    imgs,
+                    days,
+                    sim_loss_fn,
+                    structure_vec_similarity_loss_mult,
+                    training=True,
+                    structures=structures[2:],
+                    states=states[2:],
+                )
+                predicted_imgs_for_vis = predicted_imgs
             else:
                 structure_vec_sim_loss = tf.convert_to_tensor(0.0, dtype=tf.float32)
                 image_similarity_loss = tf.convert_to_tensor(0.0, dtype=tf.float32)
@@ -809,37 +1006,29 @@ class AE(tf.keras.Model):
         sim_loss_fn=tf.keras.losses.MeanSquaredError(),
         structure_vec_similarity_loss_mult=100,
     ):
-        predicted_imgs_for_vis = None
+        return self.run_step(
+            self._train_using_triplet,
+            (imgs, days),
+            optimizer,
+            sim_loss_fn,
+            structure_vec_similarity_loss_mult,
+        )
+
+    def _train_using_triplet(
+        self, imgs, days, optimizer, sim_loss_fn, structure_vec_similarity_loss_mult
+    ):
         with tf.GradientTape() as tape:
-            structures = []
-            states = []
-            for image_batch in imgs:
-                structure, state = self.encode(image_batch, training=True)
-                structures.append(structure)
-                states.append(state)
-            structure_sim_mse = [
-                sim_loss_fn(structures[0], structures[1]),
-                sim_loss_fn(structures[0], structures[2]),
-                sim_loss_fn(structures[1], structures[2]),
-            ]
-            structure_vec_sim_loss = tf.reduce_mean(structure_sim_mse)
-
-            predicted_states = self.get_predicted_states(states, days)
-            predicted_imgs = [
-                self.decode(structure, state)
-                for structure, state in zip(structures, predicted_states)
-            ]
-            if predicted_imgs_for_vis is None:
-                predicted_imgs_for_vis = predicted_imgs
-            image_similarity_mse = [
-                sim_loss_fn(real, pred) for real, pred in zip(imgs, predicted_imgs)
-            ]
-            image_similarity_loss = tf.reduce_mean(
-                image_similarity_mse
-            )  # sum(image_similarity_mse) / 3.0
-            total_loss = (
-                structure_vec_similarity_loss_mult * structure_vec_sim_loss
-                + image_similarity_loss
+            (
+                total_loss,
+                image_similarity_loss,
+                structure_vec_sim_loss,
+                predicted_imgs,
+            ) = self.triplet_losses(
+                imgs,
+                days,
+                sim_loss_fn,
+                structure_vec_similarity_loss_mult,
+                training=True,
             )
 
         grads = tape.gradient(total_loss, self.trainable_variables)
@@ -852,7 +1041,7 @@ class AE(tf.keras.Model):
             image_similarity_loss,
             structure_vec_sim_loss,
             ssims,
-            predicted_imgs_for_vis,
+            predicted_imgs,
         )
 
     def restore_model(self, checkpoint_dir):
@@ -860,6 +1049,56 @@ class AE(tf.keras.Model):
         manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=5)
         checkpoint.restore(manager.latest_checkpoint)
 
+    def build_optimizer(self, optimizer):
+        """
+        Creates optimizer slot variables for model weights, so optimizer state can be snapshot
+        before the first training step.
+
+        :param optimizer:
+        """
+        if getattr(optimizer, "built", False):
+            return
+        if hasattr(optimizer, "_create_all_weights"):
+            optimizer._create_all_weights(self.trainable_variables)
+        else:
+            optimizer.build(self.trainable_variables)
+
+    def snapshot_weights(self, optimizer=None):
+        """
+        Copies all model weights (and optimizer state if optimizer is given) to host memory.
+        Use restore_weights_snapshot to reset the model in place, e.g. between per-patient fine-tuning runs,
+        instead of reading the checkpoint from disk again.
+
+        :param optimizer: optimizer whose state is also saved, see build_optimizer
+        :return: WeightSnapshot, also kept as the latest snapshot of the model
+        """
+        model_weights = [v.numpy() for v in self.variables]
+        optimizer_weights = None
+        if optimizer is not None:
+            optimizer_weights = [v.numpy() for v in get_optimizer_variables(optimizer)]
+        self._weight_snapshot = WeightSnapshot(model_weights, optimizer_weights)
+        return self._weight_snapshot
+
+    def restore_weights_snapshot(self, snapshot=None, optimizer=None):
+        """
+        Assigns snapshot weights to model variables (and optimizer variables) in place.
+
+        :param snapshot: WeightSnapshot, latest snapshot if None
+        :param optimizer: optimizer to reset, must be the one (or have the same variables as the one) given to
+        snapshot_weights
+        """
+        if snapshot is None:
+            snapshot = self._weight_snapshot
+        for variable, value in zip(self.variables, snapshot.model_weights):
+            variable.assign(value)
+        if optimizer is not None:
+            if snapshot.optimizer_weights is None:
+                raise ValueError("Snapshot does not contain optimizer state")
+            for variable, value in zip(
+                get_optimizer_variables(optimizer), snapshot.optimizer_weights
+            ):
+                variable.assign(value)
+
 
 if __name__ == "__main__":
     FILTERS = [64, 128, 256, 512]
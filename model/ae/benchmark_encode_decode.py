@@ -0,0 +1,69 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from model.ae.ae import AE
+
+"""
+Per-call time of AE.encode and AE.decode compared to the previous implementation
+which created new Flatten and UpSampling2D layers on every call.
+
+python -m model.ae.benchmark_encode_decode
+"""
+
+FILTERS = [64, 128, 256, 512]
+KERNEL_SIZE = 3
+INPUT_HEIGHT = 64
+INPUT_WIDTH = 64
+NUM_CALLS = 100
+
+
+def encode_with_new_layers(model, image_batch):
+    x = image_batch
+    for layer in model.downsample_conv:
+        x = layer(x)
+    x = tf.keras.layers.Flatten()(x)
+    return model.structure_dense(x), model.longitudinal_dense(x)
+
+
+def decode_with_new_layers(model, structure, longitudinal_state):
+    x = model.decode_structure_dense(structure)
+    y = model.decode_longitudinal_dense(longitudinal_state)
+    x = tf.math.add(x, y)
+    x = tf.reshape(x, shape=[-1] + model.decode_input_shape)
+    for up_conv in model.upsample_layers:
+        x = tf.keras.layers.UpSampling2D()(x)
+        x = up_conv(x)
+    return x
+
+
+def timeit(fn, num_calls=NUM_CALLS):
+    fn()
+    start = time.time()
+    for _ in range(num_calls):
+        out = fn()
+    tf.nest.map_structure(lambda x: x.numpy(), out)
+    return (time.time() - start) / num_calls * 1000
+
+
+if __name__ == "__main__":
+    model = AE(filters=FILTERS, kernel_size=KERNEL_SIZE)
+    _ = model(tf.zeros((1, INPUT_HEIGHT, INPUT_WIDTH, 1)))
+    for batch_size in [1, 32]:
+        image_batch = tf.convert_to_tensor(
+            np.random.rand(batch_size, INPUT_HEIGHT, INPUT_WIDTH, 1), dtype=tf.float32
+        )
+        structure, state = model.encode(image_batch)
+        results = {
+            "encode (new layers per call)": timeit(
+                lambda: encode_with_new_layers(model, image_batch)
+            ),
+            "encode (owned layers)": timeit(lambda: model.encode(image_batch)),
+            "decode (new layers per call)": timeit(
+                lambda: decode_with_new_layers(model, structure, state)
+            ),
+            "decode (owned layers)": timeit(lambda: model.decode(structure, state)),
+        }
+        for name, ms in results.items():
+            print(f"batch size {batch_size:2d}, {name}: {ms:.3f} ms/call")
@@ -0,0 +1,103 @@
+import argparse
+import time
+
+import tensorflow as tf
+
+from model.glow.model import Glow, bits_per_dim_loss
+
+"""
+Images/sec of Glow likelihood, training step and sampling, eager and wrapped in tf.function, for the configuration
+of experiments/exp_2020_12_22_glow.py (4 blocks, 32 flows, 512 filters, LU decomposed 1x1 convs, affine coupling).
+With --kernel_cache, sampling uses cached forward and inverse 1x1 conv kernels, see Glow.set_kernel_cache.
+
+python -m model.glow.benchmark_glow --batch_size 5 --num_steps 10 --kernel_cache
+"""
+
+NUM_FLOWS = 32
+NUM_BLOCKS = 4
+SPLIT = True
+USE_LU_DECOM = True
+AFFINE = True
+NUM_FILTERS = 512
+INPUT_HEIGHT = 64
+INPUT_WIDTH = 64
+INPUT_CHANNEL = 1
+TEMPERATURE = 0.7
+
+parser = argparse.ArgumentParser(description="Glow benchmark")
+parser.add_argument("--batch_size", default=5, type=int)
+parser.add_argument("--num_steps", default=10, type=int)
+parser.add_argument(
+    "--check_numerics", action="store_true", help="benchmark with NaN checks"
+)
+parser.add_argument(
+    "--kernel_cache", action="store_true", help="sample with cached 1x1 conv kernels"
+)
+
+
+def images_per_second(fn, batch_size, num_steps):
+    # first call builds the model or traces the function
+    tf.nest.map_structure(lambda x: x.numpy(), fn())
+    start = time.time()
+    for _ in range(num_steps):
+        out = fn()
+    tf.nest.map_structure(lambda x: x.numpy(), out)
+    return batch_size * num_steps / (time.time() - start)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    model = Glow(
+        in_channels=INPUT_CHANNEL,
+        num_blocks=NUM_BLOCKS,
+        num_flows=NUM_FLOWS,
+        num_filters=NUM_FILTERS,
+        use_lu_decom=USE_LU_DECOM,
+        affine=AFFINE,
+        split=SPLIT,
+        check_numerics=args.check_numerics,
+    )
+    optimizer = tf.optimizers.Adam(1e-4, beta_1=0.5)
+    image_batch = (
+        tf.random.uniform(
+            (args.batch_size, INPUT_HEIGHT, INPUT_WIDTH, INPUT_CHANNEL),
+            dtype=tf.float32,
+        )
+        - 0.5
+    )
+    n_pixels = INPUT_HEIGHT * INPUT_WIDTH * INPUT_CHANNEL
+    z_list, _, _ = model(image_batch, training=True)
+    z_sample = [
+        tf.random.normal(tf.shape(z), stddev=TEMPERATURE, dtype=tf.float32)
+        for z in z_list
+    ]
+
+    def likelihood():
+        _, log_p, logdet = model(image_batch, training=True)
+        return bits_per_dim_loss(log_p, logdet, n_pixels)[0]
+
+    def train_step():
+        with tf.GradientTape() as tape:
+            _, log_p, logdet = model(image_batch, training=True)
+            loss = bits_per_dim_loss(log_p, logdet, n_pixels)[0]
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        return loss
+
+    def sample():
+        return model.reverse(z_sample, reconstruct=False)
+
+    for name, fn in [
+        ("likelihood", likelihood),
+        ("train step", train_step),
+        ("sample", sample),
+    ]:
+        if fn is sample and args.kernel_cache:
+            # frozen inference mode, training=True calls raise while it is enabled
+            model.set_kernel_cache(True)
+        eager = images_per_second(fn, args.batch_size, args.num_steps)
+        graph = images_per_second(tf.function(fn), args.batch_size, args.num_steps)
+        print(
+            f"{name}: eager {eager:.2f} images/s, tf.function {graph:.2f} images/s "
+            f"({graph / eager:.2f}x)"
+        )
@@ -1,3 +1,4 @@
+import abc
 import os
 
 import tensorflow as tf
@@ -5,14 +6,45 @@ import numpy as np
 from scipy.linalg import lu as lu_decomposition
 
 
+"""
+Layers do not read tensor values on the host, so the model can be wrapped in tf.function. Pass
+check_numerics=True to check log determinants and log probabilities for NaN/Inf with tf.debugging, which
+raises an InvalidArgumentError naming the layer.
+
+As in the PyTorch reference (reference_papers/glow/model.py), layers return their log determinants with their
+outputs, and Glow returns z_list, log_p and logdet of each image, so that the loss is computed from the outputs
+of the model, see bits_per_dim_loss.
+"""
+
+
 def logabs(x):
     return tf.math.log(tf.abs(x))
 
 
+def bits_per_dim_loss(log_p, logdet, num_pixels, n_bits=8):
+    """
+    Negative log likelihood of quantized images in bits per dimension, as calc_loss of
+    reference_papers/glow/train.py
+    :param log_p: log prior probability of z_list for each image, output of Glow
+    :param logdet: log determinant for each image, output of Glow
+    :param num_pixels: height * width * channels of images
+    :param n_bits: number of bits of quantized images, 2 ** n_bits bins
+    :return: loss, log_p and logdet in bits per dimension, averaged over the batch
+    """
+    scale = np.log(2.0) * num_pixels
+    loss = np.log(2.0 ** n_bits) * num_pixels - logdet - log_p
+    return (
+        tf.reduce_mean(loss / scale),
+        tf.reduce_mean(log_p / scale),
+        tf.reduce_mean(logdet / scale),
+    )
+
+
 class ActNorm(tf.keras.layers.Layer):
-    def __init__(self, in_channels, **kwargs):
+    def __init__(self, in_channels, check_numerics=False, **kwargs):
         super(ActNorm, self).__init__(**kwargs)
         self.in_channels = in_channels
+        self.check_numerics = check_numerics
         self.scale = self.add_weight(
             shape=(1, 1, 1, in_channels),
             trainable=True,
@@ -25,9 +57,13 @@ class ActNorm(tf.keras.layers.Layer):
             initializer="zeros",
             name="bias",
         )
-        self.initialized = False
+        # weight instead of python flag, so that data dependent initialization is done once in graph mode
+        # and is not repeated after restoring from a checkpoint. 1 if initialized, 0 otherwise
+        self.initialized = self.add_weight(
+            shape=(), trainable=False, initializer="zeros", name="initialized"
+        )
 
-    def initialize(self, inputs: tf.Tensor) -> None:
+    def initialize(self, inputs: tf.Tensor) -> tf.Tensor:
         self.bias.assign(
             -tf.reshape(
                 tf.reduce_mean(inputs, axis=[0, 1, 2]),
@@ -40,22 +76,22 @@ class ActNorm(tf.keras.layers.Layer):
                 shape=(1, 1, 1, inputs.shape[-1]),
             )
         )
-        self.initialized = True
+        self.initialized.assign(1.0)
+        return tf.constant(True)
 
     def call(self, inputs, training=False, **kwargs):
-        if not self.initialized:
-            self.initialize(inputs)
-        if training:
-            height = tf.cast(tf.shape(inputs)[1], dtype=tf.float32)
-            width = tf.cast(tf.shape(inputs)[2], dtype=tf.float32)
-            logdet = height * width * tf.reduce_sum(logabs(self.scale))
-            self.add_loss(logdet)
-            if tf.math.is_nan(logdet).numpy():
-                print(
-                    f"NAN in ActNorm layer!  height: {height.numpy()}, width: {width.numpy()}, scale: {self.scale.numpy()}"
-                )
-                exit()
-
+        tf.cond(
+            self.initialized > 0,
+            lambda: tf.constant(False),
+            lambda: self.initialize(inputs),
+        )
+        height = tf.cast(tf.shape(inputs)[1], dtype=tf.float32)
+        width = tf.cast(tf.shape(inputs)[2], dtype=tf.float32)
+        logdet = height * width * tf.reduce_sum(logabs(self.scale))
+        if self.check_numerics:
+            logdet = tf.debugging.check_numerics(
+                logdet, f"NAN in ActNorm layer {self.name}"
+            )
         return self.scale * (inputs + self.bias), logdet
 
     def reverse(self, inputs):
@@ -63,61 +99,165 @@ class ActNorm(tf.keras.layers.Layer):
 
     def get_config(self):
         config = super(ActNorm, self).get_config()
-        config.update({"in_channels": self.in_channels})
+        config.update(
+            {"in_channels": self.in_channels, "check_numerics": self.check_numerics}
+        )
         return config
 
 
-class Invertible1x1Conv(tf.keras.layers.Layer):
-    def __init__(self, in_channels, **kwargs):
+class CachedKernelLayer(tf.keras.layers.Layer, metaclass=abc.ABCMeta):
+    def __init__(self, in_channels, check_numerics=False, **kwargs):
         """
-        1x1 conv layer with random rotation matrix initialization
+        Base of invertible 1x1 conv layers. With use_kernel_cache, forward and inverse kernels are read from
+        non-trainable variables instead of being computed from the weights on every call. The kernel cache is a
+        frozen inference mode: the cache is not updated when weights change, so calls with training=True raise
+        while it is enabled. A copy of the weights the cache was computed from is kept, see refresh_kernel_cache.
         :param in_channels:
+        :param check_numerics: if True, logdet is checked for NaN/Inf
         :param kwargs:
         """
-        super(Invertible1x1Conv, self).__init__(**kwargs)
+        super(CachedKernelLayer, self).__init__(**kwargs)
         self.in_channels = in_channels
-        W = tf.random.normal((in_channels, in_channels), dtype=tf.float32)
-        q, r = tf.linalg.qr(W)
-        self.kernel = tf.Variable(initial_value=q, trainable=True, name="1x1_kernel")
+        self.check_numerics = check_numerics
+        self.use_kernel_cache = False
 
-    def call(self, inputs, training=None, **kwargs):
-        if training:
-            height = tf.cast(tf.shape(inputs)[1], dtype=tf.float32)
-            width = tf.cast(tf.shape(inputs)[2], dtype=tf.float32)
-            logdet = height * width * tf.linalg.slogdet(self.kernel)[1]
-            self.add_loss(logdet)
-            if any(tf.math.is_nan(logdet).numpy()):
-                print(
-                    f"NAN in Invertible1x1Conv layer!  height: {height.numpy()}, width: {width.numpy()}, kernel: {self.kernel.numpy()}"
-                )
-                exit()
+    def build_kernel_cache(self):
+        num_weights = sum(int(np.prod(w.shape)) for w in self.get_kernel_weights())
+        self.kernel_cache = tf.Variable(
+            initial_value=tf.zeros((self.in_channels, self.in_channels)),
+            trainable=False,
+            name="kernel_cache",
+        )
+        self.inverse_kernel_cache = tf.Variable(
+            initial_value=tf.zeros((self.in_channels, self.in_channels)),
+            trainable=False,
+            name="inverse_kernel_cache",
+        )
+        # all zeros never matches the weights of an invertible kernel, so a new cache is always stale
+        self.cached_weights = tf.Variable(
+            initial_value=tf.zeros((num_weights,)),
+            trainable=False,
+            name="cached_weights",
+        )
+
+    @abc.abstractmethod
+    def get_kernel_weights(self):
+        pass
+
+    @abc.abstractmethod
+    def calc_kernel(self):
+        pass
+
+    @abc.abstractmethod
+    def calc_inverse_kernel(self):
+        pass
+
+    @abc.abstractmethod
+    def calc_logdet(self, inputs):
+        pass
+
+    def flatten_kernel_weights(self):
+        return tf.concat([tf.reshape(w, [-1]) for w in self.get_kernel_weights()], 0)
 
+    def refresh_kernel_cache(self, force=False):
+        """
+        Computes cached kernels again if the weights differ from the weights they were computed from
+        :param force: if True, kernels are computed without comparing weights
+        :return: True if the cache was computed again
+        """
+        weights = self.flatten_kernel_weights()
+        if not force and bool(tf.reduce_all(tf.equal(self.cached_weights, weights))):
+            return False
+        self.kernel_cache.assign(self.calc_kernel())
+        self.inverse_kernel_cache.assign(self.calc_inverse_kernel())
+        self.cached_weights.assign(weights)
+        return True
+
+    def set_kernel_cache(self, enabled=True):
+        """
+        Enables or disables kernel cache, refreshing it when enabled. Set it before wrapping the model in
+        tf.function, the flag is read at tracing time. Weights must not change while it is enabled, call
+        refresh_kernel_cache after restoring a checkpoint.
+        :param enabled:
+        """
+        self.use_kernel_cache = enabled
+        if enabled:
+            self.refresh_kernel_cache()
+
+    def conv(self, inputs, kernel):
         return tf.nn.conv2d(
             input=inputs,
-            filters=tf.reshape(self.kernel, (1, 1, self.in_channels, self.in_channels)),
+            filters=tf.reshape(kernel, (1, 1, self.in_channels, self.in_channels)),
             strides=1,
             padding="SAME",
         )
 
+    def call(self, inputs, training=None, **kwargs):
+        if self.use_kernel_cache and training:
+            raise RuntimeError(
+                f"{self.name} is called with training=True while kernel cache is enabled, cached kernels "
+                f"would not follow weight updates. Disable it with set_kernel_cache(False) before training"
+            )
+        logdet = self.calc_logdet(inputs)
+        if self.check_numerics:
+            logdet = tf.debugging.check_numerics(
+                logdet, f"NAN in {type(self).__name__} layer {self.name}"
+            )
+        if self.use_kernel_cache:
+            kernel = self.kernel_cache
+        else:
+            kernel = self.calc_kernel()
+        return self.conv(inputs, kernel), logdet
+
     def reverse(self, inputs):
-        inv_kernel = tf.linalg.inv(self.kernel)
-        return tf.nn.conv2d(
-            input=inputs,
-            filters=tf.reshape(inv_kernel, (1, 1, self.in_channels, self.in_channels)),
-            strides=1,
-            padding="SAME",
-        )
+        if self.use_kernel_cache:
+            inverse_kernel = self.inverse_kernel_cache
+        else:
+            inverse_kernel = self.calc_inverse_kernel()
+        return self.conv(inputs, inverse_kernel)
 
     def get_config(self):
-        config = super(Invertible1x1Conv, self).get_config()
-        config.update({"in_channels": self.in_channels})
+        config = super(CachedKernelLayer, self).get_config()
+        config.update(
+            {"in_channels": self.in_channels, "check_numerics": self.check_numerics}
+        )
         return config
 
 
-class Invertible1x1ConvLU(tf.keras.layers.Layer):
-    def __init__(self, in_channels, **kwargs):
-        super().__init__(**kwargs)
-        self.in_channels = in_channels
+class Invertible1x1Conv(CachedKernelLayer):
+    def __init__(self, in_channels, check_numerics=False, **kwargs):
+        """
+        1x1 conv layer with random rotation matrix initialization
+        :param in_channels:
+        :param check_numerics: if True, logdet is checked for NaN/Inf
+        :param kwargs:
+        """
+        super(Invertible1x1Conv, self).__init__(
+            in_channels, check_numerics=check_numerics, **kwargs
+        )
+        W = tf.random.normal((in_channels, in_channels), dtype=tf.float32)
+        q, r = tf.linalg.qr(W)
+        self.kernel = tf.Variable(initial_value=q, trainable=True, name="1x1_kernel")
+        self.build_kernel_cache()
+
+    def get_kernel_weights(self):
+        return [self.kernel]
+
+    def calc_kernel(self):
+        return self.kernel
+
+    def calc_inverse_kernel(self):
+        return tf.linalg.inv(self.kernel)
+
+    def calc_logdet(self, inputs):
+        height = tf.cast(tf.shape(inputs)[1], dtype=tf.float32)
+        width = tf.cast(tf.shape(inputs)[2], dtype=tf.float32)
+        return height * width * tf.linalg.slogdet(self.kernel)[1]
+
+
+class Invertible1x1ConvLU(CachedKernelLayer):
+    def __init__(self, in_channels, check_numerics=False, **kwargs):
+        super().__init__(in_channels, check_numerics=check_numerics, **kwargs)
         W = np.random.rand(in_channels, in_channels)
         q, r = np.linalg.qr(W)
         p, l, u = lu_decomposition(q)
@@ -154,54 +294,43 @@ class Invertible1x1ConvLU(tf.keras.layers.Layer):
             name="eye",
             trainable=False,
         )
+        self.build_kernel_cache()
 
-    def calc_kernel(self):
-        return (
-            self.p
-            @ (self.l * self.l_mask + self.eye)
-            @ (self.u * self.u_mask + tf.linalg.diag(self.s_sign * tf.exp(self.log_s)))
-        )
+    def get_kernel_weights(self):
+        # p and s_sign are not trained but they are restored from checkpoints
+        return [self.p, self.l, self.u, self.s_sign, self.log_s]
 
-    def call(self, inputs, training=None, **kwargs):
-        kernel = self.calc_kernel()
-        if training:
-            height = tf.cast(tf.shape(inputs)[1], dtype=tf.float32)
-            width = tf.cast(tf.shape(inputs)[2], dtype=tf.float32)
-            logdet = height * width * tf.reduce_sum(self.log_s)
-            self.add_loss(logdet)
-            if tf.math.is_nan(logdet).numpy():
-                print(
-                    f"NAN in Invertible1x1ConvLU layer!  height: {height.numpy()}, width: {width.numpy()}, scale: {self.s.numpy()}"
-                )
-                exit()
+    def calc_lower(self):
+        return self.l * self.l_mask + self.eye
 
-        return tf.nn.conv2d(
-            input=inputs,
-            filters=tf.reshape(kernel, (1, 1, self.in_channels, self.in_channels)),
-            strides=1,
-            padding="SAME",
-        )
+    def calc_upper(self):
+        return self.u * self.u_mask + tf.linalg.diag(self.s_sign * tf.exp(self.log_s))
 
-    def reverse(self, inputs):
-        kernel = self.calc_kernel()
-        inv_kernel = tf.linalg.inv(kernel)
-        return tf.nn.conv2d(
-            input=inputs,
-            filters=tf.reshape(inv_kernel, (1, 1, self.in_channels, self.in_channels)),
-            strides=1,
-            padding="SAME",
+    def calc_kernel(self):
+        return self.p @ self.calc_lower() @ self.calc_upper()
+
+    def calc_inverse_kernel(self):
+        # (P L U)^-1 = U^-1 L^-1 P^T, with two triangular solves instead of a dense inverse
+        inverse_kernel = tf.linalg.triangular_solve(
+            self.calc_lower(), tf.transpose(self.p), lower=True
+        )
+        return tf.linalg.triangular_solve(
+            self.calc_upper(), inverse_kernel, lower=False
         )
 
-    def get_config(self):
-        config = super(Invertible1x1ConvLU, self).get_config()
-        config.update({"in_channels": self.in_channels})
-        return config
+    def calc_logdet(self, inputs):
+        height = tf.cast(tf.shape(inputs)[1], dtype=tf.float32)
+        width = tf.cast(tf.shape(inputs)[2], dtype=tf.float32)
+        return height * width * tf.reduce_sum(self.log_s)
 
 
 class AffineCouling(tf.keras.layers.Layer):
-    def __init__(self, num_filters, in_channels, affine=True, **kwargs):
+    def __init__(
+        self, num_filters, in_channels, affine=True, check_numerics=False, **kwargs
+    ):
         super(AffineCouling, self).__init__(**kwargs)
         self.affine = affine
+        self.check_numerics = check_numerics
         self.num_filters = num_filters
         self.in_channels = in_channels
         self.net = tf.keras.models.Sequential(
@@ -248,13 +377,13 @@ class AffineCouling(tf.keras.layers.Layer):
             y_a = s * (x_a + t)
             y_b = x_b
             y = tf.concat([y_a, y_b], axis=-1)
-            if training:
-                self.add_loss(tf.reduce_sum(logs))
-                if any(tf.math.is_nan(logs).numpy().flatten()):
-                    print(f"NAN in AffineCoupling layer!  logs: {logs.numpy()}")
-                    exit()
-
-            return y
+            # log of the applied scale sigmoid(logs + 2), for each image
+            logdet = tf.reduce_sum(tf.math.log_sigmoid(logs + 2), axis=[1, 2, 3])
+            if self.check_numerics:
+                logdet = tf.debugging.check_numerics(
+                    logdet, f"NAN in AffineCoupling layer {self.name}"
+                )
+            return y, logdet
         else:
             logs, t = tf.split(
                 self.net(x_b, training=training), num_or_size_splits=2, axis=-1
@@ -262,7 +391,7 @@ class AffineCouling(tf.keras.layers.Layer):
             y_a = x_a + t
             y_b = x_b
             y = tf.concat([y_a, y_b], axis=-1)
-            return y
+            return y, tf.zeros_like(inputs[:, 0, 0, 0])
 
     def reverse(self, inputs):
         x_a, x_b = tf.split(inputs, num_or_size_splits=2, axis=-1)
@@ -293,6 +422,7 @@ class AffineCouling(tf.keras.layers.Layer):
                 "num_filters": self.num_filters,
                 "in_channels": self.in_channels,
                 "affine": self.affine,
+                "check_numerics": self.check_numerics,
             }
         )
         return config
@@ -300,27 +430,41 @@ class AffineCouling(tf.keras.layers.Layer):
 
 class Flow(tf.keras.layers.Layer):
     def __init__(
-        self, in_channels, num_filters=512, use_lu_decom=True, affine=True, **kwargs
+        self,
+        in_channels,
+        num_filters=512,
+        use_lu_decom=True,
+        affine=True,
+        check_numerics=False,
+        **kwargs,
     ):
         super(Flow, self).__init__(**kwargs)
         self.affine = affine
         self.use_lu_decom = use_lu_decom
         self.num_filters = num_filters
         self.in_channels = in_channels
-        self.actnorm = ActNorm(in_channels)
+        self.check_numerics = check_numerics
+        self.actnorm = ActNorm(in_channels, check_numerics=check_numerics)
         if use_lu_decom:
-            self.invertible_conv = Invertible1x1ConvLU(in_channels)
+            self.invertible_conv = Invertible1x1ConvLU(
+                in_channels, check_numerics=check_numerics
+            )
         else:
-            self.invertible_conv = Invertible1x1Conv(in_channels)
+            self.invertible_conv = Invertible1x1Conv(
+                in_channels, check_numerics=check_numerics
+            )
         self.affine_coupling = AffineCouling(
-            num_filters=num_filters, in_channels=in_channels, affine=affine
+            num_filters=num_filters,
+            in_channels=in_channels,
+            affine=affine,
+            check_numerics=check_numerics,
         )
 
     def call(self, inputs, training=None, **kwargs):
-        x = self.actnorm(inputs, training=training)
-        x = self.invertible_conv(x, training=training)
-        x = self.affine_coupling(x, training=training)
-        return x
+        x, logdet = self.actnorm(inputs, training=training)
+        x, det1 = self.invertible_conv(x, training=training)
+        x, det2 = self.affine_coupling(x, training=training)
+        return x, logdet + det1 + det2
 
     def reverse(self, inputs):
         x = self.affine_coupling.reverse(inputs)
@@ -336,6 +480,7 @@ class Flow(tf.keras.layers.Layer):
                 "num_filters": self.num_filters,
                 "use_lu_decom": self.use_lu_decom,
                 "affine": self.affine,
+                "check_numerics": self.check_numerics,
             }
         )
         return config
@@ -359,6 +504,7 @@ class Block(tf.keras.layers.Layer):
         use_lu_decom=True,
         affine=True,
         split=True,
+        check_numerics=False,
         **kwargs,
     ):
         super(Block, self).__init__(**kwargs)
@@ -369,12 +515,14 @@ class Block(tf.keras.layers.Layer):
         self.use_lu_decom = use_lu_decom
         self.affine = affine
         self.split = split
+        self.check_numerics = check_numerics
         self.flows = [
             Flow(
                 in_channels=self.squeeze_dim,
                 num_filters=num_filters,
                 use_lu_decom=use_lu_decom,
                 affine=affine,
+                check_numerics=check_numerics,
             )
             for _ in range(num_flows)
         ]
@@ -406,40 +554,31 @@ class Block(tf.keras.layers.Layer):
         self.out_shape = [input_shape[1] // 2, input_shape[2] // 2, self.out_channels]
 
     def call(self, inputs, training=None):
-        batch_size, height, width, channels = tf.shape(inputs).numpy()
-        x = tf.reshape(inputs, [batch_size, height // 2, 2, width // 2, 2, channels])
-        x = tf.transpose(x, [0, 1, 3, 2, 4, 5])
-        x = tf.reshape(x, [batch_size, height // 2, width // 2, channels * 4])
+        """
+        :return: out, logdet, log_p, new_z where logdet and log_p are sums for each image
+        """
+        # squeeze, 2x2 patches to channels
+        x = tf.nn.space_to_depth(inputs, block_size=2)
+        logdet = 0.0
         for flow in self.flows:
-            x = flow(x, training=training)
+            x, det = flow(x, training=training)
+            logdet = logdet + det
         if self.split:
             out, new_z = tf.split(x, num_or_size_splits=2, axis=-1)
-            if training:
-                mean, log_sd = tf.split(
-                    self.prior(out, training=training), num_or_size_splits=2, axis=-1
-                )
-                log_p = gaussian_log_p(new_z, mean, log_sd)
-                self.add_loss(tf.reduce_sum(log_p))
-                if any(tf.math.is_nan(log_p).numpy().flatten()):
-                    print(f"NAN in Block layer!  logp: {log_p.numpy()}")
-                    exit()
-
+            prior_input = out
         else:
             new_z = x
             out = x
-            if training:
-                mean, log_sd = tf.split(
-                    self.prior(tf.zeros_like(new_z), training=training),
-                    num_or_size_splits=2,
-                    axis=-1,
-                )
-                log_p = gaussian_log_p(new_z, mean, log_sd)
-                self.add_loss(tf.reduce_sum(log_p))
-                if any(tf.math.is_nan(log_p).numpy().flatten()):
-                    print(f"NAN in Block layer!  height: {log_p.numpy()}")
-                    exit()
-
-        return out, new_z
+            prior_input = tf.zeros_like(new_z)
+        mean, log_sd = tf.split(
+            self.prior(prior_input, training=training), num_or_size_splits=2, axis=-1
+        )
+        log_p = tf.reduce_sum(gaussian_log_p(new_z, mean, log_sd), axis=[1, 2, 3])
+        if self.check_numerics:
+            log_p = tf.debugging.check_numerics(
+                log_p, f"NAN in Block layer {self.name}"
+            )
+        return out, logdet, log_p, new_z
 
     def reverse(self, inputs, z=None, reconstruct=True):
         if self.split:
@@ -452,11 +591,8 @@ class Block(tf.keras.layers.Layer):
             x = inputs
         for flow in reversed(self.flows):
             x = flow.reverse(x)
-        batch_size, height, width, channels = tf.shape(x).numpy()
-        x = tf.reshape(x, [batch_size, height, width, 2, 2, channels // 4])
-        x = tf.transpose(x, [0, 1, 3, 2, 4, 5])
-        x = tf.reshape(x, [batch_size, height * 2, width * 2, channels // 4])
-        return x
+        # unsqueeze, channels to 2x2 patches
+        return tf.nn.depth_to_space(x, block_size=2)
 
     def get_apriori_distribution(self, inputs):
         """
@@ -495,6 +631,7 @@ class Block(tf.keras.layers.Layer):
                 "use_lu_decom": self.use_lu_decom,
                 "affine": self.affine,
                 "split": self.split,
+                "check_numerics": self.check_numerics,
             }
         )
         return config
@@ -510,6 +647,7 @@ class Glow(tf.keras.Model):
         use_lu_decom=True,
         affine=True,
         split=True,
+        check_numerics=False,
         **kwargs,
     ):
         super(Glow, self).__init__(**kwargs)
@@ -520,6 +658,7 @@ class Glow(tf.keras.Model):
         self.use_lu_decom = use_lu_decom
         self.affine = affine
         self.split = split
+        self.check_numerics = check_numerics
         self.blocks = []
         self.block_in_channels = []
         self.block_output_shapes = []
@@ -531,6 +670,7 @@ class Glow(tf.keras.Model):
                 use_lu_decom=use_lu_decom,
                 affine=affine,
                 split=split,
+                check_numerics=check_numerics,
             )
             self.blocks.append(block)
             self.block_in_channels.append(in_channels)
@@ -542,19 +682,29 @@ class Glow(tf.keras.Model):
             use_lu_decom=use_lu_decom,
             affine=affine,
             split=False,
+            check_numerics=check_numerics,
         )
         self.blocks.append(block)
         self.block_in_channels.append(in_channels)
 
     def call(self, inputs, training=None, mask=None):
+        """
+        :param inputs: images
+        :return: z_list, log_p, logdet where log_p is the log prior probability of z_list and logdet is the log
+        determinant of the flow, one for each image
+        """
         out = inputs
         z_outs = []
+        log_p_sum = 0.0
+        logdet = 0.0
         for block in self.blocks:
-            out, new_z = block(out, training=training)
+            out, det, log_p, new_z = block(out, training=training)
             if block.split:
                 z_outs.append(new_z)
+            logdet = logdet + det
+            log_p_sum = log_p_sum + log_p
         z_outs.append(out)
-        return z_outs
+        return z_outs, log_p_sum, logdet
 
     def reverse(self, z_list, reconstruct=True):
         out = z_list[-1]
@@ -567,6 +717,32 @@ class Glow(tf.keras.Model):
             out = block.reverse(inputs=out, z=z, reconstruct=reconstruct)
         return out
 
+    def get_invertible_convs(self):
+        return [flow.invertible_conv for block in self.blocks for flow in block.flows]
+
+    def set_kernel_cache(self, enabled=True):
+        """
+        Frozen inference mode for sampling and latent space interpolation. Forward and inverse 1x1 conv kernels
+        of all flows are precomputed, and reverse and calls with training=False use them instead of computing them
+        from the weights. Calls with training=True raise while it is enabled. Set it before wrapping the model
+        in tf.function.
+        :param enabled: if False, kernels are computed from the weights on every call
+        """
+        for layer in self.get_invertible_convs():
+            layer.set_kernel_cache(enabled)
+
+    def refresh_kernel_cache(self, force=False):
+        """
+        Computes cached kernels of the layers whose weights changed since the cache was computed, e.g. after
+        restoring a checkpoint while the kernel cache is enabled
+        :param force: if True, all kernels are computed without comparing weights
+        :return: number of layers with a new cache
+        """
+        return sum(
+            layer.refresh_kernel_cache(force=force)
+            for layer in self.get_invertible_convs()
+        )
+
     def flatten_z_list(self, z_list):
         flattened = []
         for z in z_list:
@@ -579,11 +755,12 @@ class Glow(tf.keras.Model):
             self.blocks[-1].out_shape
         ]
         z_sizes = [s[0] * s[1] * s[2] for s in z_shapes]
-        batch_size, z_size = tf.shape(z).numpy()
-        assert z_size == sum(z_sizes)
+        if z.shape[-1] is not None:
+            assert z.shape[-1] == sum(z_sizes)
+        batch_size = tf.shape(z)[0]
         z_list = tf.split(z, num_or_size_splits=z_sizes, axis=-1)
         for i in range(len(z_list)):
-            z_list[i] = tf.reshape(z_list[i], [batch_size] + z_shapes[i])
+            z_list[i] = tf.reshape(z_list[i], [batch_size] + list(z_shapes[i]))
         return z_list
 
     def get_config(self):
@@ -595,6 +772,7 @@ class Glow(tf.keras.Model):
             "use_lu_decom": self.use_lu_decom,
             "affine": self.affine,
             "split": self.split,
+            "check_numerics": self.check_numerics,
         }
 
 
@@ -605,11 +783,9 @@ if __name__ == "__main__":
     outputs, logdet = layer(input_tensor, training=True)
     print("first pass")
     print("logdet: ", logdet)
-    print("losses collected: ", layer.losses)
     outputs, logdet = layer(input_tensor, training=True)
     print("second pass")
     print("logdet: ", logdet)
-    print("losses collected: ", layer.losses)
     back = layer.reverse(outputs)
     # print("inputs: ", input_tensor.numpy())
     # print("outputs: ", outputs.numpy())
@@ -620,7 +796,6 @@ if __name__ == "__main__":
     outputs, logdet = layer(input_tensor, training=True)
     print("third pass")
     print("logdet: ", logdet)
-    print("losses collected: ", layer.losses)
     back = layer.reverse(outputs)
     # print("inputs: ", input_tensor.numpy())
     # print("outputs: ", outputs.numpy())
@@ -680,11 +855,10 @@ if __name__ == "__main__":
     input_tensor = tf.convert_to_tensor(
         np.random.rand(1, 64, 64, 1) * 127 + 127, dtype=tf.float32
     )
-    outputs = glow(input_tensor, training=True)
-    outputs = glow(input_tensor, training=True)
-    print("losses collected: ")
-    for l in glow.losses:
-        print(l)
+    outputs, log_p, logdet = glow(input_tensor, training=True)
+    outputs, log_p, logdet = glow(input_tensor, training=True)
+    print("log_p: ", log_p)
+    print("logdet: ", logdet)
     exit()
     print("")
     print("inputs: ", input_tensor)
@@ -739,9 +913,9 @@ if __name__ == "__main__":
 
     exit()
     input_tensor = tf.convert_to_tensor(np.random.rand(1, 2, 2, 3), dtype=tf.float32)
-    outputs = l(input_tensor, training=True)
+    outputs, logdet = l(input_tensor, training=True)
 
-    print("losses collected: ", l.losses)
+    print("logdet: ", logdet)
     print("input tensor: ", input_tensor)
     print("outputs: ", outputs)
     back = l.reverse(outputs)
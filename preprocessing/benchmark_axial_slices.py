@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from preprocessing.benchmark_registration import make_volume
+from preprocessing.utils import get_axial_cortex_slices
+
+"""
+Speed of get_axial_cortex_slices against its former per-voxel and per-slice loop implementation,
+on a synthetic volume. Outputs of both are compared as well.
+
+python -m preprocessing.benchmark_axial_slices --size 256 --num_slices 70
+"""
+
+parser = argparse.ArgumentParser(description="Axial slice extraction benchmark")
+parser.add_argument("--size", default=256, type=int, help="volume size in voxels")
+parser.add_argument("--start_offset", default=75, type=int)
+parser.add_argument("--num_slices", default=70, type=int)
+parser.add_argument("--repeats", default=3, type=int)
+
+
+def get_axial_cortex_slices_loop(
+    img_data,
+    start_offset=30,
+    stop_offset=100,
+    step=5,
+    resampled_slice_shape=None,
+    shape_after_padding=None,
+):
+    # former implementation, kept for reference
+    mid_slice_index = img_data.shape[2] // 2
+    slicing_pattern_image = img_data[:, :, mid_slice_index]
+    slicing_pattern_image = np.stack(
+        (slicing_pattern_image, slicing_pattern_image, slicing_pattern_image), axis=-1
+    )
+    slice_index_stop = min(stop_offset, img_data.shape[2])
+    roi = img_data[start_offset:slice_index_stop, :, :]
+    threshold_adapted_mean = 20
+    nice_points = np.asarray([x for x in roi.flatten() if x > threshold_adapted_mean])
+    adapted_mean = nice_points.mean()
+    adapted_std = np.std(nice_points)
+    max_clipping_value = adapted_mean + 1.8 * adapted_std
+    slicing_pattern_image = (
+        255 * np.clip(slicing_pattern_image, 0, max_clipping_value) / max_clipping_value
+    )
+    slicing_pattern_image[start_offset, :, 0] = 255
+    processed_slices = []
+    for index in range(start_offset, slice_index_stop, step):
+        slice = img_data[index, :, :]
+        processed_slice = np.clip(slice, 0, max_clipping_value)
+        processed_slice = cv2.resize(
+            processed_slice, (resampled_slice_shape[1], resampled_slice_shape[0])
+        )
+        if shape_after_padding is not None:
+            desired_height, desired_width = shape_after_padding
+            pad_height = max(0, desired_height - processed_slice.shape[0])
+            pad_width = max(0, desired_width - processed_slice.shape[1])
+            processed_slice = np.pad(
+                processed_slice,
+                [
+                    (int(pad_height / 2), pad_height - int(pad_height / 2)),
+                    (int(pad_width / 2), pad_width - int(pad_width / 2)),
+                ],
+            )
+        processed_slice = np.asarray(processed_slice / max_clipping_value)
+        processed_slices.append(processed_slice)
+        slicing_pattern_image[index, :, 1] += 100
+    slicing_pattern_image = np.clip(slicing_pattern_image, 0, 255).astype(np.uint8)
+    return processed_slices, slicing_pattern_image
+
+
+def timeit(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        result = fn()
+        times.append(time.time() - start)
+    return result, min(times)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    volume = make_volume(args.size)
+    kwargs = dict(
+        start_offset=args.start_offset,
+        stop_offset=args.start_offset + args.num_slices,
+        step=1,
+        resampled_slice_shape=[int(args.size * 0.94), int(args.size * 0.94)],
+        shape_after_padding=(300, 300),
+    )
+    (loop_slices, loop_pattern), loop_time = timeit(
+        lambda: get_axial_cortex_slices_loop(volume, **kwargs), args.repeats
+    )
+    (slices, pattern), time_vectorized = timeit(
+        lambda: get_axial_cortex_slices(volume, **kwargs), args.repeats
+    )
+    max_diff = max(np.abs(x - y).max() for x, y in zip(loop_slices, slices))
+    print(f"loop: {loop_time:.3f} s, vectorized: {time_vectorized:.3f} s")
+    print(f"speedup: {loop_time / time_vectorized:.1f}x")
+    print(
+        f"max slice difference: {max_diff:.2e}, "
+        f"pattern images equal: {np.array_equal(loop_pattern, pattern)}"
+    )
@@ -0,0 +1,125 @@
+import argparse
+import os
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+from dipy.align.imaffine import AffineMap
+from scipy import ndimage
+
+from preprocessing.utils import rigid_body_registration
+
+"""
+Time versus accuracy of rigid_body_registration settings on a synthetic volume pair, where the moving
+volume is the static volume moved by a known rigid transform. Error is the mean distance in mm between
+voxel positions mapped by the true and the estimated transforms.
+
+python -m preprocessing.benchmark_registration --size 96
+"""
+
+parser = argparse.ArgumentParser(description="Rigid registration benchmark")
+parser.add_argument("--size", default=96, type=int, help="volume size in voxels")
+parser.add_argument("--angle", default=4.0, type=float, help="rotation in degrees")
+parser.add_argument(
+    "--shift", default=[4.0, -3.0, 2.0], type=float, nargs=3, help="shift in mm"
+)
+
+SETTINGS = {
+    "default": {},
+    "tolerance 1e-7": {"tolerance": 1e-7},
+    "tolerance 1e-6": {"tolerance": 1e-6},
+    "sampling 0.25": {"sampling_prop": 0.25},
+    "tolerance 1e-6, no translation stage": {
+        "tolerance": 1e-6,
+        "translation_stage": False,
+    },
+    "sampling 0.25, no translation stage": {
+        "sampling_prop": 0.25,
+        "translation_stage": False,
+    },
+}
+
+
+def make_volume(size, seed=0):
+    """
+    Smooth random blobs inside an ellipsoid, asymmetric enough for rotations to be recovered
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.mgrid[:size, :size, :size] / size - 0.5
+    head = ((grid / np.array([0.4, 0.35, 0.3])[:, None, None, None]) ** 2).sum(0) < 1
+    texture = ndimage.gaussian_filter(rng.random((size,) * 3), size / 24)
+    volume = head * (100 + 400 * (texture - texture.min()) / np.ptp(texture))
+    return ndimage.gaussian_filter(volume, 1.0)
+
+
+def rigid_matrix(angle, shift, center):
+    angle = np.deg2rad(angle)
+    rotation = np.array(
+        [
+            [np.cos(angle), -np.sin(angle), 0],
+            [np.sin(angle), np.cos(angle), 0],
+            [0, 0, 1],
+        ]
+    )
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = center - rotation.dot(center) + np.array(shift)
+    return matrix
+
+
+def mean_error(true_matrix, estimated_matrix, size):
+    points = np.stack(
+        np.meshgrid(*[np.linspace(0, size - 1, 10)] * 3, indexing="ij"), -1
+    ).reshape(-1, 3)
+    points = np.concatenate([points, np.ones((len(points), 1))], 1)
+    diff = points.dot(true_matrix.T) - points.dot(estimated_matrix.T)
+    return np.linalg.norm(diff[:, :3], axis=1).mean()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    size = args.size
+    static = make_volume(size)
+    true_matrix = rigid_matrix(args.angle, args.shift, np.array([size / 2] * 3))
+    # moving(x) = static(true_matrix^-1 x), so registration should recover true_matrix
+    moving = AffineMap(
+        np.linalg.inv(true_matrix),
+        domain_grid_shape=(size,) * 3,
+        domain_grid2world=np.eye(4),
+        codomain_grid_shape=(size,) * 3,
+        codomain_grid2world=np.eye(4),
+    ).transform(static)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        static_path = os.path.join(tmp_dir, "static.nii")
+        moving_path = os.path.join(tmp_dir, "moving.nii")
+        nib.save(nib.Nifti1Image(static, np.eye(4)), static_path)
+        nib.save(nib.Nifti1Image(moving, np.eye(4)), moving_path)
+
+        for name, kwargs in SETTINGS.items():
+            start = time.time()
+            _, rigid, info = rigid_body_registration(
+                static_path, moving_path, return_info=True, **kwargs
+            )
+            elapsed = time.time() - start
+            print(
+                f"{name}: {elapsed:.2f} s, {info['n_metric_evaluations']} metric evaluations, "
+                f"mean error {mean_error(true_matrix, rigid.affine, size):.3f} mm"
+            )
+
+        transform_path = os.path.join(tmp_dir, "moving_rigid.npz")
+        for name in ["transform saved", "transform reused"]:
+            start = time.time()
+            _, rigid, info = rigid_body_registration(
+                static_path,
+                moving_path,
+                return_info=True,
+                sampling_prop=0.25,
+                transform_path=transform_path,
+            )
+            elapsed = time.time() - start
+            print(
+                f"{name}: {elapsed:.2f} s, "
+                f"mean error {mean_error(true_matrix, rigid.affine, size):.3f} mm"
+            )
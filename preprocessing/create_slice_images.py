@@ -1,41 +1,28 @@
+import argparse
 import csv
 import os
 import glob
-import sys
+import functools
+import multiprocessing
+import time
 
 import cv2
 import numpy as np
-import pandas as pd
-import imageio
-import nibabel as nib
-import logging
-
-
-# Create a custom logger
-from preprocessing.utils import get_axial_cortex_slices, crop_patient_slices
-
-# logging.root.setLevel(logging.DEBUG)
-# logger = logging.getLogger(__name__)
-
-
-# # Create handlers
-# c_handler = logging.StreamHandler()
-# f_handler = logging.FileHandler("../logs/log_create_slice_images.log")
-# c_handler.setLevel(logging.DEBUG)
-# f_handler.setLevel(logging.DEBUG)
-#
-# # Create formatters and add it to handlers
-# c_format = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
-# f_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-# c_handler.setFormatter(c_format)
-# f_handler.setFormatter(f_format)
-#
-# # Add handlers to the logger
-# logger.addHandler(c_handler)
-# logger.addHandler(f_handler)
-#
-# logger.info("merhaba")
 
+from preprocessing.fused_slice_pipeline import (
+    crop_slices,
+    get_scan_image_path,
+    read_slicing_csv,
+)
+from preprocessing.utils import (
+    get_axial_cortex_slices,
+    crop_patient_slices,
+    get_head_top_slicing,
+    get_numpy_orientation,
+    get_patient_condition,
+    load_volume,
+    save_slices,
+)
 
 """
 Create slice images from .nii files using a given range for slice index.
@@ -50,9 +37,20 @@ Set the following parameters
     - saved_image_data_type: 'uint8' or 'uint16'
     - show_results: If true, shows each slices after extraction
     - shape_after_padding: If true and slice is smaller than given shape, pads the slice image with zero
-    
+
 PS: get_axial_cortex_slices function also performs intensity correction for slices using mean and standard deviation
 of intensities in the region of interest.
+
+Interactive mode (default) shows slices of each patient to adjust offsets (w/s, o to accept) and the crop window,
+and records them to the slicing index csv file. --num_slices and --step_size set the slicing range in both modes.
+
+Batch mode (--batch) runs without GUI in worker processes. Offsets and crop windows are read from the slicing index
+csv file. Patients that are not in it are skipped, or with --auto_offsets, sliced starting --head_top_offset slices
+below the top of the head found by find_upper_tangent_line_to_head_in_3d_mri with a centered crop window.
+Completed patients are recorded in manifest.csv in target_dir, which has the columns of the slicing index csv file,
+and are skipped when the script is run again.
+
+python -m preprocessing.create_slice_images --batch --auto_offsets --workers 8 --target_dir /path/to/new_dataset
 """
 
 # Set the following parameters
@@ -77,71 +75,42 @@ slicing_index_csv_file = os.path.join(
     os.path.dirname(target_dir), "processed_data_15T_192x160_4slices.csv"
 )
 
-# Condition of patients
-dataset_info = pd.read_csv(dataset_info_pth)
-patient_condition = dict()
-for item in dataset_info[["Subject", "Group"]].drop_duplicates("Subject").values:
-    patient_condition[item[0]] = item[1]
-
-# Patient folder paths
-patients = sorted(glob.glob(os.path.join(dataset_dir, "*")))
-
-# If target dir does not exist, create dir
-if not os.path.isdir(target_dir):
-    os.makedirs(target_dir)
-
-
-def save_slices(slices, dir_path, dtype="uint8", slicing_pattern_image=None):
-    for i in range(len(slices)):
-        pth = os.path.join(dir_path, "slice_{:03d}".format(i) + ".png")
-        if dtype == "uint16":
-            slice = np.asarray(slices[i] * (2 ** 16 - 1), dtype=np.uint16)
-        else:
-            slice = np.asarray(slices[i] * (2 ** 8 - 1), dtype=np.uint8)
-        imageio.imwrite(pth, slice)
-    # logger.info("%d slices were written to %s", len(slices), dir_path)
-
-    if slicing_pattern_image is not None:
-        pth = os.path.join(dir_path, "summary_slicing_pattern.png")
-        imageio.imwrite(pth, slicing_pattern_image)
-        # logger.info("Slicing pattern image was written to %s", pth)
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = [
+    "patient_name",
+    "start_index",
+    "stop_index",
+    "step_size",
+    "crop_indexes",
+    "crop_shape",
+    "offset_source",
+    "n_scans",
+]
 
 
 def get_numpy_image(img):
     # get numpy correctted dimension order image from nibabel image format Nifti1....
-    img_data = img.get_fdata()
-    img_data = np.array(img_data)
-    img_data = np.flip(img_data, axis=0)
-    img_data = np.flip(img_data, axis=1)
-    img_data = np.flip(img_data, axis=2)
-    img_data = np.transpose(img_data, (2, 1, 0))
-
-    return img_data
+    # flips and transpose are views of float32 image data
+    img_data = img.get_fdata(dtype=np.float32, caching="unchanged")
+    return get_numpy_orientation(img_data)
 
 
 def add_row_to_csv_file(
-    patient_name, start_index, stop_index, step_size, crop_indexes, crop_shape,
+    patient_name,
+    start_index,
+    stop_index,
+    step_size,
+    crop_indexes,
+    crop_shape,
+    csv_file_path=None,
 ):
-    if os.path.isfile(slicing_index_csv_file):
-        with open(slicing_index_csv_file, mode="a") as file:
-            csv_writer = csv.writer(
-                file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
-            )
-            csv_writer.writerow(
-                [
-                    patient_name,
-                    str(start_index),
-                    str(stop_index),
-                    str(step_size),
-                    str(crop_indexes),
-                    str(crop_shape),
-                ]
-            )
-    else:
-        with open(slicing_index_csv_file, mode="w") as file:
-            csv_writer = csv.writer(
-                file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
-            )
+    csv_file_path = csv_file_path or slicing_index_csv_file
+    write_header = not os.path.isfile(csv_file_path)
+    with open(csv_file_path, mode="a") as file:
+        csv_writer = csv.writer(
+            file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
+        )
+        if write_header:
             csv_writer.writerow(
                 [
                     "patient_name",
@@ -152,16 +121,16 @@ def add_row_to_csv_file(
                     "crop_shape",
                 ]
             )
-            csv_writer.writerow(
-                [
-                    patient_name,
-                    str(start_index),
-                    str(stop_index),
-                    str(step_size),
-                    str(crop_indexes),
-                    str(crop_shape),
-                ]
-            )
+        csv_writer.writerow(
+            [
+                patient_name,
+                str(start_index),
+                str(stop_index),
+                str(step_size),
+                str(crop_indexes),
+                str(crop_shape),
+            ]
+        )
 
 
 def get_voxel_sizes(mri):
@@ -174,161 +143,423 @@ def get_resampled_mri_shape(mri_shape, voxel_sizes):
     return resampled_shape
 
 
-idx = 349
-while idx < len(patients):
-    # for idx in range(len(patients)):
-    patient = patients[idx]
-    patient_name = os.path.basename(patient)
-    print("{} / {}  {}".format(idx + 1, len(patients), patient_name))
-    # logger.info("Starting slicing for new patient (%s)", os.path.basename(patient))
+def run_interactive(
+    dataset_dir,
+    dataset_info_pth,
+    target_dir,
+    slicing_index_csv_file,
+    first_index=0,
+    num_slices=num_slices,
+    step_size=step_size,
+):
+    global start_offset, stop_offset
+    stop_offset = start_offset + num_slices * step_size
 
-    # Create new patient dir if not exists
-    target_patient_dir = os.path.join(
-        os.path.join(target_dir, patient_condition[patient_name]), patient_name
-    )
-    if not os.path.isdir(target_patient_dir):
-        os.makedirs(target_patient_dir)
-
-    # Date folders in patient dir
-    dates = sorted(glob.glob(os.path.join(patient, "*")))
-
-    # Baseline image folder path
-    baseline = dates[0]
-
-    # Target date dir where slices will be saved
-    target_date_dir = os.path.join(target_patient_dir, os.path.basename(baseline))
-    if not os.path.isdir(target_date_dir):
-        os.makedirs(target_date_dir)
-
-    if os.listdir(target_date_dir):
-        # logger.info(
-        #     "Already processed this patient {}, continuing".format(patient_name)
-        # )
-        d = input(
-            "Already processed this patient {}, continuing? (y/n)".format(patient_name)
+    patient_condition = get_patient_condition(dataset_info_pth)
+
+    # Patient folder paths
+    patients = sorted(glob.glob(os.path.join(dataset_dir, "*")))
+
+    # If target dir does not exist, create dir
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+
+    idx = first_index
+    while idx < len(patients):
+        patient = patients[idx]
+        patient_name = os.path.basename(patient)
+        print("{} / {}  {}".format(idx + 1, len(patients), patient_name))
+
+        # Create new patient dir if not exists
+        target_patient_dir = os.path.join(
+            os.path.join(target_dir, patient_condition[patient_name]), patient_name
         )
-        if d in ["y", "Y", "yes", "Yes"]:
-            idx += 1
-            continue
+        if not os.path.isdir(target_patient_dir):
+            os.makedirs(target_patient_dir)
 
-    # logger.info("Working on image from %s", os.path.basename(baseline))
+        # Date folders in patient dir
+        dates = sorted(glob.glob(os.path.join(patient, "*")))
 
-    # Baseline image path
-    baseline_img_pth = glob.glob(os.path.join(baseline, "[!resampled]*.nii"))[0]
+        # Baseline image folder path
+        baseline = dates[0]
 
-    # Baseline image
-    baseline_img = nib.load(baseline_img_pth)
-    # baseline_img_data = get_numpy_image(baseline_img)
-    baseline_img_data = baseline_img.get_fdata()
-    voxel_sizes = get_voxel_sizes(baseline_img)
-    mri_shape = baseline_img.shape
-    resampled_mri_shape = get_resampled_mri_shape(
-        mri_shape=mri_shape, voxel_sizes=voxel_sizes
-    )
-    resampled_slice_shape = resampled_mri_shape[1:3]
-    print("resampled shape is {}".format(resampled_slice_shape))
-    print("mri shape: {}".format(mri_shape))
-    print("voxel sizes: {}".format(voxel_sizes))
+        # Target date dir where slices will be saved
+        target_date_dir = os.path.join(target_patient_dir, os.path.basename(baseline))
+        if not os.path.isdir(target_date_dir):
+            os.makedirs(target_date_dir)
+
+        if os.listdir(target_date_dir):
+            d = input(
+                "Already processed this patient {}, continuing? (y/n)".format(
+                    patient_name
+                )
+            )
+            if d in ["y", "Y", "yes", "Yes"]:
+                idx += 1
+                continue
+
+        # Baseline image path
+        baseline_img_pth = glob.glob(os.path.join(baseline, "[!resampled]*.nii"))[0]
+
+        # Baseline image
+        baseline_img, baseline_img_data = load_volume(baseline_img_pth)
+        # baseline_img_data = get_numpy_image(baseline_img)
+        voxel_sizes = get_voxel_sizes(baseline_img)
+        mri_shape = baseline_img.shape
+        resampled_mri_shape = get_resampled_mri_shape(
+            mri_shape=mri_shape, voxel_sizes=voxel_sizes
+        )
+        resampled_slice_shape = resampled_mri_shape[1:3]
+        print("resampled shape is {}".format(resampled_slice_shape))
+        print("mri shape: {}".format(mri_shape))
+        print("voxel sizes: {}".format(voxel_sizes))
+
+        cv2.namedWindow("slices")
+        cv2.moveWindow("slices", 20, 20)
+
+        cv2.namedWindow("slicing pattern")
+        cv2.moveWindow("slicing pattern", 500, 400)
+
+        pressed_key = 0
+        while pressed_key != ord("o"):
+            # Extract slices from the baseline image
+            (
+                processed_slices,
+                slicing_pattern_image,
+            ) = get_axial_cortex_slices(
+                baseline_img_data,
+                start_offset=start_offset,
+                stop_offset=stop_offset,
+                step=step_size,
+                resampled_slice_shape=resampled_slice_shape,
+                shape_after_padding=shape_after_padding,
+                show_results=show_results,
+            )
+            seq = np.hstack([x for x in processed_slices])
+            cv2.imshow("slices", seq)
+            cv2.imshow("slicing pattern", slicing_pattern_image)
+            pressed_key = cv2.waitKey()
+
+            if pressed_key == ord("w"):
+                start_offset -= 1
+                stop_offset -= 1
+            if pressed_key == ord("s"):
+                start_offset += 1
+                stop_offset += 1
+            if pressed_key == ord("q"):
+                exit()
+
+        # Save extracted slices to target date dir
+        save_slices(
+            processed_slices,
+            target_date_dir,
+            dtype=saved_image_data_type,
+            slicing_pattern_image=slicing_pattern_image,
+        )
+
+        # Follow-up scan folders (other date folders)
+        follow_ups = dates[1:]
+
+        for follow_up in follow_ups:
+            follow_up_img_pth = glob.glob(os.path.join(follow_up, "reg*.nii"))[0]
+            follow_up_img, follow_up_img_data = load_volume(
+                follow_up_img_pth, use_cache=False
+            )
+            # follow_up_img_data = get_numpy_image(follow_up_img)
+
+            (
+                follow_up_processed_slices,
+                follow_up_slicing_pattern_image,
+            ) = get_axial_cortex_slices(
+                follow_up_img_data,
+                start_offset=start_offset,
+                stop_offset=stop_offset,
+                step=step_size,
+                resampled_slice_shape=resampled_slice_shape,
+                shape_after_padding=shape_after_padding,
+                show_results=show_results,
+            )
 
-    cv2.namedWindow("slices")
-    cv2.moveWindow("slices", 20, 20)
+            # Target date dir where slices will be saved
+            target_date_dir = os.path.join(
+                target_patient_dir, os.path.basename(follow_up)
+            )
+            if not os.path.isdir(target_date_dir):
+                os.makedirs(target_date_dir)
+
+            # Save extracted slices to target date dir
+            save_slices(
+                follow_up_processed_slices,
+                target_date_dir,
+                dtype=saved_image_data_type,
+                slicing_pattern_image=follow_up_slicing_pattern_image,
+            )
 
-    cv2.namedWindow("slicing pattern")
-    cv2.moveWindow("slicing pattern", 500, 400)
+        crop_indexes, crop_shape = crop_patient_slices(
+            target_patient_dir,
+            target_patient_dir,
+            crop_height=shape_after_cropping[0],
+            crop_width=shape_after_cropping[1],
+            source_image_size=shape_after_padding,
+        )
 
-    pressed_key = 0
-    while pressed_key != ord("o"):
-        # Extract slices from the baseline image
-        (processed_slices, slicing_pattern_image,) = get_axial_cortex_slices(
+        # add the chosen start stop indexes for the patient to the csv file for future use
+        add_row_to_csv_file(
+            patient_name=patient_name,
+            start_index=start_offset,
+            stop_index=stop_offset,
+            step_size=step_size,
+            crop_indexes=crop_indexes,
+            crop_shape=crop_shape,
+            csv_file_path=slicing_index_csv_file,
+        )
+
+        idx += 1
+
+
+def slice_patient(
+    patient_folder,
+    target_patient_dir,
+    slicing=None,
+    head_top_offset=30,
+    num_slices=4,
+    step_size=1,
+    shape_after_padding=(300, 300),
+    shape_after_cropping=(192, 160),
+    dtype="uint8",
+):
+    """
+    Slices and crops baseline image and registered follow-up images of a patient without GUI
+
+    :param patient_folder: folder with date folders, first one is the baseline
+    :param target_patient_dir: slices of each scan are written to its date folder in this folder
+    :param slicing: {start_offset, stop_offset, step_size, crop_indexes, crop_shape} from the slicing index csv
+    file, if None offsets are found from the top of the head in baseline image and crop window is centered
+    :param head_top_offset: first slice index relative to the slice touching top of the head, if slicing is None
+    :param num_slices: number of slices, if slicing is None
+    :param step_size: sampling interval, if slicing is None
+    :param shape_after_padding: (height, width) slices are padded to before cropping
+    :param shape_after_cropping: (height, width) of centered crop window, if slicing is None
+    :param dtype: "uint8" or "uint16"
+    :return: manifest row, see MANIFEST_COLUMNS
+    """
+    dates = sorted(glob.glob(os.path.join(patient_folder, "*")))
+    baseline_img_pth = get_scan_image_path(dates[0])
+    baseline_img, baseline_img_data = load_volume(baseline_img_pth)
+    resampled_slice_shape = get_resampled_mri_shape(
+        mri_shape=baseline_img.shape, voxel_sizes=get_voxel_sizes(baseline_img)
+    )[1:3]
+
+    if slicing is None:
+        slicing = get_head_top_slicing(
             baseline_img_data,
-            start_offset=start_offset,
-            stop_offset=stop_offset,
-            step=step_size,
-            resampled_slice_shape=resampled_slice_shape,
-            shape_after_padding=shape_after_padding,
-            show_results=show_results,
+            head_top_offset=head_top_offset,
+            num_slices=num_slices,
+            step_size=step_size,
+            crop_shape=shape_after_cropping,
         )
-        seq = np.hstack(
-            [
-                # cv2.resize(x, (x.shape[0] // 2, x.shape[1] // 2))
-                x
-                for x in processed_slices
-            ]
+        offset_source = "auto"
+    else:
+        offset_source = "csv"
+    crop_indexes = slicing["crop_indexes"]
+    if crop_indexes is None:
+        crop_indexes = (
+            int((shape_after_padding[0] - slicing["crop_shape"][0]) / 2),
+            int((shape_after_padding[1] - slicing["crop_shape"][1]) / 2),
         )
-        cv2.imshow("slices", seq)
-        cv2.imshow("slicing pattern", slicing_pattern_image)
-        pressed_key = cv2.waitKey()
-
-        if pressed_key == ord("w"):
-            start_offset -= 1
-            stop_offset -= 1
-        if pressed_key == ord("s"):
-            start_offset += 1
-            stop_offset += 1
-        if pressed_key == ord("q"):
-            exit()
-
-    # Save extracted slices to target date dir
-    save_slices(
-        processed_slices,
-        target_date_dir,
-        dtype=saved_image_data_type,
-        slicing_pattern_image=slicing_pattern_image,
-    )
 
-    # Follow-up scan folders (other date folders)
-    follow_ups = dates[1:]
-
-    for follow_up in follow_ups:
-        # logger.info("Working on image from %s", os.path.basename(follow_up))
-
-        follow_up_img_pth = glob.glob(os.path.join(follow_up, "reg*.nii"))[0]
-        follow_up_img = nib.load(follow_up_img_pth)
-        # follow_up_img_data = get_numpy_image(follow_up_img)
-        follow_up_img_data = follow_up_img.get_fdata()
-
-        (
-            follow_up_processed_slices,
-            follow_up_slicing_pattern_image,
-        ) = get_axial_cortex_slices(
-            follow_up_img_data,
-            start_offset=start_offset,
-            stop_offset=stop_offset,
-            step=step_size,
+    for date in dates:
+        if date == dates[0]:
+            img_data = baseline_img_data
+        else:
+            _, img_data = load_volume(
+                glob.glob(os.path.join(date, "reg*.nii"))[0], use_cache=False
+            )
+        processed_slices, slicing_pattern_image = get_axial_cortex_slices(
+            img_data,
+            start_offset=slicing["start_offset"],
+            stop_offset=slicing["stop_offset"],
+            step=slicing["step_size"],
             resampled_slice_shape=resampled_slice_shape,
             shape_after_padding=shape_after_padding,
-            show_results=show_results,
         )
-
-        # Target date dir where slices will be saved
-        target_date_dir = os.path.join(target_patient_dir, os.path.basename(follow_up))
+        processed_slices = crop_slices(
+            processed_slices,
+            shape_after_padding,
+            crop_indexes=crop_indexes,
+            crop_shape=slicing["crop_shape"],
+        )
+        target_date_dir = os.path.join(target_patient_dir, os.path.basename(date))
         if not os.path.isdir(target_date_dir):
             os.makedirs(target_date_dir)
-
-        # Save extracted slices to target date dir
         save_slices(
-            follow_up_processed_slices,
+            processed_slices,
             target_date_dir,
-            dtype=saved_image_data_type,
-            slicing_pattern_image=follow_up_slicing_pattern_image,
+            dtype=dtype,
+            slicing_pattern_image=slicing_pattern_image,
         )
 
-    crop_indexes, crop_shape = crop_patient_slices(
-        target_patient_dir,
-        target_patient_dir,
-        crop_height=shape_after_cropping[0],
-        crop_width=shape_after_cropping[1],
-        source_image_size=shape_after_padding,
+    return {
+        "patient_name": os.path.basename(patient_folder),
+        "start_index": slicing["start_offset"],
+        "stop_index": slicing["stop_offset"],
+        "step_size": slicing["step_size"],
+        "crop_indexes": tuple(crop_indexes),
+        "crop_shape": tuple(slicing["crop_shape"]),
+        "offset_source": offset_source,
+        "n_scans": len(dates),
+    }
+
+
+def _slice_patient_job(job, **kwargs):
+    patient_folder, target_patient_dir, slicing = job
+    try:
+        return (
+            slice_patient(patient_folder, target_patient_dir, slicing, **kwargs),
+            None,
+        )
+    except Exception as e:
+        return os.path.basename(patient_folder), repr(e)
+
+
+def read_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path) as csv_file:
+        return {row["patient_name"]: row for row in csv.DictReader(csv_file)}
+
+
+def append_to_manifest(manifest_path, row):
+    write_header = not os.path.isfile(manifest_path)
+    with open(manifest_path, mode="a") as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=MANIFEST_COLUMNS)
+        if write_header:
+            csv_writer.writeheader()
+        csv_writer.writerow({k: str(v) for k, v in row.items()})
+
+
+def run_batch(
+    dataset_dir,
+    dataset_info_pth,
+    target_dir,
+    slicing_index_csv_file,
+    auto_offsets=False,
+    workers=None,
+    **kwargs
+):
+    """
+    Slices all patients without GUI in worker processes, see slice_patient
+
+    :param dataset_dir: folder with patient folders
+    :param dataset_info_pth: csv file with Subject and Group columns
+    :param target_dir: output folder, slices are written to target_dir/<group>/<patient>/<date>
+    :param slicing_index_csv_file: offsets and crop windows of patients
+    :param auto_offsets: if True, patients that are not in slicing index csv file are sliced using head top
+    detection, otherwise they are skipped
+    :param workers: number of processes, defaults to cpu count
+    :param kwargs: see slice_patient
+    :return: number of patients sliced
+    """
+    patient_condition = get_patient_condition(dataset_info_pth)
+    patient_slicing = read_slicing_csv(slicing_index_csv_file)
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    manifest_path = os.path.join(target_dir, MANIFEST_NAME)
+    done = read_manifest(manifest_path)
+
+    jobs = []
+    for patient in sorted(glob.glob(os.path.join(dataset_dir, "*"))):
+        patient_name = os.path.basename(patient)
+        if patient_name in done:
+            continue
+        if patient_name not in patient_condition:
+            print("No group info for {}, skipping".format(patient_name))
+            continue
+        if patient_name not in patient_slicing and not auto_offsets:
+            print("No slicing info for {}, skipping".format(patient_name))
+            continue
+        target_patient_dir = os.path.join(
+            target_dir, patient_condition[patient_name], patient_name
+        )
+        jobs.append((patient, target_patient_dir, patient_slicing.get(patient_name)))
+    print("{} patients to slice, {} patients done before".format(len(jobs), len(done)))
+    if not jobs:
+        return 0
+
+    n_done = 0
+    start_time = time.time()
+    workers = workers or os.cpu_count()
+    with multiprocessing.Pool(processes=min(workers, len(jobs))) as pool:
+        for result, error in pool.imap_unordered(
+            functools.partial(_slice_patient_job, **kwargs), jobs
+        ):
+            if error:
+                print("{} failed: {}".format(result, error))
+                continue
+            append_to_manifest(manifest_path, result)
+            n_done += 1
+            print(
+                "{} / {}  {}  ({} offsets {}-{})".format(
+                    n_done,
+                    len(jobs),
+                    result["patient_name"],
+                    result["offset_source"],
+                    result["start_index"],
+                    result["stop_index"],
+                )
+            )
+    print("{} patients sliced in {:.1f} s".format(n_done, time.time() - start_time))
+    return n_done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create slice images from MRIs")
+    parser.add_argument("--dataset_dir", default=dataset_dir)
+    parser.add_argument("--dataset_info_pth", default=dataset_info_pth)
+    parser.add_argument("--target_dir", default=target_dir)
+    parser.add_argument("--slicing_index_csv_file", default=slicing_index_csv_file)
+    parser.add_argument(
+        "--first_index", default=0, type=int, help="first patient, interactive mode"
     )
-
-    # add the chosen start stop indexes for the patient to the csv file for future use
-    add_row_to_csv_file(
-        patient_name=patient_name,
-        start_index=start_offset,
-        stop_index=stop_offset,
-        step_size=step_size,
-        crop_indexes=crop_indexes,
-        crop_shape=crop_shape,
+    parser.add_argument("--batch", action="store_true", help="run without GUI")
+    parser.add_argument(
+        "--auto_offsets",
+        action="store_true",
+        help="find offsets of patients not in slicing index csv from top of the head",
     )
-
-    idx += 1
+    parser.add_argument(
+        "--head_top_offset",
+        default=30,
+        type=int,
+        help="first slice relative to top of the head, with --auto_offsets",
+    )
+    parser.add_argument("--num_slices", default=num_slices, type=int)
+    parser.add_argument("--step_size", default=step_size, type=int)
+    parser.add_argument("--workers", default=None, type=int, help="processes")
+    args = parser.parse_args()
+
+    if args.batch:
+        run_batch(
+            args.dataset_dir,
+            args.dataset_info_pth,
+            args.target_dir,
+            args.slicing_index_csv_file,
+            auto_offsets=args.auto_offsets,
+            workers=args.workers,
+            head_top_offset=args.head_top_offset,
+            num_slices=args.num_slices,
+            step_size=args.step_size,
+            shape_after_padding=shape_after_padding,
+            shape_after_cropping=shape_after_cropping,
+            dtype=saved_image_data_type,
+        )
+    else:
+        run_interactive(
+            args.dataset_dir,
+            args.dataset_info_pth,
+            args.target_dir,
+            args.slicing_index_csv_file,
+            first_index=args.first_index,
+            num_slices=args.num_slices,
+            step_size=args.step_size,
+        )
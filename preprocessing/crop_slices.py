@@ -1,57 +1,176 @@
+import argparse
 import glob
 import os
-import random
-import shutil
-from shutil import copytree
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import cv2
-import imageio
+from preprocessing.fused_slice_pipeline import read_slicing_csv
+from preprocessing.utils import apply_patient_crop, crop_patient_slices
 
 """
-Splits processed dataset into train, val, test folders
-Adds ad/mci/cn prefixes to patient folders accordingly
-Set the params below
+Crops slice images of processed dataset (AD, MCI, CN folders of patient folders) and saves them in a new dataset
+folder named with the crop size.
+
+Without --slicing_index_csv_file, crop window of every patient is chosen in the cropping tool of
+crop_patient_slices. With it, crop windows recorded in the slicing csv of create_slice_images.py are applied
+to all patients without GUI, reading and writing slices in a thread pool. If --target_image_size differs from
+the recorded crop shape, the window is resized around its center, so the dataset can be cropped to a new shape.
+
+python -m preprocessing.crop_slices --slicing_index_csv_file /path/to/slicing.csv --target_image_size 192 160
 """
-# --------------------
-# set following params
-raw_dataset = "/Volumes/SAMSUNG/umut/thesis/processed_data_15T_256x256_4slices"
-processed_dataset = (
-    "/Volumes/SAMSUNG/umut/thesis/cropped_processed_data_15T_256x256_4slices"
-)
-
-source_image_size = (256, 256)
-target_image_size = (192, 160)
-# --------------------
-
-processed_dataset = (
-    processed_dataset
-    + "_"
-    + str(target_image_size[0])
-    + "x"
-    + str(target_image_size[1])
-)
-
-crop_height = target_image_size[0]
-crop_width = target_image_size[1]
-
-
-def process_disease_folder(source_folder, target_folder):
+
+PATIENT_TYPES = ["AD", "MCI", "CN"]
+
+
+def get_crop_window(crop_indexes, crop_shape, new_crop_shape, source_image_size):
+    """
+    Crop window of new_crop_shape with the same center as the recorded window, moved inside the image if needed
+
+    :param crop_indexes: (row, col) of recorded crop window
+    :param crop_shape: (height, width) of recorded crop window
+    :param new_crop_shape: (height, width) of new crop window
+    :param source_image_size: (height, width) of images to crop
+    :return: (row, col) of new crop window
+    """
+    crop_indexes = [
+        int(index + (size - new_size) / 2)
+        for index, size, new_size in zip(crop_indexes, crop_shape, new_crop_shape)
+    ]
+    return tuple(
+        min(max(index, 0), image_size - new_size)
+        for index, new_size, image_size in zip(
+            crop_indexes, new_crop_shape, source_image_size
+        )
+    )
+
+
+def crop_dataset(
+    raw_dataset,
+    processed_dataset,
+    slicing_index_csv_file,
+    source_image_size=(256, 256),
+    target_image_size=None,
+    workers=8,
+):
+    """
+    Crops all patients with crop windows from slicing csv
+
+    :param raw_dataset: dataset folder with AD, MCI and CN folders
+    :param processed_dataset: folder cropped patients are written to, with the same structure
+    :param slicing_index_csv_file: slicing csv of create_slice_images.py
+    :param source_image_size: (height, width) of slices in raw_dataset
+    :param target_image_size: (height, width) of cropped slices, recorded crop shape of each patient if None
+    :param workers: number of threads reading, cropping and writing slices
+    :return: number of cropped patients, list of patients without crop window in slicing csv
+    """
+    slicing = read_slicing_csv(slicing_index_csv_file)
+    start_time = time.time()
+    n_patients = 0
+    n_slices = 0
+    missing = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for patient_type in PATIENT_TYPES:
+            patient_folders = sorted(
+                glob.glob(os.path.join(raw_dataset, patient_type, "*"))
+            )
+            for patient_folder in patient_folders:
+                patient_name = os.path.basename(patient_folder)
+                if patient_name not in slicing:
+                    missing.append(patient_name)
+                    continue
+                crop_indexes = slicing[patient_name]["crop_indexes"]
+                crop_shape = slicing[patient_name]["crop_shape"]
+                if target_image_size and tuple(target_image_size) != crop_shape:
+                    crop_indexes = get_crop_window(
+                        crop_indexes, crop_shape, target_image_size, source_image_size
+                    )
+                    crop_shape = tuple(target_image_size)
+                n_slices += apply_patient_crop(
+                    patient_folder,
+                    os.path.join(processed_dataset, patient_type, patient_name),
+                    crop_indexes,
+                    crop_shape,
+                    executor=executor,
+                )
+                n_patients += 1
+                elapsed = time.time() - start_time
+                print(
+                    "{} patient {} cropped ({} patients, {:.0f} slices/s)".format(
+                        patient_type, patient_name, n_patients, n_slices / elapsed
+                    )
+                )
+    if missing:
+        print(
+            "{} patients are not in slicing csv and skipped: {}".format(
+                len(missing), ", ".join(missing)
+            )
+        )
+    return n_patients, missing
+
+
+def process_disease_folder(
+    source_folder, target_folder, crop_height, crop_width, source_image_size
+):
     patient_folders = sorted(glob.glob(os.path.join(source_folder, "*")))
     patient_type = os.path.basename(source_folder)
     for patient_folder in patient_folders:
         patient_name = os.path.basename(patient_folder)
         print("Processing {}...".format(patient_name))
         target_patient_folder = os.path.join(target_folder, patient_name)
-        crop_patient_slices(patient_folder, target_patient_folder)
+        crop_patient_slices(
+            patient_folder,
+            target_patient_folder,
+            crop_height=crop_height,
+            crop_width=crop_width,
+            source_image_size=source_image_size,
+        )
         print("{} patient {} completed".format(patient_type, patient_name))
 
 
-process_disease_folder(
-    os.path.join(raw_dataset, "AD"), os.path.join(processed_dataset, "AD")
-)
-process_disease_folder(
-    os.path.join(raw_dataset, "MCI"), os.path.join(processed_dataset, "MCI")
-)
-process_disease_folder(
-    os.path.join(raw_dataset, "CN"), os.path.join(processed_dataset, "CN")
-)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crop slice images")
+    parser.add_argument(
+        "--raw_dataset",
+        default="/Volumes/SAMSUNG/umut/thesis/processed_data_15T_256x256_4slices",
+    )
+    parser.add_argument(
+        "--processed_dataset",
+        default="/Volumes/SAMSUNG/umut/thesis/cropped_processed_data_15T_256x256_4slices",
+        help="crop size is appended to the folder name",
+    )
+    parser.add_argument(
+        "--slicing_index_csv_file",
+        default=None,
+        help="apply crop windows of this csv without GUI",
+    )
+    parser.add_argument("--source_image_size", default=[256, 256], type=int, nargs=2)
+    parser.add_argument("--target_image_size", default=[192, 160], type=int, nargs=2)
+    parser.add_argument("--workers", default=8, type=int, help="threads")
+    args = parser.parse_args()
+
+    processed_dataset = (
+        args.processed_dataset
+        + "_"
+        + str(args.target_image_size[0])
+        + "x"
+        + str(args.target_image_size[1])
+    )
+
+    if args.slicing_index_csv_file:
+        crop_dataset(
+            args.raw_dataset,
+            processed_dataset,
+            args.slicing_index_csv_file,
+            source_image_size=tuple(args.source_image_size),
+            target_image_size=tuple(args.target_image_size),
+            workers=args.workers,
+        )
+    else:
+        for patient_type in PATIENT_TYPES:
+            process_disease_folder(
+                os.path.join(args.raw_dataset, patient_type),
+                os.path.join(processed_dataset, patient_type),
+                crop_height=args.target_image_size[0],
+                crop_width=args.target_image_size[1],
+                source_image_size=tuple(args.source_image_size),
+            )
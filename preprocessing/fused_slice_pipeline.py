@@ -0,0 +1,385 @@
+import argparse
+import ast
+import csv
+import functools
+import glob
+import multiprocessing
+import os
+import time
+
+import nibabel as nib
+
+from preprocessing.utils import (
+    get_axial_cortex_slices,
+    get_head_top_slicing,
+    get_patient_condition,
+    get_registration_parameters,
+    get_transform_path,
+    get_voxel_affine,
+    is_transform_up_to_date,
+    load_affine_map,
+    load_volume,
+    register_volumes,
+    resample_to_slice_grid,
+    save_affine_map,
+    save_slices,
+)
+
+"""
+Registration, resampling and slicing of MRIs in a single pass, instead of
+register_mris_to_baseline_image.py -> resample_images.py -> create_slice_images.py.
+Each .nii file is read once. Follow-ups are registered to the baseline in memory (or the rigid transform is
+read from its sidecar file), and the rigid transform and the resizing of axial slices to 1mm pixels are done in
+a single interpolation. Slices are extracted with get_axial_cortex_slices, cropped and written as PNG files,
+which are the only outputs unless --keep_intermediates is given.
+
+Slicing offsets and crop windows of patients are read from the slicing csv file written by
+create_slice_images.py. Other patients are sliced like batch mode of create_slice_images.py with --auto_offsets,
+starting --head_top_offset slices below the top of the head in the baseline image, with a centered crop window.
+
+python -m preprocessing.fused_slice_pipeline --dataset_dir /path/to/adni_15T --dataset_info_pth info.csv
+    --target_dir /path/to/processed_data --slicing_index_csv_file processed_data.csv --workers 4
+"""
+
+
+def read_slicing_csv(slicing_index_csv_file):
+    """
+    Reads slicing offsets and crop windows chosen in create_slice_images.py
+
+    :param slicing_index_csv_file: csv with patient_name, start_index, stop_index, step_size, crop_indexes,
+    crop_shape columns
+    :return: {patient_name: {start_offset, stop_offset, step_size, crop_indexes, crop_shape}}
+    """
+    slicing = {}
+    if not slicing_index_csv_file or not os.path.isfile(slicing_index_csv_file):
+        return slicing
+    with open(slicing_index_csv_file) as csv_file:
+        for row in csv.DictReader(csv_file):
+            slicing[row["patient_name"]] = {
+                "start_offset": int(row["start_index"]),
+                "stop_offset": int(row["stop_index"]),
+                "step_size": int(row["step_size"]),
+                "crop_indexes": tuple(ast.literal_eval(row["crop_indexes"])),
+                "crop_shape": tuple(ast.literal_eval(row["crop_shape"])),
+            }
+    return slicing
+
+
+def get_scan_image_path(scan_folder):
+    """
+    Original image of a scan folder, registered and resampled versions are ignored
+    """
+    paths = [
+        x
+        for x in sorted(glob.glob(os.path.join(scan_folder, "*.nii")))
+        if not os.path.basename(x).startswith(("reg_", "resampled_", "."))
+    ]
+    return paths[0] if paths else None
+
+
+def get_resampled_slice_shape(img):
+    # axial slices of 1mm x 1mm pixels, as in create_slice_images.py
+    voxel_sizes = img.header["pixdim"][1:4]
+    return [int(float(x) * float(y)) for x, y in zip(img.shape, voxel_sizes)][1:3]
+
+
+def crop_slices(slices, shape_after_padding, crop_indexes=None, crop_shape=(192, 160)):
+    """
+    Crops slices like crop_patient_slices, with a centered crop window if crop_indexes is None
+    """
+    if crop_indexes is None:
+        crop_indexes = (
+            int((shape_after_padding[0] - crop_shape[0]) / 2),
+            int((shape_after_padding[1] - crop_shape[1]) / 2),
+        )
+    row, col = crop_indexes
+    return [x[row : row + crop_shape[0], col : col + crop_shape[1]] for x in slices]
+
+
+def process_patient(
+    patient_folder,
+    target_patient_dir,
+    slicing,
+    shape_after_padding=(300, 300),
+    crop_shape=(192, 160),
+    dtype="uint8",
+    keep_intermediates=False,
+    registration_kwargs=None,
+    head_top_offset=30,
+    num_slices=4,
+    step_size=1,
+):
+    """
+    Registers, resamples, slices and crops all scans of a patient and writes slice PNGs
+
+    :param patient_folder: folder with date folders, first one is the baseline
+    :param target_patient_dir: output folder, slices of each scan are written to its date folder
+    :param slicing: {start_offset, stop_offset, step_size, crop_indexes, crop_shape}, crop_indexes may be None.
+    If slicing is None, it is found from the top of the head in baseline image, see get_head_top_slicing
+    :param shape_after_padding: (height, width) slices are padded to before cropping
+    :param crop_shape: (height, width) of crop window if slicing does not give one
+    :param dtype: "uint8" or "uint16" PNGs
+    :param keep_intermediates: if True, registered follow-ups are also written as reg_*.nii
+    :param registration_kwargs: see preprocessing.utils.register_volumes
+    :param head_top_offset: first slice index relative to the slice touching top of the head, if slicing is None
+    :param num_slices: number of slices, if slicing is None
+    :param step_size: sampling interval, if slicing is None
+    :return: dict with number of scans, seconds spent and bytes read and written
+    """
+    registration_kwargs = registration_kwargs or {}
+    registration_parameters = get_registration_parameters(**registration_kwargs)
+    start_time = time.time()
+    n_bytes_read = 0
+    n_bytes_written = 0
+
+    scan_folders = sorted(glob.glob(os.path.join(patient_folder, "*")))
+    baseline_img_pth = get_scan_image_path(scan_folders[0])
+    baseline_img, baseline_img_data = load_volume(baseline_img_pth)
+    baseline_volume = (baseline_img_data, baseline_img.affine)
+    n_bytes_read += os.path.getsize(baseline_img_pth)
+    resampled_slice_shape = get_resampled_slice_shape(baseline_img)
+    if slicing is None:
+        slicing = get_head_top_slicing(
+            baseline_img_data,
+            head_top_offset=head_top_offset,
+            num_slices=num_slices,
+            step_size=step_size,
+        )
+
+    for scan_folder in scan_folders:
+        scan_img_pth = get_scan_image_path(scan_folder)
+        if scan_img_pth is None:
+            continue
+        if scan_img_pth == baseline_img_pth:
+            moving = baseline_volume[0]
+            voxel_affine = None
+        else:
+            moving_img, moving_img_data = load_volume(scan_img_pth, use_cache=False)
+            moving_volume = (moving_img_data, moving_img.affine)
+            moving = moving_volume[0]
+            n_bytes_read += os.path.getsize(scan_img_pth)
+            transform_path = get_transform_path(scan_img_pth)
+            if is_transform_up_to_date(
+                transform_path,
+                baseline_img_pth,
+                scan_img_pth,
+                parameters=registration_parameters,
+            ):
+                rigid = load_affine_map(transform_path)
+            else:
+                rigid, _ = register_volumes(
+                    baseline_volume, moving_volume, **registration_kwargs
+                )
+                save_affine_map(
+                    rigid, transform_path, parameters=registration_parameters
+                )
+            voxel_affine = get_voxel_affine(rigid)
+            if keep_intermediates:
+                reg_path = os.path.join(
+                    scan_folder, "reg_" + os.path.basename(scan_img_pth)
+                )
+                nib.save(
+                    nib.Nifti1Image(
+                        rigid.transform(moving), baseline_volume[1], moving_img.header
+                    ),
+                    reg_path,
+                )
+                n_bytes_written += os.path.getsize(reg_path)
+
+        # registered and resized in one interpolation, so get_axial_cortex_slices does not resize again
+        resampled = resample_to_slice_grid(
+            moving,
+            baseline_volume[0].shape,
+            resampled_slice_shape,
+            voxel_affine=voxel_affine,
+        )
+        processed_slices, slicing_pattern_image = get_axial_cortex_slices(
+            resampled,
+            start_offset=slicing["start_offset"],
+            stop_offset=slicing["stop_offset"],
+            step=slicing["step_size"],
+            resampled_slice_shape=resampled_slice_shape,
+            shape_after_padding=shape_after_padding,
+        )
+        processed_slices = crop_slices(
+            processed_slices,
+            shape_after_padding,
+            crop_indexes=slicing.get("crop_indexes"),
+            crop_shape=slicing.get("crop_shape") or crop_shape,
+        )
+        target_date_dir = os.path.join(
+            target_patient_dir, os.path.basename(scan_folder)
+        )
+        save_slices(
+            processed_slices,
+            target_date_dir,
+            dtype=dtype,
+            slicing_pattern_image=slicing_pattern_image,
+        )
+        n_bytes_written += sum(
+            os.path.getsize(x)
+            for x in glob.glob(os.path.join(target_date_dir, "*.png"))
+        )
+
+    return {
+        "n_scans": len(scan_folders),
+        "seconds": time.time() - start_time,
+        "bytes_read": n_bytes_read,
+        "bytes_written": n_bytes_written,
+    }
+
+
+def is_patient_done(patient_folder, target_patient_dir):
+    scan_folders = sorted(glob.glob(os.path.join(patient_folder, "*")))
+    return all(
+        glob.glob(os.path.join(target_patient_dir, os.path.basename(x), "slice_*.png"))
+        for x in scan_folders
+    )
+
+
+def _process_patient_job(job, **kwargs):
+    patient_folder, target_patient_dir, slicing = job
+    try:
+        result = process_patient(patient_folder, target_patient_dir, slicing, **kwargs)
+        result["error"] = None
+    except Exception as e:
+        result = {"error": repr(e)}
+    result["patient"] = os.path.basename(patient_folder)
+    return result
+
+
+def run_pipeline(
+    dataset_dir,
+    dataset_info_pth,
+    target_dir,
+    slicing_index_csv_file=None,
+    workers=1,
+    overwrite=False,
+    **kwargs
+):
+    """
+    Processes all patients of dataset_dir into target_dir/<group>/<patient>/<date>/slice_*.png
+
+    :param dataset_dir: folder with patient folders
+    :param dataset_info_pth: csv file with Subject and Group columns
+    :param target_dir: output folder
+    :param slicing_index_csv_file: slicing csv of create_slice_images.py, see read_slicing_csv
+    :param workers: number of processes
+    :param overwrite: if False, patients with slices of all scans are skipped
+    :param kwargs: see process_patient, head_top_offset, num_slices and step_size are used for patients
+    not in slicing csv
+    :return: list of per patient results
+    """
+    patient_condition = get_patient_condition(dataset_info_pth)
+    patient_slicing = read_slicing_csv(slicing_index_csv_file)
+
+    jobs = []
+    for patient_folder in sorted(glob.glob(os.path.join(dataset_dir, "*"))):
+        patient_name = os.path.basename(patient_folder)
+        if patient_name not in patient_condition:
+            print("No group info for {}, skipping".format(patient_name))
+            continue
+        target_patient_dir = os.path.join(
+            target_dir, patient_condition[patient_name], patient_name
+        )
+        if not overwrite and is_patient_done(patient_folder, target_patient_dir):
+            continue
+        if patient_name not in patient_slicing:
+            print(
+                "No slicing info for {}, slicing from top of the head".format(
+                    patient_name
+                )
+            )
+        jobs.append(
+            (
+                patient_folder,
+                target_patient_dir,
+                patient_slicing.get(patient_name),
+            )
+        )
+    print("{} patients to process".format(len(jobs)))
+
+    results = []
+    start_time = time.time()
+    with multiprocessing.Pool(processes=max(1, min(workers, len(jobs)))) as pool:
+        for result in pool.imap_unordered(
+            functools.partial(_process_patient_job, **kwargs), jobs
+        ):
+            results.append(result)
+            if result["error"]:
+                print("{} failed: {}".format(result["patient"], result["error"]))
+            else:
+                print(
+                    "{} / {}  {}  {} scans in {:.1f} s, read {:.1f} MB, wrote {:.2f} MB".format(
+                        len(results),
+                        len(jobs),
+                        result["patient"],
+                        result["n_scans"],
+                        result["seconds"],
+                        result["bytes_read"] / 2 ** 20,
+                        result["bytes_written"] / 2 ** 20,
+                    )
+                )
+    elapsed = time.time() - start_time
+    print("{} patients processed in {:.1f} s".format(len(results), elapsed))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fused registration and slicing")
+    parser.add_argument(
+        "--dataset_dir", default="/Volumes/SAMSUNG/umut/thesis/adni_15T"
+    )
+    parser.add_argument(
+        "--dataset_info_pth",
+        default="/Volumes/SAMSUNG/umut/thesis/ADNI1_Complete_2Yr_1.5T_5_24_2020.csv",
+    )
+    parser.add_argument(
+        "--target_dir",
+        default="/Volumes/SAMSUNG/umut/thesis/processed_data_15T_192x160_4slices",
+    )
+    parser.add_argument(
+        "--slicing_index_csv_file",
+        default="/Volumes/SAMSUNG/umut/thesis/processed_data_15T_192x160_4slices.csv",
+    )
+    parser.add_argument(
+        "--head_top_offset",
+        default=30,
+        type=int,
+        help="first slice relative to top of the head, for patients not in slicing csv",
+    )
+    parser.add_argument("--num_slices", default=4, type=int)
+    parser.add_argument("--step_size", default=1, type=int)
+    parser.add_argument("--shape_after_padding", default=[300, 300], type=int, nargs=2)
+    parser.add_argument("--crop_shape", default=[192, 160], type=int, nargs=2)
+    parser.add_argument("--dtype", default="uint8", help="uint8 or uint16")
+    parser.add_argument("--workers", default=1, type=int, help="processes")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument(
+        "--keep_intermediates",
+        action="store_true",
+        help="also write registered follow-ups as reg_*.nii",
+    )
+    parser.add_argument("--tolerance", default=None, type=float)
+    parser.add_argument("--sampling_prop", default=None, type=float)
+    args = parser.parse_args()
+
+    run_pipeline(
+        args.dataset_dir,
+        args.dataset_info_pth,
+        args.target_dir,
+        slicing_index_csv_file=args.slicing_index_csv_file,
+        head_top_offset=args.head_top_offset,
+        num_slices=args.num_slices,
+        step_size=args.step_size,
+        workers=args.workers,
+        overwrite=args.overwrite,
+        shape_after_padding=tuple(args.shape_after_padding),
+        crop_shape=tuple(args.crop_shape),
+        dtype=args.dtype,
+        keep_intermediates=args.keep_intermediates,
+        registration_kwargs={
+            "tolerance": args.tolerance,
+            "sampling_prop": args.sampling_prop,
+        },
+    )
@@ -1,86 +1,303 @@
+import argparse
+import csv
+import functools
 import os
 import glob
 import time
-import numpy as np
-import cv2
-import nibabel as nib
 import logging
+import multiprocessing
 
+from preprocessing.utils import (
+    get_transform_path,
+    load_volume,
+    rigid_body_registration,
+)
 
-# Create a custom logger
-from preprocessing.utils import rigid_body_registration
+"""
+Rigid body transformation of images to baseline image for each patient in data folder.
+
+Patients are distributed over a process pool and the baseline of a patient is loaded once. A registration
+is written to a temporary file first and renamed to reg_*.nii when it is complete, so follow-ups with an
+existing reg_*.nii are skipped when the script is run again. Timing and final metric values of every job are appended to
+registration_log.csv in the data folder.
+
+python -m preprocessing.register_mris_to_baseline_image --dataset_dir /path/to/data_3t --workers 8
+"""
 
-logging.root.setLevel(logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+REGISTRATION_LOG_NAME = "registration_log.csv"
+REGISTRATION_LOG_COLUMNS = [
+    "patient",
+    "baseline",
+    "follow_up",
+    "output",
+    "status",
+    "seconds",
+    "translation_metric",
+    "rigid_metric",
+    "n_metric_evaluations",
+    "reused_transform",
+    "error",
+]
 
-# Create handlers
-c_handler = logging.StreamHandler()
-f_handler = logging.FileHandler("../logs/log_registration.log")
-c_handler.setLevel(logging.DEBUG)
-f_handler.setLevel(logging.DEBUG)
 
-# Create formatters and add it to handlers
-c_format = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
-f_format = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-c_handler.setFormatter(c_format)
-f_handler.setFormatter(f_format)
+def setup_logger(log_path):
+    logging.root.setLevel(logging.DEBUG)
 
-# Add handlers to the logger
-logger.addHandler(c_handler)
-logger.addHandler(f_handler)
+    # Create handlers
+    c_handler = logging.StreamHandler()
+    c_handler.setLevel(logging.DEBUG)
+    c_format = logging.Formatter("%(name)s - %(levelname)s - %(message)s")
+    c_handler.setFormatter(c_format)
+    logger.addHandler(c_handler)
 
-logger.info("merhaba")
+    if log_path:
+        if os.path.dirname(log_path) and not os.path.isdir(os.path.dirname(log_path)):
+            os.makedirs(os.path.dirname(log_path))
+        f_handler = logging.FileHandler(log_path)
+        f_handler.setLevel(logging.DEBUG)
+        f_format = logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        )
+        f_handler.setFormatter(f_format)
+        logger.addHandler(f_handler)
 
 
-"""
-Rigid body transformation of images to baseline image for each patient in data folder.
-"""
+def get_registered_path(follow_up_img_pth):
+    return os.path.join(
+        os.path.dirname(follow_up_img_pth),
+        "reg_" + os.path.basename(follow_up_img_pth),
+    )
 
 
-dataset_dir = "/Users/umutkucukaslan/Desktop/thesis/dataset/data_3t"
+def find_registration_jobs(dataset_dir, overwrite=False):
+    """
+    Lists (baseline, follow-up) registrations of all patients in data folder. First date folder of a patient
+    is the baseline.
 
-# Patient folders in data folder. This folder contains folders with
-patients = sorted(glob.glob(os.path.join(dataset_dir, "*")))
+    :param dataset_dir: folder with patient folders, each with date folders containing one .nii file
+    :param overwrite: if False, follow-ups that are already registered are not listed
+    :return: list of job dicts with patient, baseline, follow_up and output paths, number of skipped follow-ups
+    """
+    jobs = []
+    n_skipped = 0
+    for patient in sorted(glob.glob(os.path.join(dataset_dir, "*"))):
+        if not os.path.isdir(patient):
+            continue
+        dates = sorted(glob.glob(os.path.join(patient, "*")))
+        if not dates:
+            continue
+        baseline_img_pths = glob.glob(os.path.join(dates[0], "*.nii"))
+        if not baseline_img_pths:
+            logger.warning("No baseline image for patient (%s)", patient)
+            continue
+        baseline_img_pth = baseline_img_pths[0]
 
-counter = 1
-for patient in patients:
-    print("Processing {} / {}".format(counter, len(patients)))
-    counter += 1
+        for follow_up in dates[1:]:
+            follow_up_img_pth = [
+                x
+                for x in glob.glob(os.path.join(follow_up, "*.nii"))
+                if not os.path.basename(x).startswith(("reg_", "."))
+            ]
+            if len(follow_up_img_pth) != 1:
+                logger.warning(
+                    "Expected one image file in %s, found %d. Continuing...",
+                    follow_up,
+                    len(follow_up_img_pth),
+                )
+                continue
+            follow_up_img_pth = follow_up_img_pth[0]
+            reg_follow_up_img_pth = get_registered_path(follow_up_img_pth)
+            if os.path.isfile(reg_follow_up_img_pth) and not overwrite:
+                n_skipped += 1
+                continue
+            jobs.append(
+                {
+                    "patient": os.path.basename(patient),
+                    "baseline": baseline_img_pth,
+                    "follow_up": follow_up_img_pth,
+                    "output": reg_follow_up_img_pth,
+                }
+            )
+    return jobs, n_skipped
 
-    logger.info(
-        "Starting registrations for new patient (%s)", os.path.basename(patient)
+
+def register_job(job, static_volume=None, reuse_transform=True, **registration_kwargs):
+    """
+    Registers follow-up image of job to its baseline and writes result atomically to job["output"].
+    Rigid transform is saved next to the follow-up image, see preprocessing.utils.get_transform_path.
+
+    :param job: see find_registration_jobs
+    :param static_volume: (image array, grid2world) of baseline image if it is already loaded
+    :param reuse_transform: if True, an existing transform file of the follow-up computed with the same
+    registration parameters is used instead of registering
+    :param registration_kwargs: level_iters, tolerance, sampling_prop, translation_stage, gtol of rigid_body_registration
+    :return: record dict with REGISTRATION_LOG_COLUMNS keys
+    """
+    record = dict(job, status="ok", error="")
+    transform_path = get_transform_path(job["follow_up"])
+    if not reuse_transform and os.path.isfile(transform_path):
+        os.remove(transform_path)
+    start_time = time.time()
+    tmp_output = os.path.join(
+        os.path.dirname(job["output"]), ".tmp_" + os.path.basename(job["output"])
     )
-    dates = sorted(glob.glob(os.path.join(patient, "*")))
-    baseline = dates[0]
-    baseline_img_pth = glob.glob(os.path.join(baseline, "*.nii"))[0]
+    try:
+        _, _, info = rigid_body_registration(
+            job["baseline"],
+            job["follow_up"],
+            output_path=tmp_output,
+            static_volume=static_volume,
+            return_info=True,
+            transform_path=transform_path,
+            **registration_kwargs,
+        )
+        os.replace(tmp_output, job["output"])
+        record.update(info)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = repr(e)
+        if os.path.isfile(tmp_output):
+            os.remove(tmp_output)
+    record["seconds"] = round(time.time() - start_time, 2)
+    return record
 
-    follow_ups = dates[1:]
 
-    for follow_up in follow_ups:
-        follow_up_img_pth = glob.glob(os.path.join(follow_up, "*.nii"))
-        if len(follow_up_img_pth) > 1:
-            logger.warning(
-                "There are more than one image file, possible registered version is also in the folder. Continuing..."
-            )
-            continue
+def register_patient(jobs, **kwargs):
+    """
+    Registers follow-ups of one patient, loading the baseline volume once
 
-        follow_up_img_pth = follow_up_img_pth[0]
-        logger.info(
-            "Starting registration of (%s, %s)",
-            os.path.basename(baseline_img_pth),
-            os.path.basename(follow_up_img_pth),
-        )
+    :param jobs: jobs of one patient, see find_registration_jobs
+    :param kwargs: see register_job
+    :return: list of records, see register_job
+    """
+    try:
+        baseline_nii, baseline_data = load_volume(jobs[0]["baseline"])
+        static_volume = (baseline_data, baseline_nii.affine)
+    except Exception:
+        # each job reports the error
+        static_volume = None
+    return [register_job(job, static_volume=static_volume, **kwargs) for job in jobs]
 
-        reg_follow_up_img_pth = os.path.join(
-            os.path.dirname(follow_up_img_pth),
-            "reg_" + os.path.basename(follow_up_img_pth),
-        )
 
-        _, _ = rigid_body_registration(
-            baseline_img_pth, follow_up_img_pth, output_path=reg_follow_up_img_pth
-        )
-        logger.info(
-            "Registration done and new image file is written to %s",
-            reg_follow_up_img_pth,
+def append_records(csv_path, records):
+    write_header = not os.path.isfile(csv_path)
+    with open(csv_path, mode="a") as csv_file:
+        csv_writer = csv.DictWriter(
+            csv_file, fieldnames=REGISTRATION_LOG_COLUMNS, restval=""
         )
+        if write_header:
+            csv_writer.writeheader()
+        csv_writer.writerows(records)
+
+
+def register_dataset(
+    dataset_dir, workers=None, overwrite=False, log_csv_path=None, **registration_kwargs
+):
+    """
+    Registers all follow-up images in data folder to baseline images in parallel
+
+    :param dataset_dir: folder with patient folders
+    :param workers: number of processes, defaults to cpu count
+    :param overwrite: if True, already registered follow-ups are registered again, without reusing transforms
+    :param log_csv_path: csv file of job records, defaults to registration_log.csv in dataset_dir
+    :param registration_kwargs: see register_job
+    :return: list of job records
+    """
+    if log_csv_path is None:
+        log_csv_path = os.path.join(dataset_dir, REGISTRATION_LOG_NAME)
+    jobs, n_skipped = find_registration_jobs(dataset_dir, overwrite=overwrite)
+    logger.info("%d registrations to do, %d registered before", len(jobs), n_skipped)
+    records = []
+    if not jobs:
+        return records
+    patient_jobs = {}
+    for job in jobs:
+        patient_jobs.setdefault(job["patient"], []).append(job)
+    workers = workers or os.cpu_count()
+    start_time = time.time()
+    with multiprocessing.Pool(processes=min(workers, len(patient_jobs))) as pool:
+        for patient_records in pool.imap_unordered(
+            functools.partial(
+                register_patient,
+                reuse_transform=not overwrite,
+                **registration_kwargs,
+            ),
+            patient_jobs.values(),
+        ):
+            append_records(log_csv_path, patient_records)
+            for record in patient_records:
+                if record["status"] == "ok":
+                    logger.info(
+                        "Registration done in %.1f s (rigid metric %s, %d metric evaluations) and new image file is written to %s",
+                        record["seconds"],
+                        record["rigid_metric"],
+                        record["n_metric_evaluations"],
+                        record["output"],
+                    )
+                else:
+                    logger.error(
+                        "Registration of %s failed: %s",
+                        record["follow_up"],
+                        record["error"],
+                    )
+            records += patient_records
+            elapsed = time.time() - start_time
+            logger.info(
+                "Processed %d / %d, %.1f registrations/hour",
+                len(records),
+                len(jobs),
+                len(records) / elapsed * 3600,
+            )
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register follow-ups to baseline")
+    parser.add_argument(
+        "--dataset_dir",
+        default="/Users/umutkucukaslan/Desktop/thesis/dataset/data_3t",
+        help="Patient folders in data folder",
+    )
+    parser.add_argument("--workers", default=None, type=int, help="processes")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="register registered images again"
+    )
+    parser.add_argument("--log_path", default="../logs/log_registration.log")
+    parser.add_argument(
+        "--level_iters",
+        default=[10000, 1000, 100],
+        type=int,
+        nargs=3,
+        help="max iterations at each pyramid level",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=None,
+        type=float,
+        help="stop a pyramid level when relative metric change is below this, e.g. 1e-5",
+    )
+    parser.add_argument(
+        "--sampling_prop",
+        default=None,
+        type=float,
+        help="proportion of voxels used for the metric",
+    )
+    parser.add_argument(
+        "--no_translation_stage",
+        action="store_true",
+        help="skip translation stage before rigid stage",
+    )
+    args = parser.parse_args()
+
+    setup_logger(args.log_path)
+    register_dataset(
+        args.dataset_dir,
+        workers=args.workers,
+        overwrite=args.overwrite,
+        level_iters=args.level_iters,
+        tolerance=args.tolerance,
+        sampling_prop=args.sampling_prop,
+        translation_stage=not args.no_translation_stage,
+    )
@@ -1,38 +1,297 @@
+import argparse
+import functools
 import glob
+import hashlib
+import json
+import multiprocessing
 import os
+import shutil
+import time
 
 import nibabel
-from nibabel.processing import resample_to_output
+import numpy as np
 
+from preprocessing.utils import load_volume, resample_to_voxel_size
 
 """
 This script resamples MRI images to (1mm, 1mm, 1mm)
 It also changes axis directions.
 It uses registered MRIs
+
+Scans are resampled in a process pool. Scans that are already on an axis aligned grid with the target voxel size
+are copied instead of resampled. Source file hashes, voxel size and interpolation order of every output are
+recorded in resample_manifest.json in data folder, so an output is made again only if its source or the settings
+changed.
+
+python -m preprocessing.resample_images --data_dir /path/to/data --workers 8 --order 3
 """
 
+MANIFEST_NAME = "resample_manifest.json"
+MANIFEST_VERSION = 1
+
+
+def get_source_image_path(scan_folder):
+    """
+    Registered image of scan folder if there is one, original image otherwise
+    """
+    reg_paths = glob.glob(os.path.join(scan_folder, "reg_*.nii"))
+    original_paths = [
+        x
+        for x in sorted(glob.glob(os.path.join(scan_folder, "*.nii")))
+        if not os.path.basename(x).startswith(("reg_", "resampled_", "."))
+    ]
+    if reg_paths:
+        return reg_paths[0]
+    return original_paths[0] if original_paths else None
+
+
+def get_resampled_path(scan_path):
+    return os.path.join(
+        os.path.dirname(scan_path), "resampled_" + os.path.basename(scan_path)
+    )
+
 
-data_dir = "/Users/umutkucukaslan/Desktop/thesis/dataset/data"
+def get_file_hash(path, chunk_size=2 ** 20):
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
 
-patient_folders = sorted(glob.glob(os.path.join(data_dir, "*")))
 
+def is_identity_resample(img, voxel_sizes, tolerance=1e-4):
+    """
+    True if resampling does not change the image grid, i.e. affine is axis aligned without flips and voxel sizes
+    are already the target voxel sizes
 
-for idx in range(len(patient_folders)):
-    patient_folder_path = patient_folders[idx]
-    patient_name = os.path.basename(patient_folder_path)
-    scans = sorted(glob.glob(os.path.join(patient_folder_path, "*")))
-    print("processing {}  ({}/{})".format(patient_name, idx + 1, len(patient_folders)))
-    for scan_folder in scans:
-        reg_paths = glob.glob(os.path.join(scan_folder, "reg_*.nii"))
-        original_paths = glob.glob(os.path.join(scan_folder, "[!reg_]*.nii"))
-        scan_path = reg_paths[0] if reg_paths else original_paths[0]
-        target_path = os.path.join(
-            os.path.dirname(scan_path), "resampled_" + os.path.basename(scan_path)
+    :param img: nibabel image
+    :param voxel_sizes: target voxel sizes, one for each axis
+    :param tolerance: absolute tolerance of affine entries in mm
+    """
+    return np.allclose(img.affine[:3, :3], np.diag(voxel_sizes), atol=tolerance)
+
+
+def load_manifest(manifest_path):
+    if not os.path.isfile(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["outputs"]
+
+
+def save_manifest(manifest_path, outputs):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(
+            {"version": MANIFEST_VERSION, "outputs": outputs}, manifest_file, indent=1
         )
-        if os.path.isfile(target_path):
-            print("    already existing {}".format(os.path.basename(target_path)))
+    os.replace(tmp_path, manifest_path)
+
+
+def is_up_to_date(entry, source_path, target_path, voxel_sizes, order):
+    """
+    Checks manifest entry of an output against its source file and resampling settings. Source file is hashed
+    only if its size or modification time changed, and the entry is updated if the content is the same.
+
+    :return: True if the output does not have to be made again
+    """
+    if entry is None or not os.path.isfile(target_path):
+        return False
+    if entry["voxel_sizes"] != list(voxel_sizes) or entry["order"] != order:
+        return False
+    stat = os.stat(source_path)
+    if (
+        entry["source_size"] == stat.st_size
+        and entry["source_mtime"] == stat.st_mtime_ns
+    ):
+        return True
+    if entry["source_size"] != stat.st_size:
+        return False
+    if entry["source_sha1"] != get_file_hash(source_path):
+        return False
+    entry["source_mtime"] = stat.st_mtime_ns
+    return True
+
+
+def find_resample_jobs(data_dir, manifest, voxel_sizes, order, overwrite=False):
+    """
+    Lists scans to resample
+
+    :param data_dir: folder with patient folders, each with scan folders
+    :param manifest: outputs of manifest, see load_manifest
+    :param voxel_sizes: target voxel sizes
+    :param order: spline interpolation order
+    :param overwrite: if True, all scans are listed
+    :return: list of (source path, target path), number of up to date outputs
+    """
+    jobs = []
+    n_up_to_date = 0
+    for patient_folder in sorted(glob.glob(os.path.join(data_dir, "*"))):
+        if not os.path.isdir(patient_folder):
             continue
-        print("    processing {}".format(os.path.basename(scan_path)))
-        img = nibabel.load(scan_path)
-        out_img = resample_to_output(img, voxel_sizes=1.0)
-        nibabel.save(out_img, target_path)
+        for scan_folder in sorted(glob.glob(os.path.join(patient_folder, "*"))):
+            scan_path = get_source_image_path(scan_folder)
+            if scan_path is None:
+                continue
+            target_path = get_resampled_path(scan_path)
+            entry = manifest.get(os.path.relpath(target_path, data_dir))
+            if not overwrite and is_up_to_date(
+                entry, scan_path, target_path, voxel_sizes, order
+            ):
+                n_up_to_date += 1
+                continue
+            jobs.append((scan_path, target_path))
+    return jobs, n_up_to_date
+
+
+def resample_scan(job, voxel_sizes=(1.0, 1.0, 1.0), order=3):
+    """
+    Resamples one scan and writes it atomically to target path
+
+    :param job: (source path, target path)
+    :param voxel_sizes: target voxel sizes
+    :param order: spline interpolation order
+    :return: record dict with source, target, hash and timing information
+    """
+    scan_path, target_path = job
+    start_time = time.time()
+    stat = os.stat(scan_path)
+    record = {
+        "source": scan_path,
+        "target": target_path,
+        "source_size": stat.st_size,
+        "source_mtime": stat.st_mtime_ns,
+        "source_sha1": get_file_hash(scan_path),
+        "voxel_sizes": list(voxel_sizes),
+        "order": order,
+        "error": "",
+    }
+    tmp_path = os.path.join(
+        os.path.dirname(target_path), ".tmp_" + os.path.basename(target_path)
+    )
+    try:
+        img, img_data = load_volume(scan_path, use_cache=False)
+        record["identity"] = bool(is_identity_resample(img, voxel_sizes))
+        if record["identity"]:
+            shutil.copyfile(scan_path, tmp_path)
+        else:
+            out_img = resample_to_voxel_size(
+                img, img_data, voxel_sizes=voxel_sizes, order=order
+            )
+            nibabel.save(out_img, tmp_path)
+        os.replace(tmp_path, target_path)
+    except Exception as e:
+        record["error"] = repr(e)
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    record["seconds"] = round(time.time() - start_time, 2)
+    return record
+
+
+def resample_dataset(
+    data_dir, voxel_sizes=(1.0, 1.0, 1.0), order=3, workers=None, overwrite=False
+):
+    """
+    Resamples all scans of data folder in parallel
+
+    :param data_dir: folder with patient folders
+    :param voxel_sizes: target voxel sizes
+    :param order: spline interpolation order, e.g. 3 for images, 1 for a faster result, 0 for label maps
+    :param workers: number of processes, defaults to cpu count
+    :param overwrite: if True, up to date outputs are made again
+    :return: list of records, see resample_scan
+    """
+    voxel_sizes = tuple(float(x) for x in voxel_sizes)
+    manifest_path = os.path.join(data_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    jobs, n_up_to_date = find_resample_jobs(
+        data_dir, manifest, voxel_sizes, order, overwrite=overwrite
+    )
+    print("{} scans to resample, {} up to date".format(len(jobs), n_up_to_date))
+    records = []
+    if not jobs:
+        save_manifest(manifest_path, manifest)
+        return records
+    workers = min(workers or os.cpu_count(), len(jobs))
+    start_time = time.time()
+    n_bytes = 0
+    with multiprocessing.Pool(processes=workers) as pool:
+        for record in pool.imap_unordered(
+            functools.partial(resample_scan, voxel_sizes=voxel_sizes, order=order),
+            jobs,
+        ):
+            records.append(record)
+            if record["error"]:
+                print("    failed {}: {}".format(record["source"], record["error"]))
+                continue
+            n_bytes += record["source_size"]
+            manifest[os.path.relpath(record["target"], data_dir)] = {
+                "source": os.path.relpath(record["source"], data_dir),
+                **{
+                    x: record[x]
+                    for x in [
+                        "source_size",
+                        "source_mtime",
+                        "source_sha1",
+                        "voxel_sizes",
+                        "order",
+                    ]
+                },
+            }
+            save_manifest(manifest_path, manifest)
+            elapsed = time.time() - start_time
+            print(
+                "    {} {} in {:.1f} s  ({}/{}, {:.1f} scans/min, {:.1f} MB/s)".format(
+                    "copied" if record["identity"] else "resampled",
+                    os.path.relpath(record["target"], data_dir),
+                    record["seconds"],
+                    len(records),
+                    len(jobs),
+                    len(records) / elapsed * 60,
+                    n_bytes / elapsed / 2 ** 20,
+                )
+            )
+    n_identity = sum(1 for x in records if not x["error"] and x["identity"])
+    n_failed = sum(1 for x in records if x["error"])
+    print(
+        "{} scans done in {:.1f} s, {} copied without resampling, {} failed".format(
+            len(records) - n_failed, time.time() - start_time, n_identity, n_failed
+        )
+    )
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resample MRI images")
+    parser.add_argument(
+        "--data_dir",
+        default="/Users/umutkucukaslan/Desktop/thesis/dataset/data",
+        help="Patient folders in data folder",
+    )
+    parser.add_argument(
+        "--voxel_sizes", default=[1.0, 1.0, 1.0], type=float, nargs=3, help="in mm"
+    )
+    parser.add_argument(
+        "--order",
+        default=3,
+        type=int,
+        help="spline interpolation order, 0 nearest, 1 linear, 3 cubic",
+    )
+    parser.add_argument("--workers", default=None, type=int, help="processes")
+    parser.add_argument(
+        "--overwrite", action="store_true", help="resample up to date scans again"
+    )
+    args = parser.parse_args()
+
+    resample_dataset(
+        args.data_dir,
+        voxel_sizes=args.voxel_sizes,
+        order=args.order,
+        workers=args.workers,
+        overwrite=args.overwrite,
+    )
@@ -1,11 +1,19 @@
 import glob
 import os
 import random
-from shutil import copytree
+
+from datasets.split_manifest import (
+    SPLIT_MANIFEST_NAME,
+    SPLITS,
+    materialize_split,
+    write_split_manifest,
+)
 
 """
 Splits processed dataset into train, val, test folders
 Adds ad/mci/cn prefixes to patient folders accordingly
+Split is written to split_manifest.csv in processed dataset folder, which LongitudinalDataset can read directly
+with split="train" etc. Split folders are created with hard links, symlinks or copies, see materialize_mode.
 Set the params below
 """
 # set following params
@@ -14,18 +22,7 @@ processed_dataset = (
     "/Users/umutkucukaslan/Desktop/thesis/dataset/processed_data_192x160_4slices"
 )
 split_ratios = [70, 10, 20]  # train, val, test
-
-
-train_folder = os.path.join(processed_dataset, "train")
-val_folder = os.path.join(processed_dataset, "val")
-test_folder = os.path.join(processed_dataset, "test")
-
-if not os.path.isdir(train_folder):
-    os.makedirs(train_folder)
-if not os.path.isdir(val_folder):
-    os.makedirs(val_folder)
-if not os.path.isdir(test_folder):
-    os.makedirs(test_folder)
+materialize_mode = "hardlink"  # "hardlink", "symlink", "copy" or None for manifest only
 
 ad_folders = [
     x for x in glob.glob(os.path.join(raw_dataset, "AD", "*")) if os.path.isdir(x)
@@ -42,27 +39,20 @@ random.shuffle(mci_folders)
 random.shuffle(cn_folders)
 
 
-def copy_to_folder(folder, dirs, prefix):
-    for dir_path in dirs:
-        dir_basename = prefix + "_" + os.path.basename(dir_path)
-        target_path = os.path.join(folder, dir_basename)
-        copytree(dir_path, target_path)
-
-
 def split_list(filelist, split_ratios):
     i1 = int(len(filelist) * split_ratios[0] / sum(split_ratios))
     i2 = int(len(filelist) * (split_ratios[0] + split_ratios[1]) / sum(split_ratios))
     return filelist[:i1], filelist[i1:i2], filelist[i2:]
 
 
-copy_to_folder(train_folder, split_list(ad_folders, split_ratios)[0], "ad")
-copy_to_folder(train_folder, split_list(mci_folders, split_ratios)[0], "mci")
-copy_to_folder(train_folder, split_list(cn_folders, split_ratios)[0], "cn")
-
-copy_to_folder(val_folder, split_list(ad_folders, split_ratios)[1], "ad")
-copy_to_folder(val_folder, split_list(mci_folders, split_ratios)[1], "mci")
-copy_to_folder(val_folder, split_list(cn_folders, split_ratios)[1], "cn")
+splits = {split: [] for split in SPLITS}
+for folders in [ad_folders, mci_folders, cn_folders]:
+    for split, split_folders in zip(SPLITS, split_list(folders, split_ratios)):
+        splits[split] += split_folders
 
-copy_to_folder(test_folder, split_list(ad_folders, split_ratios)[2], "ad")
-copy_to_folder(test_folder, split_list(mci_folders, split_ratios)[2], "mci")
-copy_to_folder(test_folder, split_list(cn_folders, split_ratios)[2], "cn")
+manifest_path = os.path.join(processed_dataset, SPLIT_MANIFEST_NAME)
+write_split_manifest(manifest_path, splits)
+print("Split manifest is written to {}".format(manifest_path))
+if materialize_mode:
+    n_created = materialize_split(manifest_path, mode=materialize_mode)
+    print("{} patient folders are created ({})".format(n_created, materialize_mode))
@@ -4,7 +4,19 @@ import csv
 import numpy as np
 
 import random
-from shutil import copytree
+
+from datasets.split_manifest import (
+    SPLIT_MANIFEST_NAME,
+    SPLITS,
+    materialize_split,
+    write_split_manifest,
+)
+
+"""
+Splits processed dataset into train, val, test, stratified by change category of patients.
+Split is written to split_manifest.csv in processed dataset folder, which LongitudinalDataset can read directly
+with split="train" etc. Split folders are created with hard links, symlinks or copies, see materialize_mode.
+"""
 
 raw_dataset = (
     "/Users/umutkucukaslan/Desktop/thesis/dataset/processed_data_15T_192x160_4slices"
@@ -13,18 +25,7 @@ processed_dataset = (
     "/Users/umutkucukaslan/Desktop/thesis/dataset/training_data_15T_192x160_4slices"
 )
 split_ratios = [70, 10, 20]  # train, val, test
-
-
-train_folder = os.path.join(processed_dataset, "train")
-val_folder = os.path.join(processed_dataset, "val")
-test_folder = os.path.join(processed_dataset, "test")
-
-if not os.path.isdir(train_folder):
-    os.makedirs(train_folder)
-if not os.path.isdir(val_folder):
-    os.makedirs(val_folder)
-if not os.path.isdir(test_folder):
-    os.makedirs(test_folder)
+materialize_mode = "hardlink"  # "hardlink", "symlink", "copy" or None for manifest only
 
 ad_folders = [
     x for x in glob.glob(os.path.join(raw_dataset, "AD", "*")) if os.path.isdir(x)
@@ -116,10 +117,13 @@ for patient_folder_path in ad_folders + mci_folders + cn_folders:
 
 training_splits = [[], [], []]
 s = ["high", "middle", "small", "very small", "no"]
+patient_changes = {}
 print("")
 print("Training dataset stats:")
 for i, l in enumerate(splitted_full_paths):
     random.shuffle(l)
+    for patient_folder_path in l:
+        patient_changes[patient_folder_path] = s[i]
     n_samples = len(l)
     n_val = int(np.ceil(split_ratios[1] / np.sum(split_ratios) * n_samples))
     n_test = int(np.ceil(split_ratios[2] / np.sum(split_ratios) * n_samples))
@@ -141,24 +145,11 @@ for i, split in enumerate(training_splits):
     print("{}: {}".format(s[i], len(split)))
 
 
-def copy_to_folder(destination_folder, source_dir_list, use_prefix=True):
-    """
-    Copy list of folders to destination folder.
-
-    :param destination_folder:
-    :param source_dir_list:
-    :param use_prefix:
-    :return:
-    """
-    prefix_dict = {"AD": "ad", "MCI": "mci", "CN": "cn"}
-    for dir_path in source_dir_list:
-        patient_type = os.path.basename(os.path.dirname(dir_path))
-        prefix = prefix_dict[patient_type]
-        dir_basename = prefix + "_" + os.path.basename(dir_path)
-        target_path = os.path.join(destination_folder, dir_basename)
-        copytree(dir_path, target_path)
-
-
-copy_to_folder(train_folder, training_splits[0], use_prefix=True)
-copy_to_folder(val_folder, training_splits[1], use_prefix=True)
-copy_to_folder(test_folder, training_splits[2], use_prefix=True)
+manifest_path = os.path.join(processed_dataset, SPLIT_MANIFEST_NAME)
+write_split_manifest(
+    manifest_path, dict(zip(SPLITS, training_splits)), changes=patient_changes
+)
+print("Split manifest is written to {}".format(manifest_path))
+if materialize_mode:
+    n_created = materialize_split(manifest_path, mode=materialize_mode)
+    print("{} patient folders are created ({})".format(n_created, materialize_mode))
@@ -1,5 +1,7 @@
+import collections
 import copy
 import glob
+import json
 import os
 import shutil
 
@@ -7,6 +9,7 @@ import cv2
 import imageio
 import nibabel as nib
 import numpy as np
+import pandas as pd
 from dipy.align.imaffine import (
     transform_centers_of_mass,
     AffineMap,
@@ -18,75 +21,384 @@ from dipy.align.transforms import (
     RigidTransform3D,
     AffineTransform3D,
 )
+from nibabel.spaces import vox2out_vox
+from scipy import ndimage
 from skimage.metrics import structural_similarity
 
+# Number of volumes kept in memory by load_volume in each process
+VOLUME_CACHE_SIZE = 4
 
-def rigid_body_registration(static_image_path, moving_image_path, output_path=None):
+_volume_cache = collections.OrderedDict()
+
+
+def load_volume(path, use_cache=True):
     """
-    Registers moving image to static image using ridig body transformations. If output_path is given, it saves
-    the result. Registration is done in the following steps.
-        - Center of mass transform
-        - Translation transform
-        - Rigid body transform
-    :param static_image_path: Path to static image file.
-    :param moving_image_path: Path to moving image file.
-    :param output_path: If given, resulting image is saved to output_path.
-    :return: (transformed_image, associated_transformation_matrix)
+    Loads image data of a .nii file as float32 without nibabel's float64 get_fdata() copy. Data of unscaled
+    float32 files stays memory-mapped. Recently loaded volumes are kept in a per-process LRU cache of
+    VOLUME_CACHE_SIZE items, keyed on path and modification time, so returned arrays are read-only.
+
+    :param path: path of image file
+    :param use_cache: if False, cache is neither searched nor updated
+    :return: (nibabel image, float32 image array)
     """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if use_cache and key in _volume_cache:
+        _volume_cache.move_to_end(key)
+        return _volume_cache[key]
 
-    # Reference page for affine registration
-    # https://dipy.org/documentation/1.0.0./examples_built/affine_registration_3d/#example-affine-registration-3d
+    img = nib.load(path, mmap=True)
+    img_data = img.get_fdata(dtype=np.float32, caching="unchanged")
+    img_data.setflags(write=False)
+    if use_cache and VOLUME_CACHE_SIZE > 0:
+        _volume_cache[key] = (img, img_data)
+        while len(_volume_cache) > VOLUME_CACHE_SIZE:
+            _volume_cache.popitem(last=False)
+    return img, img_data
 
-    static_nii = nib.load(static_image_path)
-    moving_nii = nib.load(moving_image_path)
 
-    static = static_nii.get_fdata()
-    moving = moving_nii.get_fdata()
+def clear_volume_cache():
+    _volume_cache.clear()
 
-    static_grid2world = static_nii.affine
-    moving_grid2world = moving_nii.affine
 
+def get_numpy_orientation(img_data):
+    """
+    Image array in numpy dimension order, flipped along all axes and transposed. It is a view of img_data.
+    """
+    return img_data[::-1, ::-1, ::-1].transpose((2, 1, 0))
+
+
+def resample_to_voxel_size(img, img_data=None, voxel_sizes=1.0, order=3):
+    """
+    float32 version of nibabel.processing.resample_to_output, resampling image to given voxel sizes
+
+    :param img: nibabel image
+    :param img_data: image array of img, e.g. from load_volume, read from img if not given
+    :param voxel_sizes: voxel size in mm, or one for each axis
+    :param order: spline interpolation order
+    :return: resampled nibabel.Nifti1Image
+    """
+    if img_data is None:
+        img_data = img.get_fdata(dtype=np.float32, caching="unchanged")
+    if np.isscalar(voxel_sizes):
+        voxel_sizes = (voxel_sizes,) * len(img.shape)
+    out_shape, out_affine = vox2out_vox((img.shape, img.affine), voxel_sizes)
+    out_vox2in_vox = np.linalg.inv(img.affine).dot(out_affine)
+    if order > 1:
+        img_data = ndimage.spline_filter(
+            img_data, order, output=np.float32, mode="constant"
+        )
+    out_data = ndimage.affine_transform(
+        img_data,
+        out_vox2in_vox[:3, :3],
+        out_vox2in_vox[:3, 3],
+        output_shape=out_shape,
+        output=np.float32,
+        order=order,
+        mode="constant",
+        cval=0.0,
+        prefilter=False,
+    )
+    return nib.Nifti1Image(out_data, out_affine, img.header)
+
+
+class CountingMutualInformationMetric(MutualInformationMetric):
+    """
+    Mutual information metric counting its evaluations, used to report how long the optimization ran
+    """
+
+    def __init__(self, nbins=32, sampling_proportion=None):
+        super().__init__(nbins=nbins, sampling_proportion=sampling_proportion)
+        self.n_evaluations = 0
+
+    def distance_and_gradient(self, params):
+        self.n_evaluations += 1
+        return super().distance_and_gradient(params)
+
+
+def get_transform_path(moving_image_path):
+    """
+    Default sidecar file of the rigid transform of a moving image, e.g. scan.nii -> scan_rigid.npz
+    """
+    return os.path.splitext(moving_image_path)[0] + "_rigid.npz"
+
+
+def get_registration_parameters(
+    level_iters=(10000, 1000, 100),
+    tolerance=None,
+    sampling_prop=None,
+    translation_stage=True,
+    gtol=1e-4,
+):
+    """
+    Registration parameters of register_volumes as a json string, saved with transforms to detect transforms
+    computed with other parameters
+    """
+    return json.dumps(
+        {
+            "level_iters": [int(x) for x in level_iters],
+            "tolerance": tolerance,
+            "sampling_prop": sampling_prop,
+            "translation_stage": bool(translation_stage),
+            "gtol": gtol,
+        },
+        sort_keys=True,
+    )
+
+
+def save_affine_map(affine_map, path, parameters=None):
+    """
+    Saves affine matrix and grid information of an AffineMap to a .npz file
+
+    :param affine_map: dipy AffineMap
+    :param path: .npz file path
+    :param parameters: registration parameters the transform is computed with, see get_registration_parameters
+    """
+    tmp_path = os.path.splitext(path)[0] + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        parameters=np.array(parameters or ""),
+        affine=affine_map.affine,
+        domain_shape=np.array(affine_map.domain_shape),
+        domain_grid2world=affine_map.domain_grid2world,
+        codomain_shape=np.array(affine_map.codomain_shape),
+        codomain_grid2world=affine_map.codomain_grid2world,
+    )
+    os.replace(tmp_path, path)
+
+
+def load_affine_map(path):
+    """
+    Loads an AffineMap saved by save_affine_map
+
+    :param path: .npz file path
+    :return: dipy AffineMap
+    """
+    with np.load(path) as data:
+        return AffineMap(
+            data["affine"],
+            domain_grid_shape=tuple(data["domain_shape"]),
+            domain_grid2world=data["domain_grid2world"],
+            codomain_grid_shape=tuple(data["codomain_shape"]),
+            codomain_grid2world=data["codomain_grid2world"],
+        )
+
+
+def get_voxel_affine(affine_map):
+    """
+    Matrix mapping voxel coordinates of the static (domain) grid to voxel coordinates of the moving
+    (codomain) grid of a dipy AffineMap
+    """
+    return (
+        np.linalg.inv(affine_map.codomain_grid2world)
+        .dot(affine_map.affine)
+        .dot(affine_map.domain_grid2world)
+    )
+
+
+def resample_to_slice_grid(volume, grid_shape, slice_shape, voxel_affine=None, order=1):
+    """
+    Samples volume on the grid of axial slices get_axial_cortex_slices extracts, i.e. the grid_shape voxel grid
+    with its last two axes resized to slice_shape the way cv2.resize does. Rigid transform given by voxel_affine
+    and resizing are done in a single interpolation.
+
+    :param volume: 3D array
+    :param grid_shape: shape of voxel grid to sample, e.g. shape of the baseline image
+    :param slice_shape: (height, width) of resized axial slices
+    :param voxel_affine: matrix mapping grid voxel coordinates to volume voxel coordinates, None for identity.
+    See get_voxel_affine.
+    :param order: spline interpolation order
+    :return: float32 array with shape (grid_shape[0], height, width)
+    """
+    height, width = slice_shape
+    # pixel centers of cv2.resize
+    rows = (np.arange(height) + 0.5) * (grid_shape[1] / height) - 0.5
+    cols = (np.arange(width) + 0.5) * (grid_shape[2] / width) - 0.5
+    rows, cols = np.meshgrid(rows, cols, indexing="ij")
+    plane = np.stack(
+        [np.zeros_like(rows), rows, cols, np.ones_like(rows)], axis=0
+    ).reshape(4, -1)
+    if voxel_affine is None:
+        voxel_affine = np.eye(4)
+    resampled = np.empty((grid_shape[0], height, width), dtype=np.float32)
+    for index in range(grid_shape[0]):
+        plane[0] = index
+        coordinates = voxel_affine[:3].dot(plane)
+        resampled[index] = ndimage.map_coordinates(
+            volume, coordinates, order=order, mode="nearest"
+        ).reshape(height, width)
+    return resampled
+
+
+def register_volumes(
+    static_volume,
+    moving_volume,
+    level_iters=(10000, 1000, 100),
+    tolerance=None,
+    sampling_prop=None,
+    translation_stage=True,
+    gtol=1e-4,
+):
+    """
+    Rigid body registration of moving volume to static volume, see rigid_body_registration for parameters.
+
+    :param static_volume: (image array, grid2world) of static image
+    :param moving_volume: (image array, grid2world) of moving image
+    :return: (rigid AffineMap, info dict of final metric values and number of metric evaluations)
+    """
+    static, static_grid2world = static_volume
+    moving, moving_grid2world = moving_volume
+    info = {
+        "translation_metric": None,
+        "rigid_metric": None,
+        "n_metric_evaluations": 0,
+        "reused_transform": False,
+    }
     c_of_mass = transform_centers_of_mass(
         static, static_grid2world, moving, moving_grid2world
     )
-    print("Center of mass is {}".format(c_of_mass))
-    print("Center of mass is {}".format(c_of_mass))
-
     nbins = 32
-    sampling_prop = None
-    metric = MutualInformationMetric(nbins, sampling_prop)
-    level_iters = [10000, 1000, 100]
+    metric = CountingMutualInformationMetric(nbins, sampling_prop)
     sigmas = [3.0, 1.0, 0.0]
     factors = [4, 2, 1]
+    options = {"gtol": gtol}
+    if tolerance is not None:
+        options["ftol"] = tolerance
     affreg = AffineRegistration(
-        metric=metric, level_iters=level_iters, sigmas=sigmas, factors=factors
+        metric=metric,
+        level_iters=list(level_iters),
+        sigmas=sigmas,
+        factors=factors,
+        options=options,
     )
 
-    transform = TranslationTransform3D()
-    params0 = None
     starting_affine = c_of_mass.affine
-    translation = affreg.optimize(
-        static,
-        moving,
-        transform,
-        params0,
-        static_grid2world,
-        moving_grid2world,
-        starting_affine=starting_affine,
-    )
+    if translation_stage:
+        transform = TranslationTransform3D()
+        params0 = None
+        translation, _, translation_metric = affreg.optimize(
+            static,
+            moving,
+            transform,
+            params0,
+            static_grid2world=static_grid2world,
+            moving_grid2world=moving_grid2world,
+            starting_affine=starting_affine,
+            ret_metric=True,
+        )
+        info["translation_metric"] = float(translation_metric)
+        starting_affine = translation.affine
 
     transform = RigidTransform3D()
     params0 = None
-    starting_affine = translation.affine
-    rigid = affreg.optimize(
+    rigid, _, rigid_metric = affreg.optimize(
         static,
         moving,
         transform,
         params0,
-        static_grid2world,
-        moving_grid2world,
+        static_grid2world=static_grid2world,
+        moving_grid2world=moving_grid2world,
         starting_affine=starting_affine,
+        ret_metric=True,
+    )
+    info["rigid_metric"] = float(rigid_metric)
+    info["n_metric_evaluations"] = metric.n_evaluations
+    return rigid, info
+
+
+def is_transform_up_to_date(transform_path, *image_paths, parameters=None):
+    """
+    Whether transform file exists, is newer than all image files and is computed with the given registration
+    parameters, see get_registration_parameters. Parameters are not compared if they are None.
+    """
+    if not os.path.isfile(transform_path) or os.path.getmtime(transform_path) < max(
+        os.path.getmtime(x) for x in image_paths
+    ):
+        return False
+    if parameters is None:
+        return True
+    with np.load(transform_path) as data:
+        return "parameters" in data and str(data["parameters"]) == parameters
+
+
+def rigid_body_registration(
+    static_image_path,
+    moving_image_path,
+    output_path=None,
+    static_volume=None,
+    return_info=False,
+    level_iters=(10000, 1000, 100),
+    tolerance=None,
+    sampling_prop=None,
+    translation_stage=True,
+    transform_path=None,
+    gtol=1e-4,
+):
+    """
+    Registers moving image to static image using ridig body transformations. If output_path is given, it saves
+    the result. Registration is done in the following steps.
+        - Center of mass transform
+        - Translation transform
+        - Rigid body transform
+    :param static_image_path: Path to static image file.
+    :param moving_image_path: Path to moving image file.
+    :param output_path: If given, resulting image is saved to output_path.
+    :param static_volume: (image array, grid2world) of static image if it is already loaded, static_image_path
+    is not read in that case.
+    :param return_info: If True, final metric values of translation and rigid stages are returned as well.
+    :param level_iters: Maximum number of metric evaluations at each pyramid level, coarsest first.
+    :param tolerance: If given, optimization of a pyramid level stops when the relative change of the metric
+    between iterations is smaller than tolerance (ftol of L-BFGS-B).
+    :param sampling_prop: Proportion of voxels used to calculate the metric, None for all voxels.
+    :param translation_stage: If False, rigid transform is optimized directly after center of mass transform.
+    :param transform_path: If given, rigid transform is loaded from this file when it is newer than both
+    images and computed with the same registration parameters, otherwise it is computed and saved to this file.
+    See get_transform_path.
+    :param gtol: Optimization of a pyramid level stops when the largest gradient component is smaller than gtol
+    (gtol of L-BFGS-B, 1e-4 is the default of dipy).
+    :return: (transformed_image, associated_transformation_matrix) or
+    (transformed_image, associated_transformation_matrix, info) if return_info is True
+    """
+
+    # Reference page for affine registration
+    # https://dipy.org/documentation/1.0.0./examples_built/affine_registration_3d/#example-affine-registration-3d
+
+    moving_nii, moving = load_volume(moving_image_path)
+    moving_grid2world = moving_nii.affine
+    if static_volume is None:
+        static_nii, static = load_volume(static_image_path)
+        static_volume = (static, static_nii.affine)
+    static, static_grid2world = static_volume
+
+    parameters = get_registration_parameters(
+        level_iters=level_iters,
+        tolerance=tolerance,
+        sampling_prop=sampling_prop,
+        translation_stage=translation_stage,
+        gtol=gtol,
     )
+    if transform_path is not None and is_transform_up_to_date(
+        transform_path, static_image_path, moving_image_path, parameters=parameters
+    ):
+        rigid = load_affine_map(transform_path)
+        info = {
+            "translation_metric": None,
+            "rigid_metric": None,
+            "n_metric_evaluations": 0,
+            "reused_transform": True,
+        }
+    else:
+        rigid, info = register_volumes(
+            static_volume,
+            (moving, moving_grid2world),
+            level_iters=level_iters,
+            tolerance=tolerance,
+            sampling_prop=sampling_prop,
+            translation_stage=translation_stage,
+            gtol=gtol,
+        )
+        if transform_path is not None:
+            save_affine_map(rigid, transform_path, parameters=parameters)
 
     transformed = rigid.transform(moving)
 
@@ -95,16 +407,21 @@ def rigid_body_registration(static_image_path, moving_image_path, output_path=No
         new_image = nib.Nifti1Image(transformed, static_grid2world, moving_nii.header)
         nib.save(new_image, output_path)
 
+    if return_info:
+        return transformed, rigid, info
     return transformed, rigid
 
 
-def find_upper_tangent_line_to_head_in_3d_mri(img=None, img_path=None, axis=0):
+def find_upper_tangent_line_to_head_in_3d_mri(
+    img=None, img_path=None, axis=0, img_data=None
+):
     """
-    This function finds slice index touching head at given axis. You should input either img or img_path.
+    This function finds slice index touching head at given axis. You should input either img, img_path or img_data.
 
     :param img: nibabel.Nifti1Image object - what nibabel.load returns for .nii images
     :param img_path: path of image file
     :param axis: Axis you want to find the index of touching slice
+    :param img_data: 3D image array, e.g. already loaded or memory-mapped image data
     :return: A tuple of (index, image showing the result, dynamic threshold used)
     """
 
@@ -114,21 +431,20 @@ def find_upper_tangent_line_to_head_in_3d_mri(img=None, img_path=None, axis=0):
         print("Unknown axis!")
         raise ValueError
 
-    # Reading image data with error handling
-    if img is None:
-        if img_path is None:
-            print("Provide either nibabel image or .nii file path!")
-            raise ValueError
-        else:
+    # Reading image data with error handling, as float32 without keeping a float64 copy of the volume
+    if img_data is None:
+        if img is None:
+            if img_path is None:
+                print("Provide either nibabel image, image data or .nii file path!")
+                raise ValueError
             try:
-                img = nib.load(img_path)
-                img_data = img.get_fdata()
+                img, img_data = load_volume(img_path)
             except Exception as e:
                 print("Exception occurred while reading data. ", e)
                 return None
-    else:
+    if img_data is None:
         try:
-            img_data = img.get_fdata()
+            img_data = img.get_fdata(dtype=np.float32, caching="unchanged")
         except Exception as e:
             print("Exception occurred while reading data from image object. ", e)
             return None
@@ -137,48 +453,107 @@ def find_upper_tangent_line_to_head_in_3d_mri(img=None, img_path=None, axis=0):
     img_data = np.asarray(img_data, dtype=np.float32)
 
     # Threshold for foreground/background
-    threshold = img_data.flatten().mean()
-
-    # Image shape
-    img_data_shape = img_data.shape
+    threshold = img_data.reshape(-1).mean()
 
     # Threshold for number of foreground pixels at the edge of head
     head_threshold = 500
 
-    for i in range(img_data_shape[axis]):
-
-        if axis == 0:
-            slice = img_data[i, :, :]
-        elif axis == 1:
-            slice = img_data[:, i, :]
-        elif axis == 2:
-            slice = img_data[:, :, i]
+    # Foreground pixels of 5x5 median filtered slices (cv2.medianBlur). Median of 25 pixels is above threshold
+    # if at least 13 of them are, so pixels above threshold are counted in 5x5 windows with replicated borders.
+    # Slices are processed in chunks, stopping at the first chunk touching the head.
+    slices = np.moveaxis(img_data, axis, 0)
+    chunk_size = 16
+    i = None
+    for start in range(0, slices.shape[0], chunk_size):
+        foreground = (slices[start : start + chunk_size] > threshold).astype(np.uint8)
+        window_counts = ndimage.convolve1d(
+            foreground, np.ones(5, dtype=np.uint8), axis=1, mode="nearest"
+        )
+        window_counts = ndimage.convolve1d(
+            window_counts, np.ones(5, dtype=np.uint8), axis=2, mode="nearest"
+        )
+        slice_counts = np.count_nonzero(window_counts >= 13, axis=(1, 2))
+        head_slices = np.flatnonzero(slice_counts > head_threshold)
+        if len(head_slices):
+            i = start + int(head_slices[0])
+            break
+    if i is None:
+        return None
+
+    # Sagittal or axial image showing the touching slice as a line
+    if axis == 2:
+        slice = img_data[int(img_data.shape[0] / 2), :, :]
+    else:
+        slice = img_data[:, :, int(img_data.shape[2] / 2)]
 
-        # Median filtering for noise removal
-        slice = cv2.medianBlur(slice, 5)
+    image = np.asarray((slice / slice.max()) * 255, dtype=np.uint8)
 
-        if np.sum(slice.flatten() > threshold) > head_threshold:
+    if axis == 0:
+        image[i, :] = 255
+    else:
+        image[:, i] = 255
 
-            if axis == 0:
-                mid_point = int(img_data_shape[2] / 2)
-                slice = img_data[:, :, mid_point]
-            elif axis == 1:
-                mid_point = int(img_data_shape[2] / 2)
-                slice = img_data[:, :, mid_point]
-            elif axis == 2:
-                mid_point = int(img_data_shape[0] / 2)
-                slice = img_data[mid_point, :, :]
+    return i, image, threshold
 
-            image = np.asarray((slice / slice.max()) * 255, dtype=np.uint8)
 
-            if axis == 0:
-                image[i, :] = 255
-            elif axis == 1:
-                image[:, i] = 255
-            elif axis == 2:
-                image[:, i] = 255
+def get_head_top_slicing(
+    img_data, head_top_offset=30, num_slices=4, step_size=1, crop_shape=None
+):
+    """
+    Slicing range of a patient without a recorded one, starting head_top_offset slices below the axial slice
+    touching the top of the head, see find_upper_tangent_line_to_head_in_3d_mri
+
+    :param img_data: 3D baseline image array
+    :param head_top_offset: first slice index relative to the slice touching top of the head
+    :param num_slices: number of slices
+    :param step_size: sampling interval
+    :param crop_shape: (height, width) of crop window
+    :return: {start_offset, stop_offset, step_size, crop_indexes, crop_shape}, crop_indexes is None for a
+    centered crop window
+    """
+    head_top = find_upper_tangent_line_to_head_in_3d_mri(img_data=img_data, axis=0)
+    if head_top is None:
+        raise ValueError("Top of the head is not found in baseline image")
+    start_index = head_top[0] + head_top_offset
+    return {
+        "start_offset": start_index,
+        "stop_offset": start_index + num_slices * step_size,
+        "step_size": step_size,
+        "crop_indexes": None,
+        "crop_shape": None if crop_shape is None else tuple(crop_shape),
+    }
+
+
+def resize_channels(image, size, interpolation=cv2.INTER_LINEAR):
+    """
+    cv2.resize for images with any number of channels, keeping the channel axis
 
-            return i, image, threshold
+    :param image: array with shape (height, width, channels)
+    :param size: (width, height) as in cv2.resize
+    :return: array with shape (size[1], size[0], channels)
+    """
+    # cv2 resizes 1, 3 and 4 channel images with the same interpolation as single channel images, other channel
+    # counts are interpolated with lower precision
+    chunks = []
+    start = 0
+    while start < image.shape[2]:
+        n_channels = min(4, image.shape[2] - start)
+        if n_channels == 2:
+            n_channels = 1
+        chunks.append((start, start + n_channels))
+        start += n_channels
+    resized = [
+        cv2.resize(
+            np.ascontiguousarray(image[:, :, start:stop]),
+            size,
+            interpolation=interpolation,
+        )
+        for start, stop in chunks
+    ]
+    resized = [x.reshape(size[1], size[0], -1) for x in resized]
+    if not resized:
+        return np.zeros((size[1], size[0], 0), dtype=image.dtype)
+    return np.concatenate(resized, axis=2)
 
 
 def get_axial_cortex_slices(
@@ -228,9 +603,9 @@ def get_axial_cortex_slices(
 
     # Do not include empty areas in mean and std calculation
     threshold_adapted_mean = 20
-    nice_points = np.asarray([x for x in roi.flatten() if x > threshold_adapted_mean])
-    adapted_mean = nice_points.mean()
-    adapted_std = np.std(nice_points)
+    nice_points = roi[roi > threshold_adapted_mean]
+    adapted_mean = nice_points.mean(dtype=np.float64)
+    adapted_std = np.std(nice_points, dtype=np.float64)
 
     # Clip intensity values beyond this
     max_clipping_value = adapted_mean + 1.8 * adapted_std
@@ -241,37 +616,33 @@ def get_axial_cortex_slices(
     slicing_pattern_image[start_offset, :, 0] = 255
     slicing_pattern_image[start_offset, :, 0] = 255
 
-    processed_slices = []
-    for index in range(start_offset, slice_index_stop, step):
-        slice = img_data[index, :, :]
-
-        # Clip intensity values beyond the range [0, max_clipping_value]
-        processed_slice = np.clip(slice, 0, max_clipping_value)
-        processed_slice = cv2.resize(
-            processed_slice, (resampled_slice_shape[1], resampled_slice_shape[0])
+    # All slices are processed at once as channels of a single image, (height, width, n_slices)
+    indexes = list(range(start_offset, slice_index_stop, step))
+    slab = np.clip(img_data[indexes], 0, max_clipping_value).transpose((1, 2, 0))
+    slab = resize_channels(slab, (resampled_slice_shape[1], resampled_slice_shape[0]))
+
+    # Pad with zeros if the shape of the slice is smaller than desired
+    if shape_after_padding is not None:
+        desired_height, desired_width = shape_after_padding
+        pad_height = max(0, desired_height - slab.shape[0])
+        pad_width = max(0, desired_width - slab.shape[1])
+        slab = np.pad(
+            slab,
+            [
+                (int(pad_height / 2), pad_height - int(pad_height / 2)),
+                (int(pad_width / 2), pad_width - int(pad_width / 2)),
+                (0, 0),
+            ],
         )
 
-        # Pad with zeros if the shape of the slice is smaller than desired
-        if shape_after_padding is not None:
-            desired_height, desired_width = shape_after_padding
-            pad_height = max(0, desired_height - processed_slice.shape[0])
-            pad_width = max(0, desired_width - processed_slice.shape[1])
-            processed_slice = np.pad(
-                processed_slice,
-                [
-                    (int(pad_height / 2), pad_height - int(pad_height / 2)),
-                    (int(pad_width / 2), pad_width - int(pad_width / 2)),
-                ],
-            )
+    # Compress intensities in [0, 1] range
+    processed_slices = list(slab.transpose((2, 0, 1)) / max_clipping_value)
 
-        # Compress intensities in [0, 1] range
-        processed_slice = np.asarray(processed_slice / max_clipping_value)
-        processed_slices.append(processed_slice)
+    # Show slice positions in the sagittal image
+    slicing_pattern_image[indexes, :, 1] += 100
 
-        # Show this slice position in the sagittal image
-        slicing_pattern_image[index, :, 1] += 100
-
-        if show_results:
+    if show_results:
+        for processed_slice in processed_slices:
             cv2.imshow("Slicing pattern", slicing_pattern_image)
             cv2.imshow(
                 "Processed slice", np.asarray(processed_slice * 255, dtype=np.uint8)
@@ -286,6 +657,126 @@ def get_axial_cortex_slices(
     return processed_slices, slicing_pattern_image
 
 
+def save_slices(slices, dir_path, dtype="uint8", slicing_pattern_image=None):
+    """
+    Writes slices in [0, 1] range as slice_000.png, slice_001.png, ... and the slicing pattern image
+    as summary_slicing_pattern.png
+
+    :param slices: list of 2D arrays
+    :param dir_path: output folder, created if it does not exist
+    :param dtype: "uint8" or "uint16" PNGs
+    :param slicing_pattern_image: optional image of get_axial_cortex_slices
+    """
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    for i in range(len(slices)):
+        pth = os.path.join(dir_path, "slice_{:03d}".format(i) + ".png")
+        if dtype == "uint16":
+            slice = np.asarray(slices[i] * (2 ** 16 - 1), dtype=np.uint16)
+        else:
+            slice = np.asarray(slices[i] * (2 ** 8 - 1), dtype=np.uint8)
+        imageio.imwrite(pth, slice)
+
+    if slicing_pattern_image is not None:
+        pth = os.path.join(dir_path, "summary_slicing_pattern.png")
+        imageio.imwrite(pth, slicing_pattern_image)
+
+
+def get_patient_condition(dataset_info_pth):
+    """
+    Group of each subject, e.g. {"136_S_1227": "MCI"}
+
+    :param dataset_info_pth: csv file with Subject and Group columns
+    """
+    dataset_info = pd.read_csv(dataset_info_pth)
+    patient_condition = dict()
+    for item in dataset_info[["Subject", "Group"]].drop_duplicates("Subject").values:
+        patient_condition[item[0]] = item[1]
+    return patient_condition
+
+
+def crop_slice_file(source_path, target_path, crop_indexes, crop_shape):
+    """
+    Reads a slice image, crops it and writes the cropped view, source and target may be the same file.
+    OpenCV releases the GIL while decoding and encoding, so files can be cropped in threads.
+
+    :param source_path: slice image path
+    :param target_path: cropped slice image path
+    :param crop_indexes: (row, col) of top left corner of crop window
+    :param crop_shape: (height, width) of crop window
+    """
+    image = cv2.imread(source_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"Could not read {source_path}")
+    row, col = crop_indexes
+    if (
+        row < 0
+        or col < 0
+        or row + crop_shape[0] > image.shape[0]
+        or col + crop_shape[1] > image.shape[1]
+    ):
+        raise ValueError(
+            f"Crop window {crop_indexes}, {crop_shape} is outside of {source_path} with shape {image.shape}"
+        )
+    if not cv2.imwrite(
+        target_path, image[row : row + crop_shape[0], col : col + crop_shape[1]]
+    ):
+        raise IOError(f"Could not write {target_path}")
+
+
+def apply_patient_crop(
+    source_patient_folder,
+    target_patient_folder,
+    crop_indexes,
+    crop_shape,
+    executor=None,
+):
+    """
+    Crops all slices of all scans of a patient with the given crop window and saves them in target patient folder.
+    This is the non-interactive part of crop_patient_slices, e.g. to crop again with windows from the slicing csv.
+
+    :param source_patient_folder: patient folder with scan folders containing slice_*.png files
+    :param target_patient_folder: may be the same as source_patient_folder to crop in place
+    :param crop_indexes: (row, col) of top left corner of crop window
+    :param crop_shape: (height, width) of crop window
+    :param executor: concurrent.futures executor to crop slices in, e.g. a ThreadPoolExecutor shared by patients
+    :return: number of cropped slices
+    """
+    jobs = []
+    for scan_folder in sorted(glob.glob(os.path.join(source_patient_folder, "*"))):
+        scan_folder_name = os.path.basename(scan_folder)
+        target_scan_folder = os.path.join(target_patient_folder, scan_folder_name)
+        if not os.path.isdir(target_scan_folder):
+            os.makedirs(target_scan_folder)
+
+        for slice in sorted(glob.glob(os.path.join(scan_folder, "slice_*.png"))):
+            jobs.append(
+                (slice, os.path.join(target_scan_folder, os.path.basename(slice)))
+            )
+
+        if source_patient_folder != target_patient_folder:
+            other_files = sorted(glob.glob(os.path.join(scan_folder, "summary*.png")))
+            for file in other_files:
+                target_file_path = os.path.join(
+                    target_scan_folder, os.path.basename(file)
+                )
+                shutil.copy(file, target_file_path)
+
+    if executor is None:
+        for source_path, target_path in jobs:
+            crop_slice_file(source_path, target_path, crop_indexes, crop_shape)
+    else:
+        futures = [
+            executor.submit(
+                crop_slice_file, source_path, target_path, crop_indexes, crop_shape
+            )
+            for source_path, target_path in jobs
+        ]
+        for future in futures:
+            future.result()
+    return len(jobs)
+
+
 def crop_patient_slices(
     source_patient_folder,
     target_patient_folder,
@@ -316,6 +807,8 @@ def crop_patient_slices(
 
     scan_folders = sorted(glob.glob(os.path.join(source_patient_folder, "*")))
 
+    # decoded slices are kept while browsing, so key presses do not read the files again
+    decoded_slices = {}
     scan_index = 0
     slice_index = 0
     image_row_index = int((source_image_size[0] - crop_height) / 2)
@@ -326,7 +819,9 @@ def crop_patient_slices(
             glob.glob(os.path.join(scan_folders[scan_index], "slice_*.png"))
         )
         slice = slices[slice_index]
-        slice_img = imageio.imread(slice)
+        if slice not in decoded_slices:
+            decoded_slices[slice] = imageio.imread(slice)
+        slice_img = decoded_slices[slice].copy()
         slice_img[image_row_index, :] = 255
         slice_img[image_row_index + crop_height, :] = 255
         slice_img[:, image_col_index] = 255
@@ -384,29 +879,11 @@ def crop_patient_slices(
             print("Terminated")
             exit()
 
-    for scan_folder in scan_folders:
-        scan_folder_name = os.path.basename(scan_folder)
-        target_scan_folder = os.path.join(target_patient_folder, scan_folder_name)
-        if not os.path.isdir(target_scan_folder):
-            os.makedirs(target_scan_folder)
-
-        slices = sorted(glob.glob(os.path.join(scan_folder, "slice_*.png")))
-        for slice in slices:
-            slice_name = os.path.basename(slice)
-            slice_img = imageio.imread(slice)
-            cropped_img = slice_img[
-                image_row_index : image_row_index + crop_height,
-                image_col_index : image_col_index + crop_width,
-            ]
-            target_slice_path = os.path.join(target_scan_folder, slice_name)
-            imageio.imwrite(target_slice_path, cropped_img)
-
-        if source_patient_folder != target_patient_folder:
-            other_files = sorted(glob.glob(os.path.join(scan_folder, "summary*.png")))
-            for file in other_files:
-                target_file_path = os.path.join(
-                    target_scan_folder, os.path.basename(file)
-                )
-                shutil.copy(file, target_file_path)
+    apply_patient_crop(
+        source_patient_folder,
+        target_patient_folder,
+        (image_row_index, image_col_index),
+        (crop_height, crop_width),
+    )
 
     return (image_row_index, image_col_index), (crop_height, crop_width)
@@ -6,9 +6,17 @@ import numpy as np
 from skimage.metrics import structural_similarity
 
 from datasets.longitudinal_dataset import LongitudinalDataset
+from reference_papers.glow.latent_cache import LatentCache, get_checkpoint_hash
 from reference_papers.glow.model import Glow
 from reference_papers.glow.train import calc_z_shapes
-from reference_papers.glow.utils import read_image
+from reference_papers.glow.utils import (
+    read_image,
+    read_images,
+    images_to_tensor,
+    model_outputs_to_uint8,
+    rgb_to_gray,
+    structural_similarity_batch,
+)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -25,6 +33,9 @@ else:
 
 data_folder = "val"
 
+# number of images encoded and triplets decoded at once in batched evaluation
+eval_batch_size = 64
+
 # data set path
 if MACHINE == "macbook":
     data_dir = os.path.join(
@@ -93,6 +104,14 @@ model.load_state_dict(loaded_state_dict)
 # model_single.load_state_dict(loaded_state_dict)
 model.eval()  # model in eval mode
 
+# z lists of encoded images are kept next to the checkpoint, so evaluating again costs only reverse passes
+latent_cache = LatentCache(
+    os.path.join(os.path.dirname(model_path), "latent_cache"),
+    get_checkpoint_hash(model_path),
+    image_size=args.img_size,
+    n_bits=args.n_bits,
+)
+
 
 def infer(model, image):
     """
@@ -263,6 +282,104 @@ def calculate_ssim_for_triplets(triplet_list, model, type="missing"):
     return ssims
 
 
+def encode_images(model, image_paths, batch_size=eval_batch_size, latent_cache=None):
+    """
+    Encodes images to z lists in batches
+    :param model:
+    :param image_paths: list of image paths
+    :param batch_size:
+    :param latent_cache: LatentCache of model, only images that are not in cache are encoded
+    :return: list of z tensors on cpu, one for each block, images in first dimension
+    """
+    if latent_cache is not None:
+        return latent_cache.get_or_encode(
+            image_paths, lambda paths: encode_images(model, paths, batch_size)
+        )
+    z_batches = []
+    for start in range(0, len(image_paths), batch_size):
+        images = read_images(
+            image_paths[start : start + batch_size], size=(args.img_size, args.img_size)
+        )
+        with torch.no_grad():
+            _, _, z_outs = model(images_to_tensor(images, device=device))
+        z_batches.append([z.cpu() for z in z_outs])
+    return [torch.cat(z_list, dim=0) for z_list in zip(*z_batches)]
+
+
+def calculate_ssim_for_triplets_batched(
+    triplets, model, type="missing", batch_size=eval_batch_size, latent_cache=None
+):
+    """
+    Batched calculate_ssim_for_triplets. Images are read and encoded once even if they are in many triplets,
+    z lists of a batch of triplets are blended and decoded at once, and SSIM is computed on device.
+    :param triplets: ImageCombinations view of image triplets, e.g. get_image_triplets_view(["ad"])
+    :param model:
+    :param type: "missing" predicts the middle image, "future" predicts the last image
+    :param batch_size: number of images encoded and triplets decoded at once
+    :param latent_cache: LatentCache of model, see encode_images
+    :return: list of ssim values in triplet order
+    """
+    if type == "missing":
+        input_columns, target_column = [0, 2], 1
+        create_z_sample = create_middle_z_sample
+    elif type == "future":
+        input_columns, target_column = [0, 1], 2
+        create_z_sample = create_future_z_sample
+    else:
+        raise ValueError(f"Unknown evaluation type {type}")
+    image_paths = triplets.image_paths()
+    image_indices = triplets.image_indices()
+    days = torch.from_numpy(triplets.days().astype(np.float32)).to(device)
+
+    # position of each image in encoded z tensors and in target images
+    input_images = np.unique(image_indices[:, input_columns])
+    z_all = encode_images(
+        model,
+        [image_paths[i] for i in input_images],
+        batch_size,
+        latent_cache=latent_cache,
+    )
+    z_position = np.zeros(len(image_paths), dtype=np.int64)
+    z_position[input_images] = np.arange(len(input_images))
+    target_images = np.unique(image_indices[:, target_column])
+    targets = rgb_to_gray(
+        torch.from_numpy(
+            read_images(
+                [image_paths[i] for i in target_images],
+                size=(args.img_size, args.img_size),
+            )
+        )
+        .permute(0, 3, 1, 2)
+        .to(device)
+    )
+    target_position = np.zeros(len(image_paths), dtype=np.int64)
+    target_position[target_images] = np.arange(len(target_images))
+
+    ssims = []
+    for start in range(0, len(image_indices), batch_size):
+        batch = image_indices[start : start + batch_size]
+        z1_list, z2_list = [
+            [z[z_position[batch[:, column]]].to(device) for z in z_all]
+            for column in input_columns
+        ]
+        batch_days = [
+            days[start : start + batch_size, i].view(-1, 1, 1, 1) for i in range(3)
+        ]
+        with torch.no_grad():
+            z_new = create_z_sample(days=batch_days, z1_list=z1_list, z2_list=z2_list)
+            predicted = rgb_to_gray(
+                model_outputs_to_uint8(model.reverse(z_new, reconstruct=True))
+            )
+            batch_ssims = structural_similarity_batch(
+                targets[target_position[batch[:, target_column]]],
+                predicted,
+                data_range=255,
+            )
+        ssims += batch_ssims.tolist()
+        print(f"({type}) {len(ssims)} / {len(image_indices)} : {batch_ssims.mean()}")
+    return ssims
+
+
 def print_ssims(ssims, title=""):
     print(title)
     print("mean ssim value: ", np.mean(ssims))
@@ -285,18 +402,19 @@ def print_ssims(ssims, title=""):
 # print_ssims(mci_ssims, "MCI")
 
 
-ad_ssims = calculate_ssim_for_triplets(
-    longitudinal_dataset.get_ad_image_triplets(), model_single, type="future"
-)
-print_ssims(ad_ssims, "AD")
-cn_ssims = calculate_ssim_for_triplets(
-    longitudinal_dataset.get_cn_image_triplets(), model_single, type="future"
-)
-print_ssims(cn_ssims, "CN")
-mci_ssims = calculate_ssim_for_triplets(
-    longitudinal_dataset.get_mci_image_triplets(), model_single, type="future"
-)
-print_ssims(mci_ssims, "MCI")
+# ad_ssims = calculate_ssim_for_triplets(
+#     longitudinal_dataset.get_ad_image_triplets(), model_single, type="future"
+# )
+# print_ssims(ad_ssims, "AD")
+
+for patient_type in ["ad", "cn", "mci"]:
+    ssims = calculate_ssim_for_triplets_batched(
+        longitudinal_dataset.get_image_triplets_view([patient_type]),
+        model_single,
+        type="future",
+        latent_cache=latent_cache,
+    )
+    print_ssims(ssims, patient_type.upper())
 
 
 # for data in longitudinal_dataset.get_ad_image_triplets():
@@ -1,3 +1,5 @@
+import os
+
 import cv2
 import torch
 import numpy as np
@@ -5,6 +7,7 @@ from skimage.metrics import structural_similarity
 
 from datasets.longitudinal_dataset import LongitudinalDataset
 
+from reference_papers.glow.latent_cache import LatentCache, get_checkpoint_hash
 from reference_papers.glow.model import Glow
 from reference_papers.glow.utils import read_image, model_output_to_image
 
@@ -43,6 +46,31 @@ loaded_state_dict = torch.load(model_path, map_location=torch.device("cpu"))
 model.load_state_dict(loaded_state_dict)
 model.eval()  # model in eval mode
 
+latent_cache = LatentCache(
+    os.path.join(os.path.dirname(model_path), "latent_cache"),
+    get_checkpoint_hash(model_path),
+    image_size=args.img_size,
+    n_bits=args.n_bits,
+)
+
+
+def encode_images(image_paths):
+    z_lists = []
+    for image_path in image_paths:
+        image = read_image(
+            image_path,
+            size=(args.img_size, args.img_size),
+            channel_first=True,
+            as_batch=True,
+            as_torch_tensor=True,
+            normalize=True,
+        )
+        with torch.no_grad():
+            _, _, z_list = model_single(image)
+        z_lists.append(z_list)
+    return [torch.cat(z, dim=0) for z in zip(*z_lists)]
+
+
 data_dir = "/Users/umutkucukaslan/Desktop/thesis/dataset/high_change_val_patients"
 dataset = LongitudinalDataset(data_dir=data_dir)
 
@@ -62,9 +90,9 @@ for x in dataset.get_mci_longitudinal_sequences():
         )
         for image_path in image_paths
     ]
-    with torch.no_grad():
-        _, _, z_first = model_single(images[0][0])
-        _, _, z_last = model_single(images[-1][0])
+    z_all = latent_cache.get_or_encode([image_paths[0], image_paths[-1]], encode_images)
+    z_first = [z[:1] for z in z_all]
+    z_last = [z[1:] for z in z_all]
     diff = [z_l - z_f for z_f, z_l in zip(z_first, z_last)]
     target_z_list_list = []
     relative_days.append(1.25)
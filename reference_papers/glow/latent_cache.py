@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+"""
+Persistent cache of Glow z lists, so that evaluation scripts encode every image once per model checkpoint.
+Entries are keyed by image path and modification time inside a cache folder of (checkpoint hash, image size,
+n_bits, preprocessing). z lists of each written batch are flattened into one float32 .npy shard, and
+index.json maps image paths to (mtime, shard, row). An image is encoded again if its mtime changes.
+
+    latent_cache = LatentCache(cache_dir, get_checkpoint_hash(model_path), image_size=64, n_bits=5)
+    z_list = latent_cache.get_or_encode(image_paths, encode_fn)
+"""
+
+INDEX_NAME = "index.json"
+INDEX_VERSION = 1
+
+
+def get_checkpoint_hash(checkpoint_path, chunk_size=2 ** 20):
+    """
+    sha1 of checkpoint file contents
+    """
+    file_hash = hashlib.sha1()
+    with open(checkpoint_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_state_dict_hash(model):
+    """
+    sha1 of parameters and buffers of a model, for models that are not loaded from a checkpoint file.
+    Compute it where the cache is used, a cache keyed by an earlier hash does not follow weight updates.
+    """
+    state_hash = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        state_hash.update(name.encode())
+        state_hash.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return state_hash.hexdigest()
+
+
+class LatentCache:
+    def __init__(
+        self, cache_dir, checkpoint_hash, image_size, n_bits, preprocessing="normalize"
+    ):
+        """
+        Cache of z lists of one model checkpoint and input preprocessing
+
+        :param cache_dir: root folder of caches, a subfolder is used for each key
+        :param checkpoint_hash: see get_checkpoint_hash and get_state_dict_hash
+        :param image_size: size images are resized to before encoding
+        :param n_bits: number of bits of model inputs
+        :param preprocessing: name of input preprocessing, caches of different preprocessing are not shared
+        """
+        self.folder = os.path.join(
+            cache_dir,
+            f"{checkpoint_hash[:16]}_{image_size}px_{n_bits}bits_{preprocessing}",
+        )
+        self.index_path = os.path.join(self.folder, INDEX_NAME)
+        self.z_shapes = None
+        self.entries = {}
+        self._shards = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as index_file:
+                index = json.load(index_file)
+            if index.get("version") == INDEX_VERSION:
+                self.z_shapes = [tuple(x) for x in index["z_shapes"]]
+                self.entries = index["entries"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _get_key(image_path):
+        image_path = os.path.abspath(image_path)
+        return image_path, os.stat(image_path).st_mtime_ns
+
+    def _load_shard(self, shard_name):
+        if shard_name not in self._shards:
+            self._shards[shard_name] = np.load(
+                os.path.join(self.folder, shard_name), mmap_mode="r"
+            )
+        return self._shards[shard_name]
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as index_file:
+            json.dump(
+                {
+                    "version": INDEX_VERSION,
+                    "z_shapes": [list(x) for x in self.z_shapes],
+                    "entries": self.entries,
+                },
+                index_file,
+            )
+        os.replace(tmp_path, self.index_path)
+
+    def _unflatten(self, flat):
+        z_list = []
+        start = 0
+        for shape in self.z_shapes:
+            size = int(np.prod(shape))
+            z_list.append(
+                torch.from_numpy(
+                    np.ascontiguousarray(flat[:, start : start + size])
+                ).view(-1, *shape)
+            )
+            start += size
+        return z_list
+
+    def contains(self, image_path):
+        image_path, mtime = self._get_key(image_path)
+        return image_path in self.entries and self.entries[image_path][0] == mtime
+
+    def get(self, image_paths):
+        """
+        z lists of cached images
+
+        :param image_paths: list of image paths, all of them must be in cache, see contains
+        :return: list of z tensors on cpu, one for each block, images in first dimension
+        """
+        locations = [self.entries[os.path.abspath(x)] for x in image_paths]
+        shard_names = np.array([x[1] for x in locations])
+        rows = np.array([x[2] for x in locations], dtype=np.int64)
+        flat = np.empty(
+            (len(image_paths), sum(int(np.prod(x)) for x in self.z_shapes)),
+            dtype=np.float32,
+        )
+        for shard_name in np.unique(shard_names):
+            mask = shard_names == shard_name
+            flat[mask] = self._load_shard(shard_name)[rows[mask]]
+        return self._unflatten(flat)
+
+    def put(self, image_paths, z_list):
+        """
+        Writes z lists of images as a new shard
+
+        :param image_paths: list of image paths
+        :param z_list: list of z tensors, one for each block, images in first dimension
+        """
+        z_shapes = [tuple(z.shape[1:]) for z in z_list]
+        if self.z_shapes is None:
+            self.z_shapes = z_shapes
+        elif self.z_shapes != z_shapes:
+            raise ValueError(
+                f"z shapes {z_shapes} do not match cached z shapes {self.z_shapes}"
+            )
+        flat = np.concatenate(
+            [z.detach().cpu().numpy().reshape(len(image_paths), -1) for z in z_list],
+            axis=1,
+        ).astype(np.float32)
+        os.makedirs(self.folder, exist_ok=True)
+        n_shards = len([x for x in os.listdir(self.folder) if x.startswith("shard_")])
+        shard_name = "shard_{:06d}.npy".format(n_shards)
+        np.save(os.path.join(self.folder, shard_name), flat)
+        for row, image_path in enumerate(image_paths):
+            image_path, mtime = self._get_key(image_path)
+            self.entries[image_path] = [mtime, shard_name, row]
+        self._save_index()
+
+    def get_or_encode(self, image_paths, encode_fn):
+        """
+        z lists of images from cache, encoding and caching the images that are not in cache
+
+        :param image_paths: list of image paths
+        :param encode_fn: function from a list of image paths to a list of z tensors, images in first dimension
+        :return: list of z tensors on cpu, one for each block, images in first dimension
+        """
+        missing = list(dict.fromkeys(x for x in image_paths if not self.contains(x)))
+        if missing:
+            self.put(missing, encode_fn(missing))
+        return self.get(image_paths)
@@ -1,8 +1,10 @@
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 import torch
+from torch.nn import functional as F
 
 
 def read_image(
@@ -41,3 +43,86 @@ def model_output_to_image(image_tensor):
     x = x * 255.0
     x = x.transpose((1, 2, 0)).astype(np.uint8)
     return x
+
+
+def read_images(image_paths, size=None, workers=8):
+    """
+    Reads images in a thread pool, as read_image with normalize=False
+
+    :param image_paths: list of image paths
+    :param size: (width, height) to resize images to, as in read_image
+    :param workers: number of threads
+    :return: uint8 array with shape (N, height, width, 3)
+    """
+
+    def read(image_path):
+        image = cv2.imread(image_path)
+        if size:
+            image = cv2.resize(image, dsize=size)
+        return image
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return np.stack(list(executor.map(read, image_paths)))
+
+
+def images_to_tensor(images, device=None):
+    """
+    uint8 images to normalized channel first model input, as read_image with normalize=True
+
+    :param images: uint8 array with shape (N, height, width, 3)
+    :param device: torch device
+    :return: float tensor with shape (N, 3, height, width)
+    """
+    images = torch.from_numpy(images)
+    if device:
+        images = images.to(device=device)
+    return (images.permute(0, 3, 1, 2).float() - 127.0) / 128.0
+
+
+def model_outputs_to_uint8(image_tensor):
+    """
+    Batched model outputs to uint8 images on the same device, as model_output_to_image of evaluate.py with
+    logic="new"
+
+    :param image_tensor: float tensor with shape (N, 3, height, width)
+    :return: uint8 tensor with shape (N, 3, height, width)
+    """
+    return torch.clamp(image_tensor * 127 + 128.0, 0, 255).to(torch.uint8)
+
+
+def rgb_to_gray(images):
+    """
+    cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) for a batch of uint8 images, with the same fixed point rounding
+
+    :param images: uint8 tensor with shape (N, 3, height, width)
+    :return: uint8 tensor with shape (N, height, width)
+    """
+    images = images.to(torch.int32)
+    gray = images[:, 0] * 9798 + images[:, 1] * 19235 + images[:, 2] * 3735
+    return ((gray + (1 << 14)) >> 15).to(torch.uint8)
+
+
+def structural_similarity_batch(images1, images2, data_range=255, win_size=7):
+    """
+    skimage.metrics.structural_similarity with default arguments (uniform window, sample covariance) for a
+    batch of grayscale images, computed on the device of the images
+
+    :param images1: tensor with shape (N, height, width)
+    :param images2: tensor with shape (N, height, width)
+    :param data_range: data range of images, 255 for uint8
+    :param win_size: side length of sliding window
+    :return: float64 tensor with shape (N,), ssim of each image pair
+    """
+    x = images1.to(torch.float64).unsqueeze(1)
+    y = images2.to(torch.float64).unsqueeze(1)
+    # mean over windows that lie inside the image, skimage crops the border windows
+    mean = lambda t: F.avg_pool2d(t, kernel_size=win_size, stride=1)
+    cov_norm = win_size ** 2 / (win_size ** 2 - 1)
+    ux, uy = mean(x), mean(y)
+    vx = cov_norm * (mean(x * x) - ux * ux)
+    vy = cov_norm * (mean(y * y) - uy * uy)
+    vxy = cov_norm * (mean(x * y) - ux * uy)
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+    return s.mean(dim=(1, 2, 3))
@@ -0,0 +1,538 @@
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import random
+import statistics
+import time
+import traceback
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from datasets.adni_dataset import get_triplets_adni_15t_dataset
+from datasets.longitudinal_dataset import LongitudinalDataset
+from model.ae.ae import AE
+
+"""
+Parallel patient specific fine-tuning of AE models.
+
+Every worker process holds one model replica and fine-tunes it for test samples taken from a shared
+work queue, the same way as testing/interpolate_2021_01_31_custom_ae.py does sequentially
+(future "f", missing "m" and previous "p" image prediction). Workers send result rows back to the main
+process, which is the only writer of the csv files. Rows of samples that are not in csv_progress.csv
+are removed on restart and these samples are run again. If a worker fails or dies, the run stops with an error.
+With --cache_dir, images are decoded once into on-disk tables that all workers memory-map.
+
+python -m testing.finetune_engine --experiment_name exp_2021_01_31_ae_no_similarity_loss --workers 4
+"""
+
+CSV_COLUMNS = {
+    "progress": ["sample_id"],
+    "interpolation_ssims": ["sample_id", "identifier", "train_step", "ssim"],
+    "val_loss": [
+        "sample_id",
+        "identifier",
+        "train_step",
+        "total_loss",
+        "image_similarity_loss",
+        "structure_vec_sim_loss",
+        "ssim",
+    ],
+    "train_and_pair_loss": [
+        "sample_id",
+        "identifier",
+        "train_step",
+        "total_loss",
+        "image_similarity_loss",
+        "structure_vec_sim_loss",
+        "ssim",
+        "image_similarity_loss_pair",
+        "structure_vec_sim_loss_pair",
+        "ssim_pair",
+    ],
+}
+
+# identifier, indices of the two input images, index of predicted image
+PREDICTION_MODES = [("f", 0, 1, 2), ("m", 0, 2, 1), ("p", 1, 2, 0)]
+
+# seconds between liveness checks of workers while waiting for results
+RESULT_TIMEOUT = 30
+
+
+def get_experiment_folder(machine, experiment_name):
+    if machine == "colab":
+        return os.path.join("/content/drive/My Drive/experiments", experiment_name)
+    elif machine == "cloud":
+        return os.path.join("/home/umutkucukaslan/experiments", experiment_name)
+    return os.path.join(
+        "/Users/umutkucukaslan/Desktop/thesis/experiments", experiment_name
+    )
+
+
+def csv_path(results_folder, name):
+    return os.path.join(results_folder, f"csv_{name}.csv")
+
+
+def read_csv_rows(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as csv_file:
+        return list(csv.DictReader(csv_file, delimiter=","))
+
+
+def append_csv_rows(path, columns, rows):
+    write_header = not os.path.isfile(path)
+    with open(path, mode="a") as csv_file:
+        csv_writer = csv.writer(
+            csv_file, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL
+        )
+        if write_header:
+            csv_writer.writerow(columns)
+        for row in rows:
+            csv_writer.writerow([row[c] for c in columns])
+
+
+class ResultCollector:
+    """
+    Saves images of a sample and collects its csv rows in memory, in the format of Saver
+    of the interpolation scripts
+    """
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.rows = {name: [] for name in CSV_COLUMNS if name != "progress"}
+
+    def save_interpolations_and_ssim(
+        self, sample_id, identifier, train_step, interpolations, interpolation_ssim
+    ):
+        image_name = f"sample_{int(sample_id):05d}_{str(identifier)}_step_{int(train_step):05d}.jpg"
+        cv2.imwrite(os.path.join(self.save_dir, image_name), interpolations)
+        self.rows["interpolation_ssims"].append(
+            {
+                "sample_id": sample_id,
+                "identifier": identifier,
+                "train_step": train_step,
+                "ssim": float(interpolation_ssim),
+            }
+        )
+
+    def save_true_sequence(self, sample_id, image_sequence):
+        image_name = f"sample_{int(sample_id):05d}_true.jpg"
+        cv2.imwrite(os.path.join(self.save_dir, image_name), image_sequence)
+
+    def save_val_losses(self, sample_id, identifier, train_step, val_losses):
+        self.rows["val_loss"].append(
+            dict(sample_id=sample_id, identifier=identifier, train_step=train_step)
+            | {k: float(v) for k, v in val_losses.items()}
+        )
+
+    def save_train_and_pair_losses(
+        self, sample_id, identifier, train_step, train_and_pair_losses
+    ):
+        self.rows["train_and_pair_loss"].append(
+            dict(sample_id=sample_id, identifier=identifier, train_step=train_step)
+            | {k: float(v) for k, v in train_and_pair_losses.items()}
+        )
+
+
+def finetune_sample(
+    model,
+    optimizer,
+    weights_snapshot,
+    sample_id,
+    sample,
+    train_ds,
+    val_ds,
+    collector,
+    config,
+):
+    """
+    Fine-tunes the model for future, missing and previous image prediction of one test triplet,
+    resetting the model from weights_snapshot before each run.
+    """
+    imgs = sample["imgs"]
+    days = [x.numpy()[0] for x in sample["days"]]
+    # extrapolate days
+    days += [days[-1] + i * 90 for i in range(1, 13)]
+    months = [int(round(d / 30.0)) for d in days]
+
+    true_sequence = [
+        np.clip(x.numpy()[0, ...] * 255, 0, 255).astype(np.uint8) for x in imgs
+    ]
+    true_sequence = [
+        cv2.putText(x, str(int(d)), (0, 10), cv2.FONT_HERSHEY_PLAIN, 1, 255)
+        for x, d in zip(true_sequence, months[:3])
+    ]
+    collector.save_true_sequence(sample_id, np.hstack(true_sequence))
+
+    for mode_index, (identifier, i, j, k) in enumerate(PREDICTION_MODES):
+        sample_points = [(x - days[i]) / (days[j] - days[i]) for x in days]
+
+        def generate_seq_callback_fn(step):
+            interpolation_image, ssim = model.interpolate_and_calculate_ssim(
+                imgs[i],
+                imgs[j],
+                sample_points,
+                imgs[k],
+                ground_truth_index=k,
+                dates=months,
+                structure_mix_type="mean",
+            )
+            collector.save_interpolations_and_ssim(
+                sample_id, identifier, step, interpolation_image, ssim
+            )
+
+        def callback_fn_save_val_losses(step, val_losses):
+            collector.save_val_losses(sample_id, identifier, step, val_losses)
+
+        def callback_fn_save_train_and_pair_losses(step, train_and_pair_losses):
+            collector.save_train_and_pair_losses(
+                sample_id, identifier, step, train_and_pair_losses
+            )
+
+        model.restore_weights_snapshot(weights_snapshot, optimizer)
+        print(f"sample id: {sample_id} - {mode_index + 1}/3 - {identifier}")
+        model.train_for_patient2(
+            imgs[i],
+            imgs[j],
+            train_ds,
+            val_ds,
+            num_steps=config["num_steps"],
+            period=config["period"],
+            lr=config["lr"],
+            callback_fn_generate_seq=generate_seq_callback_fn,
+            callback_fn_save_val_losses=callback_fn_save_val_losses,
+            callback_fn_save_train_and_pair_losses=callback_fn_save_train_and_pair_losses,
+            use_training_set=config["use_training_set"],
+            optimizer=optimizer,
+        )
+
+
+def get_datasets(config):
+    height, width, channels = config["input_shape"]
+    # same seed in every worker, so reduced training sets are the same
+    random.seed(config["seed"])
+    return get_triplets_adni_15t_dataset(
+        folder_name=config["folder_name"],
+        machine=config["machine"],
+        target_shape=[height, width],
+        channels=channels,
+        reduced_dataset=config["reduction_ratio"],
+        decode_once=config["cache_dir"] is not None,
+        cache_dir=config["cache_dir"],
+    )
+
+
+def worker(worker_id, config, work_queue, result_queue):
+    """
+    Fine-tunes samples from work_queue until it gets None. Sends a result for each sample,
+    an error message if it fails and a finished message at the end.
+    """
+    try:
+        run_worker(worker_id, config, work_queue, result_queue)
+    except Exception:
+        result_queue.put({"worker_id": worker_id, "error": traceback.format_exc()})
+    finally:
+        result_queue.put({"worker_id": worker_id, "finished": True})
+
+
+def run_worker(worker_id, config, work_queue, result_queue):
+    if config["threads_per_worker"]:
+        tf.config.threading.set_intra_op_parallelism_threads(
+            config["threads_per_worker"]
+        )
+        tf.config.threading.set_inter_op_parallelism_threads(
+            config["threads_per_worker"]
+        )
+    for gpu in tf.config.experimental.list_physical_devices("GPU"):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+    height, width, channels = config["input_shape"]
+    model = AE(**config["model_kwargs"])
+    _ = model(tf.zeros((1, height, width, channels)))
+    model.restore_model(config["checkpoint_dir"])
+    optimizer = tf.optimizers.Adam(config["lr"], beta_1=0.5)
+    model.build_optimizer(optimizer)
+    weights_snapshot = model.snapshot_weights(optimizer)
+
+    train_ds, val_ds, test_ds = get_datasets(config)
+    train_ds = train_ds.shuffle(1000).batch(32).prefetch(2)
+    val_ds = val_ds.batch(32).prefetch(2)
+    # sample ids are taken from the queue in increasing order, so the test set is read only once
+    test_iterator = iter(test_ds.batch(1).enumerate())
+
+    while True:
+        sample_id = work_queue.get()
+        if sample_id is None:
+            break
+        test_id, sample = next(test_iterator)
+        while int(test_id) < sample_id:
+            test_id, sample = next(test_iterator)
+        start_time = time.time()
+        collector = ResultCollector(config["results_folder"])
+        finetune_sample(
+            model,
+            optimizer,
+            weights_snapshot,
+            sample_id,
+            sample,
+            train_ds,
+            val_ds,
+            collector,
+            config,
+        )
+        result_queue.put(
+            {
+                "sample_id": sample_id,
+                "rows": collector.rows,
+                "duration": time.time() - start_time,
+                "worker_id": worker_id,
+            }
+        )
+
+
+def get_number_of_test_samples(config):
+    if config["machine"] == "colab":
+        data_dir = os.path.join("/content", config["folder_name"])
+    elif config["machine"] == "cloud":
+        data_dir = os.path.join("/home/umutkucukaslan/data", config["folder_name"])
+    else:
+        data_dir = os.path.join(
+            "/Users/umutkucukaslan/Desktop/thesis/dataset", config["folder_name"]
+        )
+    test_long = LongitudinalDataset(data_dir=os.path.join(data_dir, "test"))
+    return len(test_long.get_image_triplets_view())
+
+
+def remove_unfinished_rows(results_folder, done):
+    """
+    Removes csv rows of samples that are not in csv_progress.csv. They are left by a run that stopped
+    after writing the rows of a sample but before writing its progress entry.
+
+    :param done: set of sample ids in csv_progress.csv
+    """
+    for name, columns in CSV_COLUMNS.items():
+        if name == "progress":
+            continue
+        path = csv_path(results_folder, name)
+        rows = read_csv_rows(path)
+        finished_rows = [x for x in rows if int(x["sample_id"]) in done]
+        if len(finished_rows) < len(rows):
+            print(
+                f"removing {len(rows) - len(finished_rows)} unfinished rows of {path}"
+            )
+            tmp_path = path + ".tmp"
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            append_csv_rows(tmp_path, columns, finished_rows)
+            os.replace(tmp_path, path)
+
+
+def aggregate_results(results_folder):
+    """
+    Mean and standard deviation of interpolation ssims of all samples for each identifier and train step
+
+    :return: list of summary rows, also written to csv_interpolation_ssims_summary.csv
+    """
+    groups = {}
+    for row in read_csv_rows(csv_path(results_folder, "interpolation_ssims")):
+        key = (row["identifier"], int(row["train_step"]))
+        groups.setdefault(key, []).append(float(row["ssim"]))
+    summary = [
+        {
+            "identifier": identifier,
+            "train_step": train_step,
+            "n_samples": len(ssims),
+            "mean_ssim": statistics.mean(ssims),
+            "std_ssim": statistics.pstdev(ssims),
+        }
+        for (identifier, train_step), ssims in sorted(groups.items())
+    ]
+    summary_path = csv_path(results_folder, "interpolation_ssims_summary")
+    if os.path.isfile(summary_path):
+        os.remove(summary_path)
+    append_csv_rows(
+        summary_path,
+        ["identifier", "train_step", "n_samples", "mean_ssim", "std_ssim"],
+        summary,
+    )
+    return summary
+
+
+def run(config, num_workers, sample_range=None):
+    """
+    Fine-tunes all test samples that are not in csv_progress.csv with num_workers processes
+
+    :param config: dict of engine parameters, see __main__
+    :param num_workers: number of worker processes, each with one model replica
+    :param sample_range: optional [start, stop) range of sample ids
+    :return: aggregated results, see aggregate_results
+    """
+    results_folder = config["results_folder"]
+    if not os.path.isdir(results_folder):
+        os.makedirs(results_folder)
+    done = {
+        int(row["sample_id"])
+        for row in read_csv_rows(csv_path(results_folder, "progress"))
+    }
+    remove_unfinished_rows(results_folder, done)
+    n_samples = get_number_of_test_samples(config)
+    start, stop = sample_range if sample_range else (0, n_samples)
+    sample_ids = [x for x in range(start, min(stop, n_samples)) if x not in done]
+    print(
+        f"{len(sample_ids)} samples to fine-tune, {len(done)} samples done before, "
+        f"{num_workers} workers"
+    )
+
+    if config["cache_dir"] is not None:
+        # decode image tables once here, workers memory-map the same files
+        for ds in get_datasets(config):
+            for _ in ds.take(1):
+                pass
+
+    context = multiprocessing.get_context("spawn")
+    work_queue = context.Queue()
+    result_queue = context.Queue()
+    for sample_id in sample_ids:
+        work_queue.put(sample_id)
+    for _ in range(num_workers):
+        work_queue.put(None)
+    processes = [
+        context.Process(
+            target=worker, args=(worker_id, config, work_queue, result_queue)
+        )
+        for worker_id in range(num_workers)
+    ]
+    for process in processes:
+        process.start()
+
+    start_time = time.time()
+    finished_workers = set()
+    n_done = 0
+    try:
+        while len(finished_workers) < num_workers:
+            # a worker that is found dead before get has already sent all of its messages
+            dead_workers = [
+                worker_id
+                for worker_id, process in enumerate(processes)
+                if worker_id not in finished_workers and not process.is_alive()
+            ]
+            try:
+                result = result_queue.get(timeout=RESULT_TIMEOUT)
+            except queue.Empty:
+                if dead_workers:
+                    raise RuntimeError(
+                        f"worker {dead_workers[0]} exited with code "
+                        f"{processes[dead_workers[0]].exitcode} before finishing"
+                    )
+                continue
+            if "error" in result:
+                raise RuntimeError(
+                    f"worker {result['worker_id']} failed:\n{result['error']}"
+                )
+            if "finished" in result:
+                finished_workers.add(result["worker_id"])
+                continue
+            for name, rows in result["rows"].items():
+                append_csv_rows(csv_path(results_folder, name), CSV_COLUMNS[name], rows)
+            append_csv_rows(
+                csv_path(results_folder, "progress"),
+                CSV_COLUMNS["progress"],
+                [{"sample_id": result["sample_id"]}],
+            )
+            n_done += 1
+            elapsed = time.time() - start_time
+            print(
+                f"sample id: {result['sample_id']} took {round(result['duration'])} seconds "
+                f"on worker {result['worker_id']}, {n_done}/{len(sample_ids)} done, "
+                f"{n_done / elapsed * 3600:.1f} samples/hour"
+            )
+    except BaseException:
+        for process in processes:
+            process.terminate()
+            process.join()
+        raise
+    for process in processes:
+        process.join()
+
+    summary = aggregate_results(results_folder)
+    for row in summary:
+        print(
+            f"{row['identifier']} step {row['train_step']:4d}: "
+            f"ssim {row['mean_ssim']:.4f} +- {row['std_ssim']:.4f} ({row['n_samples']} samples)"
+        )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel patient fine-tuning")
+    parser.add_argument(
+        "--experiment_name", default="exp_2021_01_31_ae_no_similarity_loss"
+    )
+    parser.add_argument("--machine", default="none", help="none, colab or cloud")
+    parser.add_argument(
+        "--checkpoint_dir_name", default="checkpoints", help="or best_checkpoint"
+    )
+    parser.add_argument(
+        "--results_subfolder",
+        default="testing/sequences/long_state_only/reduced_trainset_full/test_train_for_patient2",
+    )
+    parser.add_argument("--folder_name", default="training_data_15T_192x160_4slices")
+    parser.add_argument(
+        "--no_training_set",
+        action="store_true",
+        help="fine-tune using only the test pair",
+    )
+    parser.add_argument("--reduction_ratio", default=1.0, type=float)
+    parser.add_argument("--num_steps", default=120, type=int)
+    parser.add_argument("--period", default=10, type=int)
+    parser.add_argument("--lr", default=1e-4, type=float)
+    parser.add_argument("--workers", default=os.cpu_count(), type=int)
+    parser.add_argument(
+        "--threads_per_worker",
+        default=None,
+        type=int,
+        help="TF threads of each worker, defaults to cpu count / workers",
+    )
+    parser.add_argument("--start", default=None, type=int, help="first sample id")
+    parser.add_argument("--stop", default=None, type=int, help="last sample id + 1")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help="decode images once into on-disk tables in this folder, shared by all workers",
+    )
+    args = parser.parse_args()
+
+    experiment_folder = get_experiment_folder(args.machine, args.experiment_name)
+    config = {
+        "model_kwargs": {
+            "filters": [64, 128, 256, 512],
+            "kernel_size": 3,
+            "activation": tf.nn.silu,
+            "last_activation": tf.nn.sigmoid,
+            "structure_vec_size": 100,
+            "longitudinal_vec_size": 1,
+        },
+        "input_shape": [64, 64, 1],
+        "checkpoint_dir": os.path.join(experiment_folder, args.checkpoint_dir_name),
+        "results_folder": os.path.join(experiment_folder, args.results_subfolder),
+        "folder_name": args.folder_name,
+        "machine": args.machine,
+        "use_training_set": not args.no_training_set,
+        "reduction_ratio": args.reduction_ratio,
+        "num_steps": args.num_steps,
+        "period": args.period,
+        "lr": args.lr,
+        "threads_per_worker": args.threads_per_worker
+        or max(1, os.cpu_count() // args.workers),
+        "seed": args.seed,
+        "cache_dir": args.cache_dir,
+    }
+    sample_range = None
+    if args.start is not None or args.stop is not None:
+        sample_range = [args.start or 0, args.stop or 10**9]
+    run(config, args.workers, sample_range=sample_range)
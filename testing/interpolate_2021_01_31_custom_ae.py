@@ -74,10 +74,15 @@ checkpoint_dir = os.path.join(EXPERIMENT_FOLDER, "checkpoints")  # latest checkp
 # checkpoint_dir = os.path.join(EXPERIMENT_FOLDER, "best_checkpoint")
 model.restore_model(checkpoint_dir)
 print("model restored")
+# weights and fresh optimizer state are kept in memory to reset the model between fine-tuning runs
+finetune_optimizer = tf.optimizers.Adam(1e-4, beta_1=0.5)
+model.build_optimizer(finetune_optimizer)
+weights_snapshot = model.snapshot_weights(finetune_optimizer)
 print("args:")
 print(sys.argv)
 
 
+# manual sharding of test samples, testing/finetune_engine.py runs all samples in parallel instead
 check_interval = None
 interval = None
 if len(sys.argv) > 1:
@@ -426,7 +431,7 @@ for sample_id, sample in enumerate(test_ds):
             train_and_pair_losses=train_and_pair_losses,
         )
 
-    model.restore_model(checkpoint_dir)
+    model.restore_weights_snapshot(weights_snapshot, finetune_optimizer)
     print(f"sample id: {sample_id} - {1}/3 - f")
     # model.train_for_patient(
     #     imgs[0],
@@ -453,6 +458,7 @@ for sample_id, sample in enumerate(test_ds):
         callback_fn_save_val_losses=callback_fn_save_val_losses,
         callback_fn_save_train_and_pair_losses=callback_fn_save_train_and_pair_losses,
         use_training_set=USE_TRAINING_SET,
+        optimizer=finetune_optimizer,
     )
 
     # =======================================================================================
@@ -500,7 +506,7 @@ for sample_id, sample in enumerate(test_ds):
             train_and_pair_losses=train_and_pair_losses,
         )
 
-    model.restore_model(checkpoint_dir)
+    model.restore_weights_snapshot(weights_snapshot, finetune_optimizer)
     print(f"sample id: {sample_id} - {2}/3 - m")
     # model.train_for_patient(
     #     imgs[0],
@@ -527,6 +533,7 @@ for sample_id, sample in enumerate(test_ds):
         callback_fn_save_val_losses=callback_fn_save_val_losses,
         callback_fn_save_train_and_pair_losses=callback_fn_save_train_and_pair_losses,
         use_training_set=USE_TRAINING_SET,
+        optimizer=finetune_optimizer,
     )
 
     # =======================================================================================
@@ -574,7 +581,7 @@ for sample_id, sample in enumerate(test_ds):
             train_and_pair_losses=train_and_pair_losses,
         )
 
-    model.restore_model(checkpoint_dir)
+    model.restore_weights_snapshot(weights_snapshot, finetune_optimizer)
     print(f"sample id: {sample_id} - {3}/3 - p")
     # model.train_for_patient(
     #     imgs[1],
@@ -601,6 +608,7 @@ for sample_id, sample in enumerate(test_ds):
         callback_fn_save_val_losses=callback_fn_save_val_losses,
         callback_fn_save_train_and_pair_losses=callback_fn_save_train_and_pair_losses,
         use_training_set=USE_TRAINING_SET,
+        optimizer=finetune_optimizer,
     )
 
     end_time = time.time()